@@ -1,14 +1,35 @@
 import json
-from matplotlib import pyplot as plt
-import pandas as pd
-import pymysql
-from sqlalchemy import create_engine
-from config import *
-import requests
-import osmium
-import yaml
+from .config import *
+from .lazy import lazy_import
+from . import metrics
+from .metrics import peak_rss_mb
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+from array import array
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 import csv
-import osmnx as ox
+import datetime
+
+# Heavy dependencies are imported on first use
+plt = lazy_import("matplotlib.pyplot")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+pymysql = lazy_import("pymysql")
+sqlalchemy = lazy_import("sqlalchemy")
+requests = lazy_import("requests")
+urllib3 = lazy_import("urllib3")
+osmium = lazy_import("osmium")
+yaml = lazy_import("yaml")
+ox = lazy_import("osmnx")
+gpd = lazy_import("geopandas")
+shapely = lazy_import("shapely")
+ds = lazy_import("pyarrow.dataset")
+fs = lazy_import("pyarrow.fs")
 
 """These are the types of import we might expect in this file
 import httplib2
@@ -28,22 +49,240 @@ def data():
 def hello_world():
     print("Hello from the data science library! (and Joel!)")
 
-def download_price_paid_data(start_year, end_year):
-    base_url = "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com"
+PRICE_PAID_BASE_URL = "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com"
+
+def get_http_session(pool_size=8, retries=3):
+    """ Create a requests session with a connection pool and retries on
+        transient server errors.
+    :param pool_size: number of pooled connections per host
+    :param retries: number of retries for failed requests
+    :return: requests.Session
+    """
+    retry = urllib3.util.retry.Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _read_json(meta_path):
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            return json.load(file)
+    return {}
+
+def _file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha
+
+def download_file(session, url, path, chunk_size=1 << 20):
+    """ Stream a file to disk, resuming a partial download with an HTTP Range
+        request and skipping it with a conditional GET if it is unchanged.
+        The ETag and Last-Modified headers of the complete file are kept in a
+        <path>.meta.json file, written only once the body is on disk; those of
+        a download in progress are kept in <path>.part.meta.json.
+    :param session: requests session
+    :param url: url of the file
+    :param path: local path to write to
+    :param chunk_size: bytes per streamed chunk
+    :return: dict with the url, path, status, bytes, seconds and sha256
+    """
+    start = time.time()
+    meta_path = path + ".meta.json"
+    part_path = path + ".part"
+    part_meta_path = part_path + ".meta.json"
+    meta = _read_json(meta_path)
+    part_meta = {}
+    headers = {}
+    offset = 0
+    if os.path.exists(part_path):
+        part_meta = _read_json(part_meta_path)
+        # Without a validator a changed file would be appended to the stale partial
+        validator = part_meta.get("etag") or part_meta.get("last_modified")
+        if validator and os.path.getsize(part_path):
+            offset = os.path.getsize(part_path)
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+    if not offset and os.path.exists(path) and meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    def complete(sha):
+        os.replace(part_path, path)
+        part_meta["sha256"] = sha.hexdigest()
+        with open(meta_path, "w") as file:
+            json.dump(part_meta, file)
+        if os.path.exists(part_meta_path):
+            os.remove(part_meta_path)
+        return part_meta["sha256"]
+
+    result = {"url": url, "path": path, "status": None, "bytes": 0, "seconds": 0.0, "sha256": meta.get("sha256")}
+    with metrics.span("download_file", url=url) as span, session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            result["status"] = "unchanged"
+        elif response.status_code == 416 and offset:
+            # The partial file already holds the whole body
+            result["status"] = "resumed"
+            result["sha256"] = complete(_file_sha256(part_path))
+        elif response.status_code in (200, 206):
+            if response.status_code == 206 and offset:
+                sha = _file_sha256(part_path)
+                mode = "ab"
+                result["status"] = "resumed"
+            else:
+                sha = hashlib.sha256()
+                mode = "wb"
+                result["status"] = "downloaded"
+                part_meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                with open(part_meta_path, "w") as file:
+                    json.dump(part_meta, file)
+            with open(part_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    sha.update(chunk)
+                    result["bytes"] += len(chunk)
+            result["sha256"] = complete(sha)
+        else:
+            result["status"] = f"missing ({response.status_code})"
+        span.add(bytes=result["bytes"], status=result["status"])
+    result["seconds"] = time.time() - start
+    return result
+
+def download_price_paid_data(start_year, end_year, base_url=PRICE_PAID_BASE_URL, data_dir=".", max_workers=4):
+    """ Download the price paid csv files for each year in [start_year, end_year)
+        concurrently, skipping files that are unchanged since the last run.
+    :param start_year: first year to download
+    :param end_year: year to stop at (exclusive)
+    :param base_url: url of the Land Registry bucket
+    :param data_dir: directory to write the files to
+    :param max_workers: number of concurrent downloads
+    :return: list of manifest dicts, one per file
+    """
     # File name with placeholders
     file_name = "/pp-<year>-part<part>.csv"
+    jobs = []
     for year in range(start_year, end_year):
-        print("Downloading data for year: " + str(year))
         for part in range(1,3):
-            url = base_url + file_name.replace("<year>", str(year)).replace("<part>", str(part))
-            response = requests.get(url)
-            if response.status_code == 200:
-                with open("." + file_name.replace("<year>", str(year)).replace("<part>", str(part)), "wb") as file:
-                    file.write(response.content)
+            name = file_name.replace("<year>", str(year)).replace("<part>", str(part))
+            jobs.append((year, part, base_url + name, data_dir + name))
+
+    os.makedirs(data_dir, exist_ok=True)
+    session = get_http_session(pool_size=max_workers)
+
+    def download(job):
+        year, part, url, path = job
+        try:
+            result = download_file(session, url, path)
+        except Exception as e:
+            # Keep going so one failed file does not lose the manifest of the others
+            result = {"url": url, "path": path, "status": f"error: {e}", "bytes": 0, "seconds": 0.0, "sha256": None}
+        result.update({"year": year, "part": part})
+        print(f"Year {year} part {part}: {result['status']}, {result['bytes']} bytes in {result['seconds']:.1f}s")
+        return result
+
+    with metrics.span("download_price_paid_data", start_year=start_year, end_year=end_year) as span:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            manifest = list(executor.map(download, jobs))
+        span.add(bytes=sum(result["bytes"] for result in manifest), files=len(manifest))
+    session.close()
+    return manifest
+
+_engines = {}
+_engine_stats = {}
+_engines_lock = threading.Lock()
+# Pool events fire from whichever thread checks a connection in or out
+_engine_stats_lock = threading.Lock()
+
+def _add_engine_stat(stats, key, value):
+    with _engine_stats_lock:
+        stats[key] += value
+
+def get_engine_for_url(db_url, **engine_kwargs):
+    """ Return the shared engine for a SQLAlchemy url, creating it on first use.
+        Pool size, overflow, recycle and pre-ping come from the config.
+    :param db_url: SQLAlchemy database url
+    :param engine_kwargs: extra arguments passed to create_engine
+    :return: Engine object
+    """
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if engine is not None:
+            return engine
+        if not db_url.startswith("sqlite"):
+            engine_kwargs.setdefault("pool_size", config.get("db_pool_size", 5))
+            engine_kwargs.setdefault("max_overflow", config.get("db_max_overflow", 10))
+        engine_kwargs.setdefault("pool_recycle", config.get("db_pool_recycle", 3600))
+        engine_kwargs.setdefault("pool_pre_ping", config.get("db_pool_pre_ping", True))
+        engine = sqlalchemy.create_engine(db_url, **engine_kwargs)
+        stats = {"connections": 0, "active": 0, "checkouts": 0, "checkout_wait_seconds": 0.0}
+
+        def on_connect(dbapi_connection, connection_record):
+            _add_engine_stat(stats, "connections", 1)
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            with _engine_stats_lock:
+                stats["active"] += 1
+                stats["checkouts"] += 1
+
+        def on_checkin(dbapi_connection, connection_record):
+            _add_engine_stat(stats, "active", -1)
+
+        sqlalchemy.event.listen(engine, "connect", on_connect)
+        sqlalchemy.event.listen(engine, "checkout", on_checkout)
+        sqlalchemy.event.listen(engine, "checkin", on_checkin)
+        metrics.instrument_engine(engine)
+        _engines[db_url] = engine
+        _engine_stats[engine] = stats
+        return engine
+
+def get_engine(username, password, url, database="ads_2024", port=3306):
+    """ Return the shared engine for a MariaDB database, keyed by credentials and host.
+    :param username: username
+    :param password: password
+    :param url: host url
+    :param database: database name
+    :param port: port number
+    :return: Engine object
+    """
+    return get_engine_for_url(f"mysql+pymysql://{username}:{password}@{url}:{port}/{database}", connect_args={"local_infile": 1})
+
+@contextmanager
+def engine_connection(engine):
+    """ Check a connection out of the engine's pool, recording the wait time. """
+    start = time.perf_counter()
+    conn = engine.connect()
+    _add_engine_stat(_engine_stats[engine], "checkout_wait_seconds", time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def engine_stats():
+    """ Pool counters for every registered engine, keyed by url without the password.
+    :return: dict of dicts with connections opened, active connections,
+        number of checkouts and total checkout wait time in seconds
+    """
+    with _engines_lock:
+        with _engine_stats_lock:
+            return {engine.url.render_as_string(hide_password=True): dict(_engine_stats[engine]) for engine in _engines.values()}
+
+def dispose_engines():
+    """ Close every pooled connection and empty the registry. """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _engine_stats.clear()
 
 def create_connection(user, password, host, database, port=3306):
     """ Create a database connection to the MariaDB database
-        specified by the host url and database name.
+        specified by the host url and database name. The connection
+        is checked out of the shared pool and returned to it on close.
     :param user: username
     :param password: password
     :param host: host url
@@ -53,65 +292,1069 @@ def create_connection(user, password, host, database, port=3306):
     """
     conn = None
     try:
-        conn = pymysql.connect(user=user,
-                               passwd=password,
-                               host=host,
-                               port=port,
-                               local_infile=1,
-                               db=database
-                               )
+        conn = connect(user, password, host, database, port)
         print(f"Connection established!")
+    except ConnectionError as e:
+        print(e)
+    return conn
+
+def connect(user, password, host, database, port=3306):
+    """ create_connection for batch jobs: raises instead of returning None.
+    :return: Connection object
+    :raises ConnectionError: if the server can't be reached or rejects the login
+    """
+    try:
+        engine = get_engine(user, password, host, database, port)
+        start = time.perf_counter()
+        conn = engine.raw_connection()
     except Exception as e:
-        print(f"Error connecting to the MariaDB Server: {e}")
+        raise ConnectionError(f"Error connecting to the MariaDB Server: {e}") from e
+    _add_engine_stat(_engine_stats[engine], "checkout_wait_seconds", time.perf_counter() - start)
     return conn
 
-def housing_upload_join_data(conn, year):
+PP_DATA_COLUMNS = ["transaction_unique_identifier", "price", "date_of_transfer", "postcode", "property_type", "new_build_flag", "tenure_type", "primary_addressable_object_name", "secondary_addressable_object_name", "street", "locality", "town_city", "district", "county", "ppd_category_type", "record_status"]
+
+PRICES_COORDINATES_COLUMNS = "transaction_unique_identifier, price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude"
+
+# Tables created before create_prices_coordinates_table have no transaction id
+LEGACY_PRICES_COORDINATES_COLUMNS = "price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude"
+
+LEGACY_HOUSING_JOIN_QUERY = "SELECT pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude FROM (SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county FROM pp_data WHERE date_of_transfer BETWEEN %s AND %s) AS pp INNER JOIN postcode_data AS po ON pp.postcode = po.postcode"
+
+HOUSING_JOIN_QUERY = "SELECT pp.transaction_unique_identifier, pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude FROM (SELECT transaction_unique_identifier, price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county FROM pp_data WHERE date_of_transfer BETWEEN %s AND %s) AS pp INNER JOIN postcode_data AS po ON pp.postcode = po.postcode"
+
+PRICES_COORDINATES_TABLE = """CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
+  `transaction_unique_identifier` varchar(38) COLLATE utf8_bin NOT NULL,
+  `price` int(10) unsigned NOT NULL,
+  `date_of_transfer` date NOT NULL,
+  `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+  `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+  `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+  `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+  `locality` tinytext COLLATE utf8_bin NOT NULL,
+  `town_city` tinytext COLLATE utf8_bin NOT NULL,
+  `district` tinytext COLLATE utf8_bin NOT NULL,
+  `county` tinytext COLLATE utf8_bin NOT NULL,
+  `country` enum('England', 'Wales', 'Scotland', 'Northern Ireland', 'Channel Islands', 'Isle of Man') NOT NULL,
+  `latitude` decimal(11,8) NOT NULL,
+  `longitude` decimal(10,8) NOT NULL,
+  `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  PRIMARY KEY (`transaction_unique_identifier`, `date_of_transfer`),
+  KEY `idx_prices_coordinates_db_id` (`db_id`),
+  KEY `idx_prices_coordinates_date` (`date_of_transfer`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin"""
+
+# Bookkeeping for incremental loads, in SQL that MariaDB and SQLite both accept
+WATERMARK_TABLES = [
+    "CREATE TABLE IF NOT EXISTS prices_coordinates_watermarks (year INT NOT NULL PRIMARY KEY, row_count BIGINT NOT NULL, max_date_of_transfer DATE, last_update_id VARCHAR(64), source VARCHAR(255), updated_at DATETIME)",
+    "CREATE TABLE IF NOT EXISTS pp_update_log (update_id VARCHAR(64) NOT NULL PRIMARY KEY, source VARCHAR(255), added INT, changed INT, deleted INT, applied_at DATETIME)",
+]
+
+def create_prices_coordinates_table(conn, start_year=1995, end_year=None):
+    """ Create prices_coordinates_data keyed by (transaction_unique_identifier,
+        date_of_transfer) and partitioned by year, with one partition per year
+        from start_year to end_year and a catch-all pmax, along with the
+        watermark and update log tables. Also indexes pp_data by transaction id.
+        An existing unpartitioned prices_coordinates_data must be renamed or
+        dropped first and reloaded with housing_upload_join_data_years.
+    :param conn: Connection object
+    :param start_year: first year with its own partition
+    :param end_year: last year with its own partition, the current year by default
+    """
+    end_year = end_year or datetime.date.today().year
+    partitions = ", ".join(f"PARTITION p{year} VALUES LESS THAN ({year + 1})" for year in range(start_year, end_year + 1))
+    with conn.cursor() as cur:
+        cur.execute(PRICES_COORDINATES_TABLE + f" PARTITION BY RANGE (YEAR(date_of_transfer)) ({partitions}, PARTITION pmax VALUES LESS THAN MAXVALUE)")
+        for statement in WATERMARK_TABLES:
+            cur.execute(statement)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pp_data_transaction ON pp_data (transaction_unique_identifier(38))")
+    conn.commit()
+
+def _table_partitions(conn, table="prices_coordinates_data"):
+    """ (name, upper bound) of each partition of table, empty if it is not partitioned. """
+    with conn.cursor() as cur:
+        cur.execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION", (table,))
+        return list(cur.fetchall())
+
+def _table_columns(conn, table):
+    """ Column names of table, read from an empty SELECT so it also works on SQLite. """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT * FROM {table} LIMIT 0")
+        return [column[0] for column in cur.description]
+
+def prices_coordinates_layout(conn):
+    """ Column list and join query matching the prices_coordinates_data in the
+        database: with transaction_unique_identifier, or without it for tables
+        created before create_prices_coordinates_table.
+    :return: (columns, join query)
+    """
+    if "transaction_unique_identifier" in _table_columns(conn, "prices_coordinates_data"):
+        return PRICES_COORDINATES_COLUMNS, HOUSING_JOIN_QUERY
+    return LEGACY_PRICES_COORDINATES_COLUMNS, LEGACY_HOUSING_JOIN_QUERY
+
+def _has_date_index(conn, table="prices_coordinates_data"):
+    """ Whether some index of table starts with date_of_transfer. """
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'date_of_transfer' AND SEQ_IN_INDEX = 1", (table,))
+        return cur.fetchone()[0] > 0
+
+def year_partition(conn, year, table="prices_coordinates_data"):
+    """ The partition holding exactly the given year. Years past the last
+        yearly partition are split off pmax, one partition per year. The
+        first partition also holds every earlier year, so start_year is never
+        swapped and is reloaded with DELETE and INSERT instead.
+    :return: partition name, or None if the table is not partitioned or the
+        year shares a partition with other years
+    """
+    lower = None
+    for name, bound in _table_partitions(conn, table):
+        if bound == "MAXVALUE":
+            if lower is None:
+                return None
+            # Every earlier bound is <= year, so at least p{year} is new
+            new_partitions = ", ".join(f"PARTITION p{new_year} VALUES LESS THAN ({new_year + 1})" for new_year in range(lower, year + 1))
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {name} INTO ({new_partitions}, PARTITION {name} VALUES LESS THAN MAXVALUE)")
+            return f"p{year}"
+        if year < int(bound):
+            return name if lower == year and int(bound) == year + 1 else None
+        lower = int(bound)
+    return None
+
+def _write_watermark(cur, year, update_id, source):
+    cur.execute("SELECT COUNT(*), MAX(date_of_transfer) FROM prices_coordinates_data WHERE date_of_transfer BETWEEN %s AND %s", (f"{year}-01-01", f"{year}-12-31"))
+    row_count, max_date = cur.fetchone()
+    cur.execute("REPLACE INTO prices_coordinates_watermarks (year, row_count, max_date_of_transfer, last_update_id, source, updated_at) VALUES (%s, %s, %s, %s, %s, %s)",
+                (year, row_count, max_date, update_id, source, time.strftime("%Y-%m-%d %H:%M:%S")))
+    return row_count
+
+def get_watermarks(conn):
+    """ The per-year watermarks of prices_coordinates_data: rows, latest
+        date_of_transfer, and the last update applied to each year.
+    :return: DataFrame indexed by year
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT year, row_count, max_date_of_transfer, last_update_id, source, updated_at FROM prices_coordinates_watermarks ORDER BY year")
+        rows = cur.fetchall()
+    return pd.DataFrame(list(rows), columns=["year", "row_count", "max_date_of_transfer", "last_update_id", "source", "updated_at"]).set_index("year")
+
+def _stream_join_to_csv(conn, start_date, end_date, csv_file_path, chunk_size, join_query=HOUSING_JOIN_QUERY):
+    rows = 0
+    cur = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cur.execute(join_query, (start_date, end_date))
+        with open(csv_file_path, 'w', newline='') as csvfile:
+            csv_writer = csv.writer(csvfile, lineterminator='\n')
+            while True:
+                chunk = cur.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                csv_writer.writerows(chunk)
+                rows += len(chunk)
+                metrics.count("housing_upload_join_data.fetched_rows", len(chunk))
+    finally:
+        cur.close()
+    return rows
+
+def housing_upload_join_data(conn, year, mode="server", chunk_size=100000, partitioned=None):
+    """ Join pp_data with postcode_data for one year and replace that year of
+        prices_coordinates_data with the result, so re-running a year does not
+        duplicate it. On a year-partitioned table (see
+        create_prices_coordinates_table) the year is built in a staging table
+        and swapped in with EXCHANGE PARTITION; otherwise the old rows are
+        deleted and the new ones inserted in a single transaction. The year's
+        watermark is updated afterwards. Tables without a
+        transaction_unique_identifier column are loaded without it.
+        Without an index on date_of_transfer the DELETE scans the whole
+        table, and under InnoDB's REPEATABLE READ it locks every row and gap
+        it scans until the commit, blocking loads of other years.
+    :param conn: Connection object
+    :param year: year to join
+    :param mode: "server" runs one INSERT ... SELECT on the server, "stream"
+        streams the join through an unbuffered cursor into a temporary csv
+        which is then loaded with LOAD DATA LOCAL INFILE
+    :param chunk_size: rows fetched per round trip in "stream" mode
+    :param partitioned: whether to swap partitions, looked up when None
+    :return: dict with the year, rows, partition swapped, seconds, rows per second and peak RSS
+    """
     start_date = str(year) + "-01-01"
     end_date = str(year) + "-12-31"
+    start = time.time()
+
+    with conn.cursor() as cur:
+        for statement in WATERMARK_TABLES:
+            cur.execute(statement)
+    columns, join_query = prices_coordinates_layout(conn)
+    partition = year_partition(conn, year) if partitioned or partitioned is None else None
+    target = "prices_coordinates_data"
+    if partition is not None:
+        target = f"prices_coordinates_data_stage_{year}"
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {target}")
+            cur.execute(f"CREATE TABLE {target} LIKE prices_coordinates_data")
+            cur.execute(f"ALTER TABLE {target} REMOVE PARTITIONING")
+
+    with metrics.span("housing_upload_join_data", year=year, mode=mode, partition=partition) as span:
+        conn.begin()
+        try:
+            if partition is None:
+                with metrics.span("housing_upload_join_data.delete", year=year) as stage, conn.cursor() as cur:
+                    stage.add(rows=cur.execute("DELETE FROM prices_coordinates_data WHERE date_of_transfer BETWEEN %s AND %s", (start_date, end_date)))
+            if mode == "server":
+                print('Joining data for year: ' + str(year))
+                with metrics.span("housing_upload_join_data.insert_select", year=year) as stage, conn.cursor() as cur:
+                    rows = cur.execute(f"INSERT INTO {target} ({columns}) " + join_query, (start_date, end_date))
+                    stage.add(rows=rows)
+            elif mode == "stream":
+                print('Selecting data for year: ' + str(year))
+                fd, csv_file_path = tempfile.mkstemp(prefix=f"pp-join-{year}-", suffix=".csv")
+                os.close(fd)
+                try:
+                    with metrics.span("housing_upload_join_data.select", year=year) as stage:
+                        stage.add(rows=_stream_join_to_csv(conn, start_date, end_date, csv_file_path, chunk_size, join_query), bytes=os.path.getsize(csv_file_path))
+                    print('Storing data for year: ' + str(year))
+                    with metrics.span("housing_upload_join_data.load", year=year) as stage, conn.cursor() as cur:
+                        rows = cur.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE `{target}` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '\"' LINES STARTING BY '' TERMINATED BY '\\n' ({columns});", (csv_file_path,))
+                        stage.add(rows=rows)
+                finally:
+                    os.remove(csv_file_path)
+            else:
+                raise ValueError(f"Unknown mode: {mode}")
+            with metrics.span("housing_upload_join_data.commit", year=year), conn.cursor() as cur:
+                if partition is None:
+                    _write_watermark(cur, year, None, f"reload ({mode})")
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            if partition is not None:
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {target}")
+            raise
+        if partition is not None:
+            print('Swapping partition for year: ' + str(year))
+            with metrics.span("housing_upload_join_data.swap", year=year), conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE prices_coordinates_data EXCHANGE PARTITION {partition} WITH TABLE {target}")
+                cur.execute(f"DROP TABLE {target}")
+                _write_watermark(cur, year, None, f"reload ({mode})")
+                conn.commit()
+        span.add(rows=rows)
+
+    seconds = time.time() - start
+    stats = {"year": year, "rows": rows, "partition": partition, "seconds": seconds, "rows_per_second": rows / seconds if seconds else 0.0, "peak_rss_mb": peak_rss_mb()}
+    print(f"Data stored for year: {year} ({rows} rows, {stats['rows_per_second']:.0f} rows/s, peak RSS {stats['peak_rss_mb']:.0f} MB)")
+    return stats
+
+def housing_upload_join_data_years(user, password, host, database, years, mode="server", max_workers=4, port=3306):
+    """ Run housing_upload_join_data for several years concurrently, each
+        year on its own connection and in its own transaction. Missing year
+        partitions are added first, from a single connection. An unpartitioned
+        table without an index on date_of_transfer (created before
+        create_prices_coordinates_table) is loaded one year at a time, since
+        each year's DELETE would lock the whole table and the other years
+        would wait on it until they time out. Adding the index, e.g.
+        CREATE INDEX idx_prices_coordinates_date ON prices_coordinates_data (date_of_transfer),
+        limits the locks to the year's range and its neighbouring gaps.
+    :return: list of stats dicts, one per year
+    """
+    conn = connect(user, password, host, database, port)
+    try:
+        partitioned = bool(_table_partitions(conn))
+        if partitioned:
+            for year in sorted(years):
+                year_partition(conn, year)
+        elif max_workers > 1 and not _has_date_index(conn):
+            print("prices_coordinates_data has no index on date_of_transfer; loading one year at a time")
+            max_workers = 1
+    finally:
+        conn.close()
+
+    def upload(year):
+        conn = connect(user, password, host, database, port)
+        try:
+            return housing_upload_join_data(conn, year, mode=mode, partitioned=partitioned)
+        finally:
+            conn.close()
 
-    cur = conn.cursor()
-    print('Selecting data for year: ' + str(year))
-    cur.execute(f'SELECT pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude FROM (SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county FROM pp_data WHERE date_of_transfer BETWEEN "' + start_date + '" AND "' + end_date + '") AS pp INNER JOIN postcode_data AS po ON pp.postcode = po.postcode')
-    rows = cur.fetchall()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(upload, years))
 
-    csv_file_path = 'output_file.csv'
+PRICE_PAID_UPDATE_FILE = "/pp-monthly-update-new-version.csv"
+
+def download_price_paid_update(base_url=PRICE_PAID_BASE_URL, data_dir="."):
+    """ Download the monthly Land Registry update file, skipping it if it is
+        unchanged since the last download.
+    :return: download_file manifest dict
+    """
+    with get_http_session(pool_size=1) as session:
+        result = download_file(session, base_url + PRICE_PAID_UPDATE_FILE, data_dir + PRICE_PAID_UPDATE_FILE)
+    print(f"Monthly update: {result['status']}, {result['bytes']} bytes in {result['seconds']:.1f}s")
+    return result
 
-    # Write the rows to the CSV file
-    with open(csv_file_path, 'w', newline='') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        # Write the data rows
-        csv_writer.writerows(rows)
-    print('Storing data for year: ' + str(year))
-    cur.execute(f"LOAD DATA LOCAL INFILE '" + csv_file_path + "' INTO TABLE `prices_coordinates_data` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '\"' LINES STARTING BY '' TERMINATED BY '\n';")
+def apply_price_paid_update(conn, csv_path, batch_size=50000, update_id=None):
+    """ Apply a Land Registry update file (pp_data layout, no header) to pp_data
+        and prices_coordinates_data using its record_status column: A adds, C
+        changes and D deletes the record with that transaction id. Each batch
+        is staged in a temporary table, the affected transaction ids are
+        deleted from both tables and the A and C records inserted again, in
+        one transaction per batch, so re-applying a file or resuming after a
+        failure leaves the same rows. Files already recorded in pp_update_log
+        are skipped, and the watermarks of the affected years are updated.
+        prices_coordinates_data must have transaction_unique_identifier; an
+        older table has to be recreated with create_prices_coordinates_table
+        and reloaded first.
+    :param conn: Connection object
+    :param csv_path: path to the update csv
+    :param batch_size: records per batch
+    :param update_id: id recorded in pp_update_log, the file's sha256 by default
+    :return: dict with the update id, status, record counts by status, rows
+        inserted into and deleted from prices_coordinates_data, affected years and seconds
+    """
+    start = time.time()
+    if prices_coordinates_layout(conn)[0] != PRICES_COORDINATES_COLUMNS:
+        raise ValueError("prices_coordinates_data has no transaction_unique_identifier column; recreate it with create_prices_coordinates_table and reload it with housing_upload_join_data_years")
+    update_id = update_id or _file_sha256(csv_path).hexdigest()
+    with conn.cursor() as cur:
+        for statement in WATERMARK_TABLES:
+            cur.execute(statement)
+        cur.execute("SELECT update_id FROM pp_update_log WHERE update_id = %s", (update_id,))
+        if cur.fetchone() is not None:
+            print(f"Update {update_id[:12]} already applied")
+            return {"update_id": update_id, "status": "already applied"}
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS pp_updates (transaction_unique_identifier VARCHAR(38) NOT NULL PRIMARY KEY, price INT UNSIGNED, date_of_transfer DATE, postcode VARCHAR(8), property_type VARCHAR(1), new_build_flag VARCHAR(1), tenure_type VARCHAR(1), primary_addressable_object_name TINYTEXT, secondary_addressable_object_name TINYTEXT, street TINYTEXT, locality TINYTEXT, town_city TINYTEXT, district TINYTEXT, county TINYTEXT, ppd_category_type VARCHAR(2), record_status VARCHAR(2))")
+
+    counts = {"A": 0, "C": 0, "D": 0}
+    stats = {"update_id": update_id, "status": "applied", "inserted": 0, "deleted": 0, "years": set()}
+    pp_columns = ", ".join(PP_DATA_COLUMNS)
+    joined_columns = "u.transaction_unique_identifier, u.price, u.date_of_transfer, po.postcode, u.property_type, u.new_build_flag, u.tenure_type, u.locality, u.town_city, u.district, u.county, po.country, po.latitude, po.longitude"
+    for batch in pd.read_csv(csv_path, header=None, names=PP_DATA_COLUMNS, dtype=str, keep_default_na=False, chunksize=batch_size):
+        # The last record for a transaction id wins
+        batch = batch.drop_duplicates("transaction_unique_identifier", keep="last")
+        batch["date_of_transfer"] = batch["date_of_transfer"].str[:10]
+        status_counts = batch["record_status"].value_counts()
+        for status in counts:
+            counts[status] += int(status_counts.get(status, 0))
+        stats["years"].update(int(year) for year in batch.loc[batch["record_status"] != "D", "date_of_transfer"].str[:4].unique())
+
+        with metrics.span("apply_price_paid_update.batch", update_id=update_id[:12]) as span:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM pp_updates")
+                    cur.executemany(f"INSERT INTO pp_updates ({pp_columns}) VALUES ({', '.join(['%s'] * len(PP_DATA_COLUMNS))})", batch.itertuples(index=False, name=None))
+                    cur.execute("SELECT DISTINCT YEAR(pcd.date_of_transfer) FROM prices_coordinates_data AS pcd INNER JOIN pp_updates AS u ON pcd.transaction_unique_identifier = u.transaction_unique_identifier")
+                    stats["years"].update(row[0] for row in cur.fetchall())
+                    deleted = cur.execute("DELETE pcd FROM prices_coordinates_data AS pcd INNER JOIN pp_updates AS u ON pcd.transaction_unique_identifier = u.transaction_unique_identifier")
+                    cur.execute("DELETE pp FROM pp_data AS pp INNER JOIN pp_updates AS u ON pp.transaction_unique_identifier = u.transaction_unique_identifier")
+                    cur.execute(f"INSERT INTO pp_data ({pp_columns}) SELECT {pp_columns} FROM pp_updates WHERE record_status IN ('A', 'C')")
+                    inserted = cur.execute(f"INSERT INTO prices_coordinates_data ({PRICES_COORDINATES_COLUMNS}) SELECT {joined_columns} FROM pp_updates AS u INNER JOIN postcode_data AS po ON u.postcode = po.postcode WHERE u.record_status IN ('A', 'C')")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            span.add(rows=len(batch), inserted=inserted, deleted=deleted)
+        stats["inserted"] += inserted
+        stats["deleted"] += deleted
+        print(f"Update batch: {len(batch)} records, {inserted} rows inserted, {deleted} rows deleted")
+
+    with conn.cursor() as cur:
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS pp_updates")
+        for year in sorted(stats["years"]):
+            _write_watermark(cur, year, update_id, os.path.basename(csv_path))
+        cur.execute("INSERT INTO pp_update_log (update_id, source, added, changed, deleted, applied_at) VALUES (%s, %s, %s, %s, %s, %s)",
+                    (update_id, os.path.basename(csv_path), counts["A"], counts["C"], counts["D"], time.strftime("%Y-%m-%d %H:%M:%S")))
     conn.commit()
-    print('Data stored for year: ' + str(year))
+    stats.update({"added": counts["A"], "changed": counts["C"], "removed": counts["D"], "years": sorted(stats["years"]), "seconds": time.time() - start})
+    print(f"Update {update_id[:12]} applied: {counts['A']} added, {counts['C']} changed, {counts['D']} deleted, years {stats['years']}")
+    return stats
+
+def update_prices_coordinates(conn, base_url=PRICE_PAID_BASE_URL, data_dir=".", batch_size=50000):
+    """ Download the monthly update file and apply it with apply_price_paid_update.
+    :return: the apply_price_paid_update stats
+    """
+    result = download_price_paid_update(base_url, data_dir)
+    if not result["status"] or result["status"].startswith("missing"):
+        raise RuntimeError(f"Monthly update not available: {result['status']}")
+    return apply_price_paid_update(conn, result["path"], batch_size)
 
 class TestError(Exception):
     def __init__(self):
         super().__init__()
 
-class OSMHandler(osmium.SimpleHandler):
+OSM_ELEMENT_TYPES = ["node", "way", "relation"]
+
+class OSMColumnBuffer:
+    """ Typed, array-backed column buffer for tagged OSM elements. Tag keys and
+        values are dictionary encoded per batch and stored one row per tag,
+        with tag_offsets marking where each element's tags start.
+    """
     def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = array('q')
+        self.types = array('b')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.tag_offsets = array('q', [0])
+        self.tag_keys = array('i')
+        self.tag_values = array('i')
+        self.key_codes = {}
+        self.value_codes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, element_type, osm_id, lat, lon, tags):
+        self.ids.append(osm_id)
+        self.types.append(element_type)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        key_codes = self.key_codes
+        value_codes = self.value_codes
+        for tag in tags:
+            self.tag_keys.append(key_codes.setdefault(tag.k, len(key_codes)))
+            self.tag_values.append(value_codes.setdefault(tag.v, len(value_codes)))
+        self.tag_offsets.append(len(self.tag_keys))
+
+    def to_frames(self, with_json_tags=True):
+        """ Convert the buffer into an elements frame and a normalized tags frame.
+        :param with_json_tags: also add the tags of each element as a json string
+        :return: (elements_df, tags_df)
+        """
+        ids = np.frombuffer(self.ids, dtype=np.int64) if len(self.ids) else np.empty(0, dtype=np.int64)
+        counts = np.diff(np.frombuffer(self.tag_offsets, dtype=np.int64))
+        keys = pd.Categorical.from_codes(np.asarray(self.tag_keys, dtype=np.int32), categories=list(self.key_codes))
+        values = pd.Categorical.from_codes(np.asarray(self.tag_values, dtype=np.int32), categories=pd.Index(list(self.value_codes), dtype=object))
+        elements_df = pd.DataFrame({
+            "id": ids,
+            "type": pd.Categorical.from_codes(np.asarray(self.types, dtype=np.int8), categories=OSM_ELEMENT_TYPES),
+            "latitude": np.asarray(self.lats, dtype=np.float64),
+            "longitude": np.asarray(self.lons, dtype=np.float64),
+        })
+        tags_df = pd.DataFrame({
+            "id": np.repeat(ids, counts),
+            "type": np.repeat(elements_df["type"].to_numpy(), counts),
+            "tag_key": keys,
+            "tag_value": values,
+        })
+        if with_json_tags:
+            key_list = list(self.key_codes)
+            value_list = list(self.value_codes)
+            offsets = self.tag_offsets
+            tag_keys = self.tag_keys
+            tag_values = self.tag_values
+            elements_df["tags"] = [
+                json.dumps({key_list[tag_keys[i]]: value_list[tag_values[i]] for i in range(offsets[n], offsets[n + 1])})
+                for n in range(len(ids))
+            ]
+        return elements_df, tags_df
+
+class OSMHandlerMixin:
+    """ Streaming handler that keeps only tagged elements in an OSMColumnBuffer
+        and passes them to sink(elements_df, tags_df) every batch_size elements.
+        Ways are placed at the mean of their node locations when the file is
+        applied with locations=True; relations have no location.
+    """
+    def __init__(self, sink, batch_size=500_000, element_types=("node", "way", "relation"), with_json_tags=True):
         super().__init__()
-        self.nodes = []
+        self.sink = sink
+        self.batch_size = batch_size
+        self.element_types = set(element_types)
+        self.with_json_tags = with_json_tags
+        self.buffer = OSMColumnBuffer()
+        self.batches = 0
+        self.elements = 0
 
+    def _append(self, element_type, osm_id, lat, lon, tags):
+        self.buffer.append(element_type, osm_id, lat, lon, tags)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        elements_df, tags_df = self.buffer.to_frames(self.with_json_tags)
+        self.elements += len(elements_df)
+        self.batches += 1
+        self.buffer.clear()
+        with metrics.span("osm.sink", batch=self.batches) as span:
+            span.add(rows=len(elements_df), tag_rows=len(tags_df))
+            self.sink(elements_df, tags_df)
 
     def node(self, n):
-        self.nodes.append([n.id, n.location.lat, n.location.lon, dict(n.tags)])
+        if len(n.tags) == 0 or "node" not in self.element_types:
+            return
+        self._append(0, n.id, n.location.lat, n.location.lon, n.tags)
+
+    def way(self, w):
+        if len(w.tags) == 0 or "way" not in self.element_types:
+            return
+        lats = [node.location.lat for node in w.nodes if node.location.valid()]
+        lons = [node.location.lon for node in w.nodes if node.location.valid()]
+        if lats:
+            self._append(1, w.id, sum(lats) / len(lats), sum(lons) / len(lons), w.tags)
+        else:
+            self._append(1, w.id, np.nan, np.nan, w.tags)
+
+    def relation(self, r):
+        if len(r.tags) == 0 or "relation" not in self.element_types:
+            return
+        self._append(2, r.id, np.nan, np.nan, r.tags)
+
+@functools.lru_cache(maxsize=None)
+def _osm_handler_class():
+    # osmium is only imported when a handler is first needed
+    return type("OSMHandler", (OSMHandlerMixin, osmium.SimpleHandler), {})
+
+def __getattr__(name):
+    if name == "OSMHandler":
+        return _osm_handler_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def ingest_osm(pbf_path, sink, batch_size=500_000, element_types=("node",), with_json_tags=True):
+    """ Stream the tagged elements of an OSM PBF file to sink in bounded batches.
+    :param pbf_path: path to the .osm.pbf file
+    :param sink: callable taking (elements_df, tags_df) for each batch
+    :param batch_size: number of elements per batch
+    :param element_types: any of "node", "way" and "relation"
+    :param with_json_tags: include a json tags column in elements_df
+    :return: the handler, with counts of batches and elements
+    """
+    handler = _osm_handler_class()(sink, batch_size, element_types, with_json_tags)
+    with metrics.span("ingest_osm", pbf_path=pbf_path) as span:
+        handler.apply_file(pbf_path, locations="way" in element_types)
+        handler.flush()
+        span.add(rows=handler.elements, bytes=os.path.getsize(pbf_path), batches=handler.batches)
+    return handler
+
+def osm_parquet_sink(directory):
+    """ Sink writing each batch to <directory>/elements-<n>.parquet and tags-<n>.parquet. """
+    os.makedirs(directory, exist_ok=True)
+    batch = [0]
+
+    def sink(elements_df, tags_df):
+        elements_df.to_parquet(os.path.join(directory, f"elements-{batch[0]:05d}.parquet"), index=False)
+        tags_df.to_parquet(os.path.join(directory, f"tags-{batch[0]:05d}.parquet"), index=False)
+        batch[0] += 1
+    return sink
+
+def osm_sql_sink(conn, elements_table="osm_england_nodes", tags_table=None):
+    """ Sink writing each batch to the database, replacing the tables on the first batch. """
+    if_exists = ["replace"]
+
+    def sink(elements_df, tags_df):
+        elements_df.to_sql(name=elements_table, con=conn, if_exists=if_exists[0], index=False, dtype={"type": sqlalchemy.String(8)})
+        if tags_table is not None:
+            # OSM limits tag keys and values to 255 characters
+            tags_df.to_sql(name=tags_table, con=conn, if_exists=if_exists[0], index=False, dtype={"type": sqlalchemy.String(8), "tag_key": sqlalchemy.String(255), "tag_value": sqlalchemy.String(255)})
+        if_exists[0] = "append"
+    return sink
+
+def full_england_osm_to_df(pbf_path="england-latest.osm.pbf", element_types=("node",), batch_size=500_000):
+    batches = []
+    ingest_osm(pbf_path, lambda elements_df, tags_df: batches.append(elements_df), batch_size, element_types)
+    if not batches:
+        return pd.DataFrame(columns=["id", "type", "latitude", "longitude", "tags"])
+    return pd.concat(batches, ignore_index=True)
+
+def create_osm_indexes(conn, elements_table="osm_england_nodes", tags_table="osm_england_tags"):
+    """ Index the OSM elements by id and location, and the normalized tags by
+        (tag_key, tag_value, id) so tag filters do not scan the json column.
+    """
+    conn.execute(sqlalchemy.text(f"CREATE INDEX idx_{elements_table}_id ON {elements_table} (id)"))
+    conn.execute(sqlalchemy.text(f"CREATE INDEX idx_{elements_table}_lat_lon ON {elements_table} (latitude, longitude)"))
+    conn.execute(sqlalchemy.text(f"CREATE INDEX idx_{tags_table}_key_value ON {tags_table} (tag_key, tag_value, id)"))
+
+def create_spatial_indexes(conn):
+    """ Index postcode_data on (latitude, longitude) and pp_data on
+        (postcode, date_of_transfer) for the assess location queries.
+    :param conn: Connection object
+    """
+    with conn.cursor() as cur:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_postcode_data_lat_long ON postcode_data (latitude, longitude)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_postcode_data_postcode ON postcode_data (postcode)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pp_data_postcode_date ON pp_data (postcode, date_of_transfer)")
+    conn.commit()
+
+def upload_full_england_osm(username, password, url, pbf_path="england-latest.osm.pbf", batch_size=500_000):
+    with metrics.span("upload_full_england_osm"), engine_connection(get_engine(username, password, url)) as conn:
+        ingest_osm(pbf_path, osm_sql_sink(conn, "osm_england_nodes", "osm_england_tags"), batch_size)
+        with metrics.span("create_osm_indexes"):
+            create_osm_indexes(conn)
+        conn.commit()
+
+def benchmark_osm_ingest(pbf_path, batch_size=100_000):
+    """ Compare the time and peak Python memory of the old list-of-lists node
+        load with the streaming columnar ingest on a (small) PBF file.
+    :return: dict of {"list_of_lists": {...}, "streaming": {...}} with seconds, peak_mb and rows
+    """
+    import tracemalloc
+
+    class ListOfListsHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.nodes = []
+
+        def node(self, n):
+            self.nodes.append([n.id, n.location.lat, n.location.lon, dict(n.tags)])
+
+    def list_of_lists():
+        handler = ListOfListsHandler()
+        handler.apply_file(pbf_path)
+        nodes_df = pd.DataFrame(handler.nodes, columns=["id", "latitude", "longitude", "tags"])
+        nodes_df = nodes_df[nodes_df['tags'] != {}].reset_index()
+        nodes_df['tags'] = nodes_df['tags'].apply(lambda x: json.dumps(x))
+        return len(nodes_df)
+
+    def streaming():
+        rows = [0]
+
+        def sink(elements_df, tags_df):
+            rows[0] += len(elements_df)
+        ingest_osm(pbf_path, sink, batch_size)
+        return rows[0]
+
+    results = {}
+    for name, run in [("list_of_lists", list_of_lists), ("streaming", streaming)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        rows = run()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {"seconds": seconds, "peak_mb": peak / 2**20, "rows": rows}
+    return results
+
+
+class OSMCacheMiss(Exception):
+    """ Raised by an offline OSMCache when a query is not in the cache. """
+
+def bbox_from_point(latitude, longitude, dist):
+    # Same approximation osmnx uses for its point queries; works element-wise on arrays
+    delta_lat = (dist / 6_371_009) / np.pi * 180
+    delta_lon = delta_lat / np.cos(np.radians(latitude))
+    return latitude + delta_lat, latitude - delta_lat, longitude + delta_lon, longitude - delta_lon
+
+def _tags_cover(cached_tags, tags):
+    """ Whether a query with cached_tags returns every feature a query with tags would. """
+    for key, value in tags.items():
+        if key not in cached_tags:
+            return False
+        cached_value = cached_tags[key]
+        if cached_value is True:
+            continue
+        if value is True:
+            return False
+        cached_values = {cached_value} if isinstance(cached_value, str) else set(cached_value)
+        values = {value} if isinstance(value, str) else set(value)
+        if not values <= cached_values:
+            return False
+    return True
+
+def filter_tags(gdf, tags):
+    """ The rows of an OSM features frame matching a tags query the way osmnx
+        matches it: any key whose value is True, or one of the listed values.
+    :param gdf: features frame with one column per tag key
+    :param tags: osmnx tags dict, e.g. {"amenity": ["cafe", "pub"], "shop": True}
+    :return: the matching rows
+    """
+    mask = pd.Series(False, index=gdf.index)
+    for key, value in tags.items():
+        if key not in gdf.columns:
+            continue
+        if value is True:
+            mask |= gdf[key].notna()
+        else:
+            mask |= gdf[key].isin([value] if isinstance(value, str) else list(value))
+    return gdf[mask]
+
+class OSMCache:
+    """ Content-addressed on-disk cache for osmnx queries.
 
+        Features are stored as GeoParquet, graphs as GraphML, keyed by a hash
+        of the query. A features query is answered from any cached bbox that
+        contains it with tags that cover it, filtered locally. When a miss
+        overlaps a cached bbox with the same tags, their union is fetched
+        instead, up to max_union_ratio times the requested area. Entries
+        older than ttl_seconds are refetched, and the least recently used
+        entries are evicted once the cache is over max_bytes. In offline mode
+        a miss raises OSMCacheMiss and expired entries are still served.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None, ttl_seconds=None, offline=None, max_union_ratio=4.0):
+        self.cache_dir = cache_dir or config.get("osm_cache_dir", "osm_cache")
+        self.max_bytes = max_bytes if max_bytes is not None else config.get("osm_cache_max_mb", 1024) * 2**20
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else config.get("osm_cache_ttl_days", 30) * 86400
+        self.offline = offline if offline is not None else config.get("osm_offline", False)
+        self.max_union_ratio = max_union_ratio
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = _read_json(self.index_path)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, kind, query):
+        return hashlib.sha1(json.dumps([kind, query], sort_keys=True).encode()).hexdigest()
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, self.index_path)
+
+    def _expired(self, entry):
+        return not self.offline and time.time() - entry["created"] > self.ttl_seconds
+
+    def _remove(self, key):
+        entry = self.index.pop(key)
+        path = os.path.join(self.cache_dir, entry["file"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _touch(self, key):
+        self.hits += 1
+        self.index[key]["accessed"] = time.time()
+        self._save_index()
+        return os.path.join(self.cache_dir, self.index[key]["file"])
+
+    def _store(self, key, kind, query, file_name, write):
+        path = os.path.join(self.cache_dir, file_name)
+        write(path)
+        now = time.time()
+        self.index[key] = {"kind": kind, "query": query, "file": file_name, "bytes": os.path.getsize(path), "created": now, "accessed": now}
+        self._evict(keep=key)
+        self._save_index()
+        return path
+
+    def _evict(self, keep=None):
+        """ Remove least recently used entries until the cache fits, never the entry keep. """
+        total = sum(entry["bytes"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]["accessed"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index[key]["bytes"]
+            self._remove(key)
+        if keep is not None and total > self.max_bytes:
+            print(f"OSM cache entry {keep} ({self.index[keep]['bytes']} bytes) alone exceeds the {self.max_bytes} byte cache limit; keeping it")
+
+    def _miss(self, description):
+        self.misses += 1
+        if self.offline:
+            raise OSMCacheMiss(f"{description} is not cached and the OSM cache is offline")
+
+    def features_from_bbox(self, north, south, east, west, tags):
+        """ Cached ox.geometries_from_bbox. """
+        requested = shapely.box(west, south, east, north)
+        # Entries replaced by this fetch are only dropped once it is stored,
+        # so a failed fetch leaves the cache and its index as they were
+        replaced = []
+        for key, entry in list(self.index.items()):
+            if entry["kind"] != "features":
+                continue
+            if self._expired(entry):
+                replaced.append(key)
+                continue
+            query = entry["query"]
+            if shapely.box(query["west"], query["south"], query["east"], query["north"]).contains(requested) and _tags_cover(query["tags"], tags):
+                pois = gpd.read_parquet(self._touch(key))
+                pois = pois[pois.intersects(requested)]
+                return pois if query["tags"] == tags else filter_tags(pois, tags)
+
+        self._miss(f"Features for bbox {(north, south, east, west)}")
+        fetch_bbox = shapely.box(west, south, east, north)
+        for key, entry in list(self.index.items()):
+            query = entry["query"]
+            if entry["kind"] == "features" and query["tags"] == tags and key not in replaced:
+                cached = shapely.box(query["west"], query["south"], query["east"], query["north"])
+                union = shapely.box(*fetch_bbox.union(cached).bounds)
+                if cached.intersects(requested) and union.area <= self.max_union_ratio * requested.area:
+                    fetch_bbox = union
+                    replaced.append(key)
+        west_, south_, east_, north_ = fetch_bbox.bounds
+        pois = ox.geometries_from_bbox(north_, south_, east_, west_, tags)
+        query = {"north": north_, "south": south_, "east": east_, "west": west_, "tags": tags}
+        key = self._key("features", query)
+        self._store(key, "features", query, key + ".parquet", pois.to_parquet)
+        for old_key in replaced:
+            if old_key != key and old_key in self.index:
+                self._remove(old_key)
+        if replaced:
+            self._save_index()
+        return pois[pois.intersects(requested)]
+
+    def features_from_point(self, point, tags, dist=1000):
+        """ Cached ox.geometries_from_point, served through the bbox cache. """
+        north, south, east, west = bbox_from_point(point[0], point[1], dist)
+        return self.features_from_bbox(north, south, east, west, tags)
+
+    def graph_from_bbox(self, north, south, east, west, **kwargs):
+        """ Cached ox.graph_from_bbox. """
+        query = {"north": north, "south": south, "east": east, "west": west, **kwargs}
+        key = self._key("graph", query)
+        if key in self.index and not self._expired(self.index[key]):
+            return ox.load_graphml(self._touch(key))
+        self._miss(f"Graph for bbox {(north, south, east, west)}")
+        graph = ox.graph_from_bbox(north, south, east, west, **kwargs)
+        self._store(key, "graph", query, key + ".graphml", lambda path: ox.save_graphml(graph, path))
+        return graph
+
+    def geocode_to_gdf(self, place_name):
+        """ Cached ox.geocode_to_gdf. """
+        key = self._key("geocode", place_name)
+        if key in self.index and not self._expired(self.index[key]):
+            return gpd.read_parquet(self._touch(key))
+        self._miss(f"Geocode for {place_name}")
+        area = ox.geocode_to_gdf(place_name)
+        self._store(key, "geocode", place_name, key + ".parquet", area.to_parquet)
+        return area
+
+_osm_cache = None
+
+def get_osm_cache():
+    """ The shared OSMCache configured from the config file. """
+    global _osm_cache
+    if _osm_cache is None:
+        _osm_cache = OSMCache()
+    return _osm_cache
+
+
+class LocalStore:
+    """ Local snapshot of database tables as Parquet, partitioned by year (when
+        the table has a date column) and postcode area, e.g.
+        <root>/pp_data/year=2020/area=CB/part-0.parquet. Rows without a date
+        go to year=__HIVE_DEFAULT_PARTITION__, which reads back as a null year.
+
+        refresh() compares a per-partition row count and checksum computed on
+        the server with the ones stored in <root>/<table>/_manifest.json and
+        only downloads partitions that changed. read() memory-maps the files
+        and reads only the requested columns and partitions.
+    """
+    def __init__(self, root=None):
+        self.root = root or config.get("local_store_dir", "local_store")
+
+    def _table_dir(self, table):
+        return os.path.join(self.root, table)
+
+    def _manifest(self, table):
+        return _read_json(os.path.join(self._table_dir(table), "_manifest.json"))
+
+    def _save_manifest(self, table, manifest):
+        path = os.path.join(self._table_dir(table), "_manifest.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+        os.replace(path + ".tmp", path)
+
+    # pyarrow's hive partitioning reads this value back as null
+    null_year = "__HIVE_DEFAULT_PARTITION__"
+
+    @classmethod
+    def _partition_name(cls, year, area, dated):
+        if not dated:
+            return f"area={area}"
+        return f"year={cls.null_year if pd.isna(year) else int(year)}/area={area}"
+
+    def fingerprints(self, table, conn, date_column=None, postcode_column="postcode"):
+        """ Row count and checksum of every (year, area) partition, computed on the server. """
+        columns = pd.read_sql_query(f"SELECT * FROM {table} LIMIT 0", conn).columns
+        year_expr = f"YEAR({date_column})" if date_column else "NULL"
+        query = (f"SELECT {year_expr} AS year, REGEXP_SUBSTR({postcode_column}, '^[A-Z]+') AS area, COUNT(*) AS n, "
+                 f"BIT_XOR(CRC32(CONCAT_WS('|', {', '.join(columns)}))) AS checksum FROM {table} GROUP BY year, area")
+        fingerprints_df = pd.read_sql_query(query, conn)
+        return {
+            self._partition_name(row.year, row.area or "", bool(date_column)): [int(row.n), int(row.checksum)]
+            for row in fingerprints_df.itertuples()
+        }
+
+    def write_partitions(self, table, df, date_column=None, postcode_column="postcode", partitions=None):
+        """ Write df split into (year, area) partitions, replacing those partitions.
+        :param partitions: if given, only these partition names are written
+        :return: list of partition names written
+        """
+        keys = pd.DataFrame({"area": df[postcode_column].str.extract(r"^([A-Z]+)", expand=False).fillna("")})
+        if date_column:
+            keys["year"] = pd.to_datetime(df[date_column]).dt.year
+        written = []
+        # Keep rows whose date is missing, as fingerprints counts them
+        for key, part_df in df.groupby([keys[c] for c in keys.columns], sort=False, dropna=False):
+            area, year = (key[0], key[1]) if date_column else (key[0], None)
+            name = self._partition_name(year, area, bool(date_column))
+            if partitions is not None and name not in partitions:
+                continue
+            directory = os.path.join(self._table_dir(table), name)
+            os.makedirs(directory, exist_ok=True)
+            part_df.to_parquet(os.path.join(directory, "part-0.parquet"), index=False)
+            written.append(name)
+        return written
+
+    def _remove_partition(self, table, name):
+        path = os.path.join(self._table_dir(table), name, "part-0.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _changed_rows_query(table, date_column, postcode_column, year, areas):
+        """ Query for the rows of one year partition value (or the whole table) in the given postcode areas. """
+        conditions, params = [], {}
+        if year == LocalStore.null_year:
+            conditions.append(f"{date_column} IS NULL")
+        elif year is not None:
+            conditions.append(f"{date_column} BETWEEN :start AND :end")
+            params.update(start=f"{year}-01-01", end=f"{year}-12-31")
+        # Rows without a postcode area can only be found by reading everything
+        if "" not in areas:
+            likes = []
+            for n, area in enumerate(sorted(areas)):
+                likes.append(f"{postcode_column} LIKE :area_{n}")
+                params[f"area_{n}"] = area + "%"
+            conditions.append("(" + " OR ".join(likes) + ")")
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return sqlalchemy.text(f"SELECT * FROM {table}{where}"), params
 
-def full_england_osm_to_df():
-    handler = OSMHandler()
-    handler.apply_file("england-latest.osm.pbf")
-    nodes_df = pd.DataFrame(handler.nodes, columns=["id", "latitude", "longitude", "tags"])
+    def refresh(self, table, conn, date_column=None, postcode_column="postcode"):
+        """ Bring the snapshot of table up to date, downloading only changed partitions.
+            Changed partitions are fetched one year at a time, selecting the
+            year's rows whose postcode starts with a changed area; rows from
+            other areas sharing that prefix (e.g. CB for C) are read but not
+            written.
+        :param conn: SQLAlchemy connection, e.g. from engine_connection
+        :return: list of partition names that were rewritten or removed
+        """
+        os.makedirs(self._table_dir(table), exist_ok=True)
+        manifest = self._manifest(table)
+        current = self.fingerprints(table, conn, date_column, postcode_column)
+        changed = {name for name, fingerprint in current.items() if manifest.get(name) != fingerprint}
+        removed = set(manifest) - set(current)
+        for name in removed:
+            self._remove_partition(table, name)
+        changed_areas = {}
+        for name in changed:
+            *year, area = name.split("/")
+            changed_areas.setdefault(year[0][len("year="):] if year else None, set()).add(area[len("area="):])
+        for year, areas in sorted(changed_areas.items(), key=lambda item: item[0] or ""):
+            print(f"Refreshing {table}" + (f" for year: {year}" if year is not None else ""))
+            query, params = self._changed_rows_query(table, date_column, postcode_column, year, areas)
+            changed_df = pd.read_sql_query(query, conn, params=params)
+            self.write_partitions(table, changed_df, date_column, postcode_column, changed)
+        self._save_manifest(table, current)
+        return sorted(changed | removed)
 
-    # filter out points without tags
-    nodes_df = nodes_df[nodes_df['tags'] != {}].reset_index()
+    def dataset(self, table):
+        """ pyarrow dataset over the memory-mapped snapshot of table. """
+        return ds.dataset(self._table_dir(table), format="parquet", partitioning="hive", filesystem=fs.LocalFileSystem(use_mmap=True))
 
-    nodes_df['tags'] = nodes_df['tags'].apply(lambda x: json.dumps(x))
-    return nodes_df
+    def read(self, table, columns=None, years=None, areas=None, filter=None):
+        """ Read a snapshot with column projection and predicate pushdown.
+        :param columns: columns to load, all if None
+        :param years: (first, last) years to load, inclusive
+        :param areas: postcode areas to load, e.g. ["CB", "SW"]
+        :param filter: extra pyarrow.dataset expression, e.g. ds.field("price") > 500000
+        :return: DataFrame, without the year and area partition columns unless they are requested
+        """
+        dataset = self.dataset(table)
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name not in ("year", "area")]
+        expression = filter
+        if years is not None:
+            in_years = (ds.field("year") >= years[0]) & (ds.field("year") <= years[1])
+            expression = in_years if expression is None else expression & in_years
+        if areas is not None:
+            in_areas = ds.field("area").isin(list(areas))
+            expression = in_areas if expression is None else expression & in_areas
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
 
-def upload_full_england_osm(username, password, url):
-    node_df = full_england_osm_to_df()
-    engine = create_engine(f"mysql+pymysql://{username}:{password}@{url}/{'ads_2024'}")
-    node_df.to_sql(name='osm_england_nodes', con=engine, if_exists='replace')
+
+def census_csv_path(code, level, data_dir=None):
+    """ Path of a Census 2021 table csv, e.g. census_csv_path("ts062", "lsoa"). """
+    if data_dir is None:
+        # A relative census_data_dir is relative to the repository, not the working directory
+        data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), config.get("census_data_dir", "_notebooks"))
+    return os.path.join(data_dir, f"census2021-{code}", f"census2021-{code}-{level}.csv")
+
+def _short_census_columns(columns):
+    # Value columns look like "<Title>: <category>[; measures: Value]", keep just the category
+    short = {}
+    for column in columns:
+        name = column.replace("; measures: Value", "")
+        if ": " in name:
+            name = name.split(": ", 1)[1]
+        if name.startswith("Total"):
+            name = "Total"
+        short[column] = name
+    return short
+
+def load_census(code, level="msoa", columns=None, data_dir=None, cache_dir=None):
+    """ Load a Census 2021 table, parsing the csv only once into a typed Parquet cache.
+        Value columns are renamed to their category (e.g. "Aged 4 years and under")
+        and stored as int32, indexed by geography code.
+    :param code: table code, e.g. "ts007" or "ts062"
+    :param level: geography level, one of ctry, rgn, utla, ltla, msoa or lsoa
+    :param columns: columns to load (short names), all if None
+    :param data_dir: directory holding the census2021-<code> folders
+    :param cache_dir: Parquet cache directory
+    :return: DataFrame indexed by geography code
+    """
+    csv_path = census_csv_path(code, level, data_dir)
+    cache_dir = cache_dir or config.get("census_cache_dir", "census_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(csv_path)
+    cache_path = os.path.join(cache_dir, f"census2021-{code}-{level}-{int(stat.st_mtime)}-{stat.st_size}.parquet")
+    if not os.path.exists(cache_path):
+        census_df = pd.read_csv(csv_path, dtype={"geography": str, "geography code": str})
+        census_df = census_df.rename(columns=_short_census_columns(census_df.columns[3:]))
+        census_df = census_df.rename(columns={"geography code": "geography_code"})
+        value_columns = census_df.columns[3:]
+        census_df[value_columns] = census_df[value_columns].astype(np.int32)
+        census_df["date"] = census_df["date"].astype(np.int16)
+        census_df.to_parquet(cache_path + ".tmp", index=False)
+        os.replace(cache_path + ".tmp", cache_path)
+    read_columns = None if columns is None else ["geography_code"] + [column for column in columns if column != "geography_code"]
+    return pd.read_parquet(cache_path, columns=read_columns).set_index("geography_code")
+
+def join_census_features(df, code, level="msoa", columns=None, area_column=None, proportions=False, prefix=None, **kwargs):
+    """ Attach census columns to each row of df by its area code.
+    :param df: frame with an area code column, e.g. postcode_data rows after attach_postcode_areas
+    :param area_column: column holding the area code, <level>21cd by default
+    :param proportions: divide each column by the table's "Total" column
+    :param prefix: prefix for the new columns, "<code>_" by default
+    :return: df with the census columns added (NaN where the area is unknown)
+    """
+    area_column = area_column or f"{level}21cd"
+    census_df = load_census(code, level, None if columns is None else list(columns) + ["Total"] if proportions else columns, **kwargs)
+    positions = census_df.index.get_indexer(df[area_column])
+    known = positions >= 0
+    prefix = f"{code}_" if prefix is None else prefix
+    features = {}
+    totals = census_df["Total"].to_numpy(dtype=np.float64) if proportions else None
+    for column in (columns if columns is not None else census_df.columns.drop(["date", "geography"])):
+        values = census_df[column].to_numpy(dtype=np.float64)
+        if proportions:
+            values = values / totals
+        feature = np.full(len(df), np.nan)
+        feature[known] = values[positions[known]]
+        features[prefix + column] = feature
+    return df.assign(**features)
+
+def attach_postcode_areas(conn, lookup_csv_path, chunk_size=500_000):
+    """ Load the ONS postcode to OA/LSOA/MSOA lookup into postcode_area_lookup and
+        copy lsoa21cd and msoa21cd onto postcode_data through an indexed join.
+    :param conn: Connection object
+    :param lookup_csv_path: ONS PCD_OA21_LSOA21_MSOA21_LAD csv
+    """
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS postcode_area_lookup")
+        cur.execute("CREATE TABLE postcode_area_lookup (postcode VARCHAR(8) NOT NULL, lsoa21cd VARCHAR(9), msoa21cd VARCHAR(9), PRIMARY KEY (postcode))")
+        fd, csv_file_path = tempfile.mkstemp(prefix="postcode-areas-", suffix=".csv")
+        os.close(fd)
+        try:
+            for chunk in pd.read_csv(lookup_csv_path, usecols=["pcds", "lsoa21cd", "msoa21cd"], dtype=str, encoding="latin-1", chunksize=chunk_size):
+                chunk.to_csv(csv_file_path, header=False, index=False, lineterminator='\n')
+                cur.execute("LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE `postcode_area_lookup` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '\"' LINES TERMINATED BY '\\n' (postcode, lsoa21cd, msoa21cd)", (csv_file_path,))
+        finally:
+            os.remove(csv_file_path)
+        for column in ["lsoa21cd", "msoa21cd"]:
+            cur.execute(f"ALTER TABLE postcode_data ADD COLUMN IF NOT EXISTS {column} VARCHAR(9)")
+        cur.execute("UPDATE postcode_data AS po INNER JOIN postcode_area_lookup AS l ON po.postcode = l.postcode SET po.lsoa21cd = l.lsoa21cd, po.msoa21cd = l.msoa21cd")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_postcode_data_lsoa ON postcode_data (lsoa21cd)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_postcode_data_msoa ON postcode_data (msoa21cd)")
+    conn.commit()
@@ -16,3 +16,260 @@ import scipy.stats"""
 
 """Address a particular question that arises from the data"""
 
+
+import functools
+import hashlib
+import inspect
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import *
+from .lazy import lazy_import
+from . import access
+from . import assess
+from . import metrics
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+spatial = lazy_import("scipy.spatial")
+
+# Cache keys cover the source of the fynesse package and of the modules
+# defining each generator's functions. Bump this when anything else the
+# features depend on changes, e.g. a dependency's behaviour or the data files.
+FEATURE_PIPELINE_VERSION = "1"
+
+class FeatureGenerator:
+    """ A named group of feature columns computed for a batch of coordinates.
+
+        build_index() builds the read-only index (e.g. a POIIndex) once per
+        run, and compute(index, lats, longs) returns a dict or DataFrame of
+        columns for those points. Both should be module level functions or
+        functools.partial of them so they can be sent to worker processes.
+    """
+    def __init__(self, name, build_index, compute, version="1"):
+        self.name = name
+        self.build_index = build_index
+        self.compute = compute
+        self.version = version
+
+    def cache_key(self, coords_key):
+        """ Key of this generator's columns for the given inputs and code version. """
+        sha = hashlib.sha1()
+        sha.update(f"{FEATURE_PIPELINE_VERSION}|{self.name}|{self.version}|{coords_key}|{_package_fingerprint()}".encode())
+        for function in [self.build_index, self.compute]:
+            sha.update(_fingerprint(function).encode())
+        return sha.hexdigest()
+
+def _fingerprint(obj):
+    if isinstance(obj, functools.partial):
+        return "|".join([_fingerprint(obj.func)] + [_fingerprint(arg) for arg in obj.args] + [f"{key}={_fingerprint(value)}" for key, value in sorted(obj.keywords.items())])
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        if isinstance(obj, pd.DataFrame) and hasattr(obj, "geometry"):
+            # Hash geometries through their WKB
+            obj = pd.DataFrame(obj.drop(columns=obj.geometry.name)).assign(geometry=obj.geometry.to_wkb(hex=True))
+        return str(int(pd.util.hash_pandas_object(obj.astype(str), index=False).sum()))
+    if isinstance(obj, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+    if callable(obj):
+        name = getattr(obj, "__qualname__", repr(obj))
+        module = inspect.getmodule(obj)
+        try:
+            # The whole module, so helpers the function calls are covered too
+            return f"{module.__name__}.{name}|{_source_fingerprint(module.__name__)}"
+        except (AttributeError, OSError, TypeError):
+            pass
+        try:
+            return inspect.getsource(obj)
+        except (OSError, TypeError):
+            return name
+    return repr(obj)
+
+@functools.lru_cache(maxsize=None)
+def _source_fingerprint(module_name):
+    return hashlib.sha1(inspect.getsource(sys.modules[module_name]).encode()).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _package_fingerprint():
+    """ Hash of every module in the fynesse package, tests excluded. """
+    sha = hashlib.sha1()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for file_name in sorted(os.listdir(package_dir)):
+        if file_name.endswith(".py"):
+            with open(os.path.join(package_dir, file_name), "rb") as file:
+                sha.update(file_name.encode() + file.read())
+    return sha.hexdigest()
+
+def _compute_poi_counts(index, lats, longs, areas=None, radius_km=None):
+    if radius_km is None:
+        counts = index.count_boxes(lats, longs, np.broadcast_to(areas, len(lats)))
+    else:
+        counts = index.count_radius(lats, longs, radius_km)
+    return pd.DataFrame(counts, columns=[f"poi_{feature}" for feature in index.features])
+
+def poi_count_features(tag_filtered_df, tags, area=0, radius_km=None):
+    """ POI counts per feature in get_boxed_pois_from_df boxes of the given area, or within radius_km. """
+    return FeatureGenerator("poi_counts", functools.partial(assess.POIIndex, tag_filtered_df, tags),
+                            functools.partial(_compute_poi_counts, areas=area, radius_km=radius_km))
+
+def _build_rail_indexes(rail_2012_geo_df, rail_2022_geo_df):
+    return assess.GeoLayerIndex(rail_2012_geo_df), assess.GeoLayerIndex(rail_2022_geo_df)
+
+def _compute_rail_diff(indexes, lats, longs, length=2):
+    rail_2012_index, rail_2022_index = indexes
+    return {"rail_diff": assess.get_diff_rail_counts(lats, longs, rail_2022_index, rail_2012_index, length)}
+
+def rail_diff_features(rail_2012_geo_df=None, rail_2022_geo_df=None, length=2):
+    """ Difference between the 2022 and 2012 rail feature counts around each point. """
+    if rail_2012_geo_df is None or rail_2022_geo_df is None:
+        rail_2012_geo_df, rail_2022_geo_df = assess.get_rail_geo_dfs()
+    return FeatureGenerator("rail_diff", functools.partial(_build_rail_indexes, rail_2012_geo_df, rail_2022_geo_df),
+                            functools.partial(_compute_rail_diff, length=length))
+
+def _compute_new_builds(indexes, lats, longs, lengths=(1,)):
+    return assess.count_new_builds(indexes, lats, longs, lengths)
+
+def new_build_features(new_build_coords_df, lengths=(1,), date_windows=None):
+    """ Number of new builds in boxes of the given lengths (and date windows) around each point. """
+    return FeatureGenerator("new_builds", functools.partial(assess.new_build_indexes, new_build_coords_df, date_windows),
+                            functools.partial(_compute_new_builds, lengths=tuple(lengths)))
+
+def _build_census_index(areas_df, code, level, columns, proportions, area_column, census_kwargs):
+    area_column = area_column or f"{level}21cd"
+    areas_df = areas_df[areas_df[area_column].notna()]
+    features = access.join_census_features(areas_df[[area_column]], code, level, columns, area_column, proportions, **census_kwargs)
+    features = features.drop(columns=area_column).reset_index(drop=True)
+    lats = areas_df['latitude'].to_numpy(dtype=np.float64)
+    scale = np.cos(np.radians(lats.mean())) if len(lats) else 1.0
+    tree = spatial.cKDTree(np.column_stack([lats, areas_df['longitude'].to_numpy(dtype=np.float64) * scale]))
+    return tree, scale, features
+
+def _compute_census(index, lats, longs):
+    tree, scale, features = index
+    _, nearest = tree.query(np.column_stack([lats, np.asarray(longs) * scale]))
+    return features.iloc[nearest].reset_index(drop=True)
+
+def census_features(areas_df, code, level="msoa", columns=None, proportions=False, area_column=None, **census_kwargs):
+    """ Census 2021 columns (see access.join_census_features) of the area of
+        the nearest row of areas_df, e.g. postcode_data with msoa21cd from
+        access.attach_postcode_areas, to each point.
+    :param areas_df: frame with latitude, longitude and an area code column
+    :param census_kwargs: data_dir and cache_dir passed to access.load_census
+    """
+    return FeatureGenerator(f"census_{code}_{level}",
+                            functools.partial(_build_census_index, areas_df, code, level, None if columns is None else tuple(columns), proportions, area_column, census_kwargs),
+                            _compute_census)
+
+# Generators and their indexes, built once per run; forked workers inherit them read-only
+_worker_generators = {}
+_worker_indexes = {}
+
+def _init_worker(generators):
+    for generator in generators:
+        _worker_generators[generator.name] = generator
+        if generator.name not in _worker_indexes:
+            _worker_indexes[generator.name] = generator.build_index()
+
+def _compute_shard(names, positions, lats, longs):
+    results = {}
+    for name in names:
+        generator = _worker_generators[name]
+        start = time.perf_counter()
+        result = generator.compute(_worker_indexes[generator.name], lats, longs)
+        results[generator.name] = ({column: np.asarray(values) for column, values in result.items()}, time.perf_counter() - start)
+    return positions, results
+
+def spatial_shards(lats, longs, n_shards, shard_km=10.0):
+    """ Split point positions into up to n_shards groups of whole grid cells, so each shard is spatially compact. """
+    cells_lat = np.floor(np.asarray(lats) / (0.009 * shard_km))
+    cells_long = np.floor(np.asarray(longs) / (0.014 * shard_km))
+    order = np.lexsort([cells_long, cells_lat])
+    if not len(order):
+        return []
+    cells = np.column_stack([cells_lat[order], cells_long[order]])
+    cell_starts = np.flatnonzero(np.r_[True, np.any(cells[1:] != cells[:-1], axis=1)])
+    # Give each cell to the shard its first point would fall in under an even
+    # split, and cut only where that shard changes
+    cell_shards = cell_starts * n_shards // len(order)
+    cuts = cell_starts[1:][np.diff(cell_shards) > 0]
+    return np.split(order, cuts)
+
+def build_feature_matrix(lats, longs, generators, cache_dir=None, n_workers=None, shard_km=10.0):
+    """ Feature matrix for a batch of coordinates.
+
+        Each generator's columns are cached as Parquet in cache_dir, keyed by
+        the coordinates, the generator's parameters and its source code, so
+        only generators whose key changed are recomputed. Those are computed
+        over spatial shards in a process pool, with each generator's index
+        built once and shared read-only with forked workers.
+    :param lats: latitudes
+    :param longs: longitudes
+    :param generators: list of FeatureGenerator
+    :param cache_dir: feature cache directory, feature_cache_dir from the config by default
+    :param n_workers: worker processes, os.cpu_count() by default; 1 runs in process
+    :param shard_km: grid cell size used to shard the points
+    :return: DataFrame with one row per point, and seconds per stage in .attrs["timings"]
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    cache_dir = cache_dir or config.get("feature_cache_dir", "feature_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    n_workers = n_workers or os.cpu_count() or 1
+    coords_key = _fingerprint(np.column_stack([lats, longs]))
+
+    frames = {}
+    stale = []
+    for generator in generators:
+        path = os.path.join(cache_dir, generator.cache_key(coords_key) + ".parquet")
+        if os.path.exists(path):
+            frames[generator.name] = pd.read_parquet(path)
+            metrics.count("feature_cache.hits")
+        else:
+            stale.append((generator, path))
+            metrics.count("feature_cache.misses")
+
+    timings = {}
+    if stale:
+        stale_generators = [generator for generator, _ in stale]
+        start = time.perf_counter()
+        _worker_generators.clear()
+        _worker_indexes.clear()
+        _init_worker(stale_generators)
+        names = [generator.name for generator in stale_generators]
+        timings["build_index"] = time.perf_counter() - start
+
+        if n_workers > 1:
+            shards = spatial_shards(lats, longs, n_workers * 4, shard_km)
+            if "fork" in multiprocessing.get_all_start_methods():
+                executor = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("fork"))
+            else:
+                executor = ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(stale_generators,))
+            with executor:
+                shard_results = list(executor.map(_compute_shard, [names] * len(shards), shards,
+                                                  [lats[shard] for shard in shards], [longs[shard] for shard in shards]))
+        else:
+            shard_results = [_compute_shard(names, np.arange(len(lats)), lats, longs)]
+        _worker_generators.clear()
+        _worker_indexes.clear()
+
+        for generator, path in stale:
+            columns = {}
+            timings[generator.name] = 0.0
+            for positions, results in shard_results:
+                shard_columns, seconds = results[generator.name]
+                timings[generator.name] += seconds
+                for column, values in shard_columns.items():
+                    if column not in columns:
+                        columns[column] = np.zeros(len(lats), dtype=values.dtype)
+                    columns[column][positions] = values
+            frame = pd.DataFrame(columns)
+            frame.to_parquet(path, index=False)
+            frames[generator.name] = frame
+            metrics.record(f"feature.{generator.name}", timings[generator.name], rows=len(lats), shards=len(shard_results))
+        metrics.record("feature.build_index", timings["build_index"], generators=len(stale))
+
+    feature_df = pd.concat([frames[generator.name] for generator in generators], axis=1) if generators else pd.DataFrame(index=range(len(lats)))
+    feature_df.attrs["timings"] = timings
+    return feature_df
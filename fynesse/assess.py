@@ -1,11 +1,23 @@
-import pandas as pd
-from shapely import box
+import functools
+import json
+import re
+import time
 from .config import *
-import osmnx as ox
-import matplotlib.pyplot as plt
-from sqlalchemy import create_engine
-import geopandas as gpd
+from .lazy import lazy_import
 from . import access
+from . import metrics
+
+# Heavy dependencies are imported on first use
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+spatial = lazy_import("scipy.spatial")
+shapely = lazy_import("shapely")
+sqlalchemy = lazy_import("sqlalchemy")
+ox = lazy_import("osmnx")
+plt = lazy_import("matplotlib.pyplot")
+gpd = lazy_import("geopandas")
+ds = lazy_import("pyarrow.dataset")
 
 """These are the types of import we might expect in this file
 import pandas
@@ -17,10 +29,20 @@ import sklearn.feature_extraction"""
 
 """Place commands in this file to assess the data you have downloaded. How are missing values encoded, how are outliers encoded? What do columns represent, makes rure they are correctly labeled. How is the data indexed. Crete visualisation routines to assess the data (e.g. in bokeh). Ensure that date formats are correct and correctly timezoned."""
 
-def get_df_from_sql(table_name, username, password, url):
-  engine = create_engine(f"mysql+pymysql://{username}:{password}@{url}:{3306}/ads_2024")
-  query = 'SELECT * FROM ' + table_name 
-  return pd.read_sql_query(query, engine)
+def get_df_from_sql(table_name, username=None, password=None, url=None, local_store=None, engine=None):
+  """
+  Every row of a table, from the database (through engine if given, else
+  the shared engine for the credentials) or, when local_store (an
+  access.LocalStore) is given, from its local snapshot with no round trip.
+  """
+  if local_store is not None:
+    return local_store.read(table_name)
+  query = 'SELECT * FROM ' + table_name
+  engine = engine or access.get_engine(username, password, url)
+  with metrics.span("get_df_from_sql", table=table_name) as span, access.engine_connection(engine) as conn:
+    df = pd.read_sql_query(query, conn)
+    span.add(rows=len(df))
+    return df
 
 def get_box(latitude, longitude, length):
   box_height = 0.018*length
@@ -31,44 +53,57 @@ def get_box(latitude, longitude, length):
   east = longitude + box_width/2
   return north, south, west, east
 
+BUILDING_TAGS = {
+    "building": True,
+    "addr:housenumber": True,
+    "addr:street": True,
+    "addr:postcode": True,
+    "addr:city": True,
+}
+ADDRESS_COLUMNS = ["addr:housenumber", "addr:street", "addr:postcode", "addr:city"]
+# ETRS89 Lambert Azimuthal Equal-Area, which covers Great Britain
+EQUAL_AREA_CRS = "EPSG:3035"
+
+def add_building_areas(pois):
+  """
+  Select the buildings from an OSM features frame in a single pass, adding
+  their area in m2 (computed once in an equal-area CRS) and whether they
+  have a full address.
+  """
+  buildings = pois[pois['building'].notna()] if 'building' in pois.columns else pois.iloc[:0]
+  has_full_address = np.ones(len(buildings), dtype=bool)
+  for column in ADDRESS_COLUMNS:
+    has_full_address &= buildings[column].notna().to_numpy() if column in buildings.columns else False
+  geometry = buildings.geometry if buildings.crs is not None else buildings.geometry.set_crs("EPSG:4326")
+  areas = shapely.area(geometry.to_crs(EQUAL_AREA_CRS).values)
+  return buildings.assign(area=areas, has_full_address=has_full_address)
+
 def get_buildings_with_area(pois, has_full_address):
-    if has_full_address:
-      buildings_full_addr = pois[
-        pois['building'].notna()
-        & pois['addr:housenumber'].notna()
-        & pois['addr:street'].notna()
-        & pois['addr:postcode'].notna()
-        & pois['addr:city'].notna()
-        ]
-      buildings_full_addr['area'] = buildings_full_addr.geometry.area
-      return buildings_full_addr
-    else:
-      buildings_no_addr = pois[
-          pois['building'].notna()
-          & (
-              pois['addr:housenumber'].isna()
-              | pois['addr:street'].isna()
-              | pois['addr:postcode'].isna()
-              | pois['addr:city'].isna()
-            )
-            ]
-      buildings_no_addr['area'] = buildings_no_addr.geometry.area
-      return buildings_no_addr
-
-def plotBuildings(latitude, longitude, place_name):
-  tags = {
-      "building": True,
-      "addr:housenumber": True,
-      "addr:street": True,
-      "addr:postcode": True,
-      "addr:city": True,
-  }
-
-  north, south, west, east = get_box(latitude, longitude)
-  pois = ox.geometries_from_bbox(north, south, east, west, tags)
-  graph = ox.graph_from_bbox(north, south, east, west)
+  """
+  The buildings with (or without) a full address and their area in m2.
+  pois may already have been through add_building_areas, in which case the
+  areas are reused.
+  """
+  buildings = pois if 'has_full_address' in pois.columns else add_building_areas(pois)
+  return buildings[buildings['has_full_address'] == has_full_address]
+
+@functools.lru_cache(maxsize=32)
+def get_building_features(north, south, east, west):
+  """
+  Buildings in a bbox, fetched through the OSM cache and passed through
+  add_building_areas, memoized per bbox. The frame is shared between
+  callers, so do not modify it in place.
+  """
+  pois = access.get_osm_cache().features_from_bbox(north, south, east, west, BUILDING_TAGS)
+  return add_building_areas(pois)
+
+def plotBuildings(latitude, longitude, place_name, length=1):
+  osm_cache = access.get_osm_cache()
+  north, south, west, east = get_box(latitude, longitude, length)
+  buildings = get_building_features(north, south, east, west)
+  graph = osm_cache.graph_from_bbox(north, south, east, west)
   nodes, edges = ox.graph_to_gdfs(graph)
-  area = ox.geocode_to_gdf(place_name)
+  area = osm_cache.geocode_to_gdf(place_name)
 
   fig, ax = plt.subplots()
 
@@ -81,43 +116,287 @@ def plotBuildings(latitude, longitude, place_name):
   ax.set_xlabel("longitude")
   ax.set_ylabel("latitude")
 
-  buildings_full_addr = get_buildings_with_area(pois, True)
-  buildings_no_addr = get_buildings_with_area(pois, False)
+  buildings_full_addr = get_buildings_with_area(buildings, True)
+  buildings_no_addr = get_buildings_with_area(buildings, False)
 
   buildings_full_addr.plot(ax=ax, color="blue", alpha=0.7, markersize=10)
   buildings_no_addr.plot(ax=ax, color="grey", alpha=0.7, markersize=10)
   plt.tight_layout()
 
-def get_pcd_joined_df(lat, long, postcode_start, conn):
-  lat_km_in_degs = 0.009
-  long_km_in_degs = 0.014
-
-  query1 = "SELECT pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.primary_addressable_object_name ,pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude FROM"
-  query2 = f" (SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, primary_addressable_object_name, town_city, district, county FROM pp_data WHERE date_of_transfer BETWEEN '2020-01-01' AND '2024-12-31' and postcode LIKE '{postcode_start}%') AS pp INNER JOIN"
-  query3 = f" (SELECT * FROM postcode_data where latitude between {lat} - {lat_km_in_degs} and {lat} + {lat_km_in_degs} and longitude between {long} - {long_km_in_degs} and {long} + {long_km_in_degs} and postcode LIKE '{postcode_start}%') AS po"
-  query4 = " ON pp.postcode = po.postcode "
-
-  query = query1+query2+query3+query4
-  return pd.read_sql_query(query, conn)
-
-def get_merged_df(pp_buildings_df, pois):
-  pp_buildings_df
-  osm_buildings_df = pois[pois['building'].notna()]
-  osm_buildings_df['area'] = osm_buildings_df.geometry.area
-  merged_df = pd.merge(
-      pp_buildings_df,
-      osm_buildings_df,
-      left_on=['primary_addressable_object_name', 'postcode'],
-      right_on=['addr:housenumber', 'addr:postcode'],
-      how='outer',
-      indicator=True
-  )
-  unmatched_pp = merged_df[(merged_df['_merge'] == 'left_only')]
-  unmatched_osm = merged_df[(merged_df['_merge'] == 'right_only') & (merged_df['addr:postcode'].notna())]
-  both = merged_df[merged_df['_merge'] == 'both']
-  print("\nnum matches:", len(both), "| num unmatched pp:", len(unmatched_pp), "| num unmatched osm:", len(unmatched_osm),'\n')
+PCD_JOINED_COLUMNS = "pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.primary_addressable_object_name, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude"
+
+def get_pcd_box(lat, long, distance_km=1.0):
+  """ South, north, west and east bounds of the get_pcd_joined_df box. """
+  lat_km_in_degs = 0.009 * distance_km
+  long_km_in_degs = 0.014 * distance_km
+  return lat - lat_km_in_degs, lat + lat_km_in_degs, long - long_km_in_degs, long + long_km_in_degs
+
+def build_pcd_joined_query(lat, long, postcode_start, start_date="2020-01-01", end_date="2024-12-31", distance_km=1.0):
+  """
+  Parameterised pp_data / postcode_data join for the transactions around a
+  location. The bounding box is a range predicate on postcode_data
+  (latitude, longitude) and the postcode prefix a LIKE 'prefix%', so both can
+  use the indexes from access.create_spatial_indexes.
+  Returns:
+      (query, params)
+  """
+  south, north, west, east = get_pcd_box(lat, long, distance_km)
+  query = (f"SELECT {PCD_JOINED_COLUMNS} FROM postcode_data AS po INNER JOIN pp_data AS pp ON pp.postcode = po.postcode"
+           " WHERE po.latitude BETWEEN %s AND %s AND po.longitude BETWEEN %s AND %s AND po.postcode LIKE %s"
+           " AND pp.date_of_transfer BETWEEN %s AND %s")
+  return query, (south, north, west, east, postcode_start + "%", start_date, end_date)
+
+def get_pcd_joined_df(lat, long, postcode_start, conn=None, start_date="2020-01-01", end_date="2024-12-31", distance_km=1.0, local_store=None):
+  """
+  Transactions around a location joined with their postcode coordinates,
+  from the database through conn or, when local_store (an access.LocalStore
+  holding pp_data and postcode_data snapshots) is given, from the snapshots
+  with the same filters and columns.
+  """
+  if local_store is not None:
+    return _get_pcd_joined_df_local(lat, long, postcode_start, local_store, start_date, end_date, distance_km)
+  query, params = build_pcd_joined_query(lat, long, postcode_start, start_date, end_date, distance_km)
+  return pd.read_sql_query(query, conn, params=params)
+
+def _get_pcd_joined_df_local(lat, long, postcode_start, local_store, start_date, end_date, distance_km):
+  south, north, west, east = get_pcd_box(lat, long, distance_km)
+  area = re.match(r"[A-Z]*", postcode_start).group(0)
+  areas = [area] if area else None
+  postcodes = local_store.read("postcode_data", columns=["postcode", "country", "latitude", "longitude"], areas=areas,
+                               filter=(ds.field("latitude") >= south) & (ds.field("latitude") <= north) & (ds.field("longitude") >= west) & (ds.field("longitude") <= east))
+  postcodes = postcodes[postcodes["postcode"].str.startswith(postcode_start)]
+  pp_columns = ["price", "date_of_transfer", "postcode", "property_type", "new_build_flag", "tenure_type", "locality", "primary_addressable_object_name", "town_city", "district", "county"]
+  pp = local_store.read("pp_data", columns=pp_columns, years=(pd.Timestamp(start_date).year, pd.Timestamp(end_date).year), areas=areas,
+                        filter=ds.field("postcode").isin(postcodes["postcode"].tolist()))
+  dates = pd.to_datetime(pp["date_of_transfer"])
+  pp = pp[(dates >= pd.Timestamp(start_date)) & (dates <= pd.Timestamp(end_date))]
+  joined = pp.merge(postcodes, on="postcode", how="inner")
+  return joined[[column.split(".")[1] for column in PCD_JOINED_COLUMNS.split(", ")]].reset_index(drop=True)
+
+def get_pcd_joined_dfs(locations, conn, start_date="2020-01-01", end_date="2024-12-31", distance_km=1.0):
+  """
+  get_pcd_joined_df for many locations in one round trip. The boxes are
+  loaded into a temporary table that is joined against postcode_data.
+  Args:
+      locations (iterable): (lat, long, postcode_start) tuples.
+      conn: a pymysql connection, as returned by access.create_connection.
+  Returns:
+      list: one DataFrame per location, in the order of locations.
+  """
+  locations = list(locations)
+  rows = [(n, *get_pcd_box(lat, long, distance_km), postcode_start + "%") for n, (lat, long, postcode_start) in enumerate(locations)]
+  with conn.cursor() as cur:
+    cur.execute("CREATE TEMPORARY TABLE pcd_query_locations (location_id INT NOT NULL, south DOUBLE, north DOUBLE, west DOUBLE, east DOUBLE, postcode_pattern VARCHAR(16), PRIMARY KEY (location_id))")
+    try:
+      cur.executemany("INSERT INTO pcd_query_locations VALUES (%s, %s, %s, %s, %s, %s)", rows)
+      query = (f"SELECT q.location_id, {PCD_JOINED_COLUMNS} FROM pcd_query_locations AS q"
+               " INNER JOIN postcode_data AS po ON po.latitude BETWEEN q.south AND q.north AND po.longitude BETWEEN q.west AND q.east AND po.postcode LIKE q.postcode_pattern"
+               " INNER JOIN pp_data AS pp ON pp.postcode = po.postcode"
+               " WHERE pp.date_of_transfer BETWEEN %s AND %s")
+      with metrics.span("get_pcd_joined_dfs.query", locations=len(locations)) as span:
+        joined_df = pd.read_sql_query(query, conn, params=(start_date, end_date))
+        span.add(rows=len(joined_df))
+    finally:
+      cur.execute("DROP TEMPORARY TABLE IF EXISTS pcd_query_locations")
+  groups = dict(list(joined_df.groupby("location_id")))
+  empty_df = joined_df.iloc[:0].drop(columns="location_id")
+  return [groups[n].drop(columns="location_id").reset_index(drop=True) if n in groups else empty_df.copy() for n in range(len(locations))]
+
+def explain_pcd_joined_query(conn, lat, long, postcode_start, start_date="2020-01-01", end_date="2024-12-31", distance_km=1.0):
+  """
+  Check with EXPLAIN that the get_pcd_joined_df query uses an index on every table.
+  Returns:
+      DataFrame: the EXPLAIN output.
+  Raises:
+      ValueError: if any table is read with a full scan.
+  """
+  query, params = build_pcd_joined_query(lat, long, postcode_start, start_date, end_date, distance_km)
+  explain_df = pd.read_sql_query("EXPLAIN " + query, conn, params=params)
+  full_scans = explain_df[explain_df["key"].isna() | (explain_df["type"] == "ALL")]
+  if len(full_scans):
+    raise ValueError(f"Tables read without an index: {', '.join(full_scans['table'].astype(str))}")
+  return explain_df
+
+def normalize_postcodes(postcodes):
+  """ Upper case postcodes with all whitespace removed, e.g. 'cb2 1tn ' -> 'CB21TN'. """
+  return postcodes.astype("string").str.upper().str.replace(r"\s+", "", regex=True)
+
+def normalize_house_numbers(house_numbers):
+  """ Upper case house numbers without whitespace or punctuation, e.g. '12 a.' -> '12A'. """
+  return house_numbers.astype("string").str.upper().str.replace(r"[\s,.;]+", "", regex=True)
+
+class AddressMatcher:
+  """
+  Matches price paid transactions to OSM buildings. House numbers and
+  postcodes are normalized once and packed into int64 keys, with a hash
+  index over the OSM side. Optionally, transactions with no exact match
+  and a location are matched to the nearest unnumbered building in their
+  postcode.
+  """
+  def __init__(self, osm_buildings_df):
+    self.buildings = osm_buildings_df
+    postcodes = normalize_postcodes(osm_buildings_df['addr:postcode'])
+    numbers = normalize_house_numbers(osm_buildings_df['addr:housenumber'])
+    self.postcode_codes, self.postcode_values = pd.factorize(postcodes, use_na_sentinel=True)
+    self.number_codes, self.number_values = pd.factorize(numbers, use_na_sentinel=True)
+    self.postcode_lookup = pd.Index(self.postcode_values)
+    self.number_lookup = pd.Index(self.number_values)
+    keys = self._keys(self.postcode_codes, self.number_codes)
+    valid = np.flatnonzero(keys >= 0)
+    # Keep the first building for each address
+    unique_keys, first = np.unique(keys[valid], return_index=True)
+    self.key_index = pd.Index(unique_keys)
+    self.key_positions = valid[first]
+    centroids = shapely.centroid(osm_buildings_df.geometry.values)
+    self.centroid_x = shapely.get_x(centroids)
+    self.centroid_y = shapely.get_y(centroids)
+
+  def _keys(self, postcode_codes, number_codes):
+    keys = postcode_codes.astype(np.int64) * (len(self.number_values) + 1) + number_codes
+    return np.where((postcode_codes < 0) | (number_codes < 0), -1, keys)
+
+  def match(self, pp_df, nearest=True, max_candidates=8):
+    """
+    Args:
+        nearest (bool): match transactions with no exact match to the
+          nearest building in their postcode that has no house number and
+          no exact match, each building at most once. Transactions only
+          carry their postcode centroid, so these matches are approximate.
+        max_candidates (int): buildings considered per transaction at a
+          time, so a postcode with many flats and many buildings is not
+          expanded into their cross product.
+    Returns:
+        (osm_positions, match_types): the matched row position in the OSM
+        buildings (-1 if unmatched) and "exact", "nearest" or None for every
+        transaction.
+    """
+    postcode_codes = self.postcode_lookup.get_indexer(normalize_postcodes(pp_df['postcode']))
+    number_codes = self.number_lookup.get_indexer(normalize_house_numbers(pp_df['primary_addressable_object_name']))
+    keys = self._keys(postcode_codes, number_codes)
+    found = self.key_index.get_indexer(keys)
+    osm_positions = np.where((keys >= 0) & (found >= 0), self.key_positions[np.maximum(found, 0)], -1) if len(self.key_positions) else np.full(len(keys), -1)
+    match_types = np.where(osm_positions >= 0, "exact", None).astype(object)
+
+    if nearest and {'latitude', 'longitude'} <= set(pp_df.columns):
+      self._match_nearest(pp_df['latitude'].to_numpy(dtype=np.float64), pp_df['longitude'].to_numpy(dtype=np.float64),
+                          postcode_codes, osm_positions, match_types, max_candidates)
+    return osm_positions, match_types
+
+  # Postcodes are laid out this many degrees apart along a third axis, so a
+  # radius-bounded KD-tree query never crosses into another postcode
+  postcode_spacing = 1000.0
+
+  def _tree_points(self, lats, longs, postcode_codes):
+    return np.column_stack([longs * np.cos(np.radians(lats)), lats, postcode_codes * self.postcode_spacing])
+
+  def _match_nearest(self, pp_lats, pp_longs, postcode_codes, osm_positions, match_types, max_candidates):
+    claimed = np.zeros(len(self.postcode_codes), dtype=bool)
+    claimed[osm_positions[osm_positions >= 0]] = True
+    waiting = (osm_positions < 0) & (postcode_codes >= 0) & np.isfinite(pp_lats) & np.isfinite(pp_longs)
+    free_mask = (self.number_codes < 0) & (self.postcode_codes >= 0) & ~claimed & np.isfinite(self.centroid_x) & np.isfinite(self.centroid_y)
+    building_points = self._tree_points(self.centroid_y, self.centroid_x, self.postcode_codes)
+    while True:
+      unmatched = np.flatnonzero(waiting)
+      free = np.flatnonzero(free_mask)
+      if not len(unmatched) or not len(free):
+        return
+      # The max_candidates nearest free buildings in each transaction's postcode
+      k = min(max_candidates, len(free))
+      tree = spatial.cKDTree(building_points[free])
+      _, neighbours = tree.query(self._tree_points(pp_lats[unmatched], pp_longs[unmatched], postcode_codes[unmatched]),
+                                 k=k, distance_upper_bound=self.postcode_spacing / 2)
+      neighbours = neighbours.reshape(len(unmatched), k)
+      rows, cols = np.nonzero(neighbours < len(free))
+      if not len(rows):
+        return
+      candidates = pd.DataFrame({"pp": unmatched[rows], "osm": free[neighbours[rows, cols]]})
+      # Transactions whose whole list is in range may have more buildings beyond it
+      truncated = unmatched[(neighbours < len(free)).all(axis=1)] if k < len(free) else unmatched[:0]
+      pp_lats_candidates = pp_lats[candidates["pp"]]
+      distances = np.hypot(
+        (self.centroid_x[candidates["osm"]] - pp_longs[candidates["pp"]]) * np.cos(np.radians(pp_lats_candidates)),
+        self.centroid_y[candidates["osm"]] - pp_lats_candidates)
+      candidates = candidates.assign(distance=distances).sort_values("distance", kind="stable")
+      # Greedy assignment by distance: each round pairs every remaining
+      # transaction with its nearest remaining building, keeping the
+      # closest transaction where several pick the same building. Once a
+      # truncated list runs out, the remaining transactions are queried again.
+      while len(candidates):
+        pairs = candidates.drop_duplicates("pp").drop_duplicates("osm")
+        osm_positions[pairs["pp"].to_numpy()] = pairs["osm"].to_numpy()
+        match_types[pairs["pp"].to_numpy()] = "nearest"
+        free_mask[pairs["osm"].to_numpy()] = False
+        candidates = candidates[~candidates["pp"].isin(pairs["pp"]) & ~candidates["osm"].isin(pairs["osm"])]
+        if not np.isin(truncated[osm_positions[truncated] < 0], candidates["pp"]).all():
+          break
+      waiting[unmatched] = False
+      waiting[candidates["pp"].to_numpy()] = True
+      waiting[truncated[osm_positions[truncated] < 0]] = True
+
+def get_merged_df(pp_buildings_df, pois, nearest=True):
+  """
+  Outer join of transactions and OSM buildings on normalized (house number,
+  postcode), falling back to the nearest unnumbered building in the postcode
+  unless nearest is False (see AddressMatcher.match). The result has the
+  columns of both sides, a _merge indicator as from pd.merge(...,
+  indicator=True), a match_type of "exact" or "nearest", and the number of
+  matches of each type and of unmatched rows in .attrs["match_counts"].
+  """
+  osm_buildings_df = pois if 'has_full_address' in pois.columns else add_building_areas(pois)
+  with metrics.span("get_merged_df.match", buildings=len(osm_buildings_df)) as span:
+    osm_positions, match_types = AddressMatcher(osm_buildings_df).match(pp_buildings_df, nearest)
+    span.add(rows=len(pp_buildings_df))
+
+  matched = osm_positions >= 0
+  osm_reset = osm_buildings_df.reset_index(drop=True)
+  left = pp_buildings_df.reset_index(drop=True)
+  both = pd.concat([left[matched].reset_index(drop=True), osm_reset.iloc[osm_positions[matched]].reset_index(drop=True).drop(columns=left.columns.intersection(osm_reset.columns))], axis=1)
+  both['_merge'] = 'both'
+  both['match_type'] = match_types[matched]
+  unmatched_pp = left[~matched].assign(_merge='left_only', match_type=None)
+  osm_used = np.zeros(len(osm_reset), dtype=bool)
+  osm_used[osm_positions[matched]] = True
+  unmatched_osm_all = osm_reset[~osm_used].assign(_merge='right_only', match_type=None)
+  merged_df = pd.concat([both, unmatched_pp, unmatched_osm_all], ignore_index=True)
+  merged_df['_merge'] = pd.Categorical(merged_df['_merge'], categories=['left_only', 'right_only', 'both'])
+
+  match_counts = {"exact": int((match_types == "exact").sum()), "nearest": int((match_types == "nearest").sum()),
+                  "unmatched_pp": int((~matched).sum()), "unmatched_osm": int(unmatched_osm_all['addr:postcode'].notna().sum())}
+  merged_df.attrs["match_counts"] = match_counts
+  print("\nnum matches:", int(matched.sum()), "(exact:", match_counts["exact"], "| nearest:", match_counts["nearest"], ") | num unmatched pp:", match_counts["unmatched_pp"], "| num unmatched osm:", match_counts["unmatched_osm"], '\n')
   return merged_df
 
+def benchmark_address_matching(n_transactions=1_000_000, n_buildings=200_000, seed=0):
+  """
+  Time AddressMatcher on synthetic transactions and buildings.
+  Returns:
+      dict: seconds to build the index, seconds to match, transactions per
+      minute and the exact match rate.
+  """
+  rng = np.random.default_rng(seed)
+  n_postcodes = max(n_buildings // 20, 1)
+  postcodes = np.array([f"CB{n // 100} {n % 10}{chr(65 + n % 26)}{chr(65 + n // 26 % 26)}" for n in range(n_postcodes)])
+  building_postcodes = postcodes[rng.integers(0, n_postcodes, n_buildings)]
+  building_numbers = rng.integers(1, 200, n_buildings).astype(str)
+  x = rng.uniform(0, 0.1, n_buildings)
+  y = rng.uniform(52, 52.1, n_buildings)
+  buildings = gpd.GeoDataFrame({'building': 'yes', 'addr:housenumber': building_numbers, 'addr:postcode': building_postcodes},
+                               geometry=gpd.points_from_xy(x, y), crs="EPSG:4326")
+  picks = rng.integers(0, n_buildings, n_transactions)
+  pp_df = pd.DataFrame({
+    'primary_addressable_object_name': np.where(rng.random(n_transactions) < 0.8, building_numbers[picks], "FLAT 1"),
+    'postcode': pd.Series(building_postcodes[picks]).str.lower().to_numpy(),
+    'latitude': y[picks], 'longitude': x[picks]})
+  start = time.perf_counter()
+  matcher = AddressMatcher(buildings)
+  build_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  _, match_types = matcher.match(pp_df, nearest=False)
+  match_seconds = time.perf_counter() - start
+  return {"build_seconds": build_seconds, "match_seconds": match_seconds,
+          "transactions_per_minute": n_transactions / match_seconds * 60,
+          "exact_match_rate": float((match_types == "exact").mean())}
+
 def count_pois_near_coordinates(latitude: float, longitude: float, tags: dict, distance_km: float = 1.0) -> dict:
     """
     Count Points of Interest (POIs) near a given pair of coordinates within a specified distance.
@@ -129,7 +408,7 @@ def count_pois_near_coordinates(latitude: float, longitude: float, tags: dict, d
     Returns:
         dict: A dictionary where keys are the OSM tags and values are the counts of POIs for each tag.
     """
-    pois = ox.geometries_from_point((latitude, longitude), tags=tags, dist=distance_km*1000)
+    pois = access.get_osm_cache().features_from_point((latitude, longitude), tags=tags, dist=distance_km*1000)
 
     pois_count = {}
 
@@ -141,17 +420,135 @@ def count_pois_near_coordinates(latitude: float, longitude: float, tags: dict, d
 
     return pois_count
 
-def get_all_pois_sql(username, password, url, tags):
+def nodes_df_to_geo_df(nodes_df, keys):
+  """
+  Turn a node table (e.g. from get_all_pois_sql or access.full_england_osm_to_df)
+  into a GeoDataFrame with one column per tag key, usable as the pois source
+  of count_pois_near_coordinates_batch.
+  """
+  if not all(f"tag:{key}" in nodes_df for key in keys):
+    nodes_df = parse_tag_columns(nodes_df, keys)
+  return gpd.GeoDataFrame(
+    {key: nodes_df[f"tag:{key}"].to_numpy() for key in keys},
+    geometry=gpd.points_from_xy(nodes_df["longitude"], nodes_df["latitude"]),
+    crs="EPSG:4326",
+  )
 
-  query = f"Select * from osm_england_nodes where "
+def count_pois_near_coordinates_batch(latitudes, longitudes, tags, distance_km=1.0, pois=None, group_km=10.0):
+  """
+  Count POIs near many coordinates at once, with the same boxes and per-tag
+  counts as count_pois_near_coordinates.
+  Args:
+      latitudes, longitudes (array-like): coordinates of the points.
+      tags (dict): OSM tags to filter the POIs, as for count_pois_near_coordinates.
+      distance_km (float): the distance around each point in kilometers.
+      pois (GeoDataFrame): local POI source with one column per tag key (see
+        nodes_df_to_geo_df), filtered to the tag values as osmnx would. If
+        None, points are grouped into group_km grid cells and each cell's
+        covering bbox is fetched through the OSM cache.
+      group_km (float): size of the grid cells used to group points for fetching.
+  Returns:
+      DataFrame: one row per point and one column per tag, with the seconds
+        spent in each stage in .attrs["timings"].
+  """
+  timings = {}
+  start = time.perf_counter()
+  latitudes = np.asarray(latitudes, dtype=np.float64)
+  longitudes = np.asarray(longitudes, dtype=np.float64)
+  norths, souths, easts, wests = access.bbox_from_point(latitudes, longitudes, distance_km * 1000)
+  timings["boxes"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  if pois is None:
+    osm_cache = access.get_osm_cache()
+    cells = np.column_stack([np.floor(latitudes / (0.009 * group_km)), np.floor(longitudes / (0.014 * group_km))])
+    _, groups = np.unique(cells, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    fetched = []
+    for group in range(groups.max() + 1 if len(groups) else 0):
+      members = groups == group
+      fetched.append(osm_cache.features_from_bbox(norths[members].max(), souths[members].min(), easts[members].max(), wests[members].min(), tags))
+    fetched = [frame for frame in fetched if len(frame)]
+    pois = pd.concat(fetched) if fetched else gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    pois = pois[~pois.index.duplicated()]
+  else:
+    pois = access.filter_tags(pois, tags)
+  timings["fetch"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  tree = shapely.STRtree(pois.geometry.values)
+  point_index, poi_index = tree.query(shapely.box(wests, souths, easts, norths), predicate="intersects")
+  timings["query"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  counts = {}
+  for tag in tags.keys():
+    if tag in pois.columns:
+      has_tag = pois[tag].notna().to_numpy()[poi_index]
+      counts[tag] = np.bincount(point_index[has_tag], minlength=len(latitudes))
+    else:
+      counts[tag] = np.zeros(len(latitudes), dtype=np.int64)
+  pois_count_df = pd.DataFrame(counts)
+  timings["count"] = time.perf_counter() - start
 
-  # select all rows with appropriate tags
-  conditions = " OR ".join([f"JSON_CONTAINS(tags, '\"{feature}\"', '$.{tag}')" for tag, features in tags.items() for feature in features ])
-  query += conditions
+  pois_count_df.attrs["timings"] = timings
+  return pois_count_df
 
-  engine = create_engine(f"mysql+pymysql://{username}:{password}@{url}/{'ads_2024'}")
-  tag_filtered_osm_nodes_df = pd.read_sql_query(query, engine)
-  return tag_filtered_osm_nodes_df
+def get_all_pois_sql(username, password, url, tags, indexed=None, engine=None):
+  """
+  Select the OSM nodes carrying any of the given tag values.
+  Args:
+      tags (dict): {tag: [feature, ...]}, e.g. {'amenity': ['school', 'cafe']}.
+      indexed (bool): look the tags up in the indexed osm_england_tags table
+        rather than scanning the json tags column of every node. Way and
+        relation ids can collide with node ids, so only node rows are used.
+        If None, the tag table is used when it exists (see
+        access.create_osm_indexes) and the json scan otherwise.
+      engine: engine to query, e.g. from access.get_engine_for_url, instead
+        of the shared engine for the credentials.
+  Returns:
+      DataFrame: the matching rows of osm_england_nodes.
+  """
+  pairs = [(tag, feature) for tag, features in tags.items() for feature in features]
+  engine = engine or access.get_engine(username, password, url)
+  with access.engine_connection(engine) as conn:
+    if indexed is None:
+      indexed = sqlalchemy.inspect(conn).has_table("osm_england_tags")
+    if indexed:
+      conditions = " OR ".join([f"(t.tag_key = :key_{n} AND t.tag_value = :value_{n})" for n in range(len(pairs))])
+      query = sqlalchemy.text("SELECT n.* FROM osm_england_nodes AS n WHERE n.type = 'node' AND n.id IN "
+                              f"(SELECT t.id FROM osm_england_tags AS t WHERE t.type = 'node' AND ({conditions}))")
+      params = {}
+      for n, (tag, feature) in enumerate(pairs):
+        params[f"key_{n}"] = tag
+        params[f"value_{n}"] = feature
+    else:
+      # select all rows with appropriate tags
+      conditions = " OR ".join([f"JSON_CONTAINS(tags, '\"{feature}\"', '$.{tag}')" for tag, feature in pairs])
+      query = "Select * from osm_england_nodes where " + conditions
+      params = None
+
+    with metrics.span("get_all_pois_sql", indexed=indexed) as span:
+      tag_filtered_osm_nodes_df = pd.read_sql_query(query, conn, params=params)
+      span.add(rows=len(tag_filtered_osm_nodes_df))
+  return parse_tag_columns(tag_filtered_osm_nodes_df, tags.keys())
+
+def benchmark_pois_sql(username, password, url, tags, repeats=3):
+  """
+  Time get_all_pois_sql with the json scan and with the indexed tag table.
+  Returns:
+      dict: {"json_scan": seconds, "indexed": seconds, "rows": number of rows}, best of repeats.
+  """
+  results = {}
+  for name, indexed in [("json_scan", False), ("indexed", True)]:
+    timings = []
+    for _ in range(repeats):
+      start = time.perf_counter()
+      df = get_all_pois_sql(username, password, url, tags, indexed=indexed)
+      timings.append(time.perf_counter() - start)
+    results[name] = min(timings)
+    results["rows"] = len(df)
+  return results
 
 def get_boxed_pois_from_df(lat, long, tag_filtered_df, area):
   lat_per_km = 0.009 * 2 * (int(area / 1_000_000) + 1)
@@ -163,34 +560,224 @@ def get_boxed_pois_from_df(lat, long, tag_filtered_df, area):
       (tag_filtered_df['longitude'] < long + long_per_km)]
   return local_nodes_df
 
+def parse_tag_columns(nodes_df, keys):
+  """
+  Parse the json tags column once into one categorical "tag:<key>" column per key.
+  Args:
+      nodes_df (DataFrame): node table with a json (or dict) "tags" column.
+      keys (iterable): tag keys to extract, e.g. tags.keys().
+  Returns:
+      DataFrame: nodes_df with the tag columns added.
+  """
+  parsed = [json.loads(x) if isinstance(x, str) else x for x in nodes_df["tags"]]
+  columns = {f"tag:{key}": pd.Categorical([tags.get(key) for tags in parsed]) for key in keys}
+  return nodes_df.assign(**columns)
+
+def _tag_column(nodes_df, tag):
+  column = f"tag:{tag}"
+  if column not in nodes_df:
+    nodes_df = parse_tag_columns(nodes_df, [tag])
+  return nodes_df[column]
+
+def get_tag_feature_matrix(nodes_df, tags):
+  """
+  Sparse (nodes x features) matrix with a 1 where the node has tag = feature,
+  with the features in the order of get_pois_count_from_df.
+  """
+  rows = []
+  cols = []
+  col = 0
+  for tag, features in tags.items():
+    values = _tag_column(nodes_df, tag)
+    codes = values.cat.codes.to_numpy()
+    for feature in features:
+      if feature in values.cat.categories:
+        matches = np.flatnonzero(codes == values.cat.categories.get_loc(feature))
+        rows.append(matches)
+        cols.append(np.full(len(matches), col))
+      col += 1
+  rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+  cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+  return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(nodes_df), col))
+
 def get_pois_count_from_df(tags, local_nodes_df):
   pois_count = {}
   for tag, features in tags.items():
+    counts = _tag_column(local_nodes_df, tag).value_counts()
     for feature in features:
-      count = local_nodes_df["tags"].apply(lambda x:f'"{tag}": "{feature}"' in x).sum()
-      pois_count[feature] = count
+      pois_count[feature] = int(counts.get(feature, 0))
   return pois_count
 
-def get_pois_count_df_from_coords(lats, longs, tags, areas):
-  tag_filtered_osm_nodes_df = get_all_pois_sql(tags)
-  pois_count_df = pd.DataFrame({feature:[] for _, features in tags.items() for feature in features})
-  n = 0
-  for lat, long, area in zip(lats, longs, areas):
-    local_nodes_df = get_boxed_pois_from_df(lat, long, tag_filtered_osm_nodes_df, area)
-    pois_count = get_pois_count_from_df(tags, local_nodes_df)
-    pois_count_df.loc[n] = pois_count
-    n += 1
-  return pois_count_df
-
-def get_rail_geo_dfs():
-  rail_2012_geo_df = gpd.read_file("/content/2012rail.geojson")
-  rail_2022_geo_df = gpd.read_file("/content/2022rail.geojson")
+EARTH_RADIUS_KM = 6371.0088
+
+class POIIndex:
+  """
+  Spatial index over a tag-filtered node table, built once and queried for
+  many locations at a time. Box counts use the same boxes as
+  get_boxed_pois_from_df, with the same strict edges; radius counts use the
+  true great-circle distance.
+  """
+  def __init__(self, tag_filtered_df, tags):
+    self.features = [feature for _, features in tags.items() for feature in features]
+    self.lats = tag_filtered_df['latitude'].to_numpy(dtype=np.float64)
+    self.longs = tag_filtered_df['longitude'].to_numpy(dtype=np.float64)
+    self.feature_matrix = get_tag_feature_matrix(tag_filtered_df, tags)
+    # Scale longitude so the lat/long boxes become squares for a Chebyshev ball query
+    self.long_scale = 0.009 / 0.014
+    self.box_tree = spatial.cKDTree(np.column_stack([self.lats, self.longs * self.long_scale]))
+    self.sphere_tree = spatial.cKDTree(_unit_vectors(self.lats, self.longs))
+
+  @staticmethod
+  def _pairs(neighbours):
+    lengths = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+    rows = np.repeat(np.arange(len(neighbours)), lengths)
+    cols = np.concatenate(neighbours).astype(np.int64) if lengths.sum() else np.empty(0, dtype=np.int64)
+    return rows, cols
+
+  def _count(self, rows, cols, n_points, counts, offset):
+    incidence = sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)), shape=(n_points, self.feature_matrix.shape[0]))
+    counts[offset:offset + n_points] = (incidence @ self.feature_matrix).toarray()
+
+  def count_boxes(self, lats, longs, areas, chunk_size=10_000):
+    """
+    Count each feature inside the get_boxed_pois_from_df box around every location.
+    Returns:
+        ndarray: (len(lats), len(features)) count matrix.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    multiples = (np.asarray(areas, dtype=np.float64) / 1_000_000).astype(np.int64) + 1
+    lat_per_km = 0.009 * 2 * multiples
+    long_per_km = 0.014 * 2 * multiples
+    counts = np.zeros((len(lats), len(self.features)), dtype=np.int64)
+    for start in range(0, len(lats), chunk_size):
+      end = start + chunk_size
+      points = np.column_stack([lats[start:end], longs[start:end] * self.long_scale])
+      # Query a slightly larger closed box, then apply the strict edges exactly as get_boxed_pois_from_df does
+      neighbours = self.box_tree.query_ball_point(points, lat_per_km[start:end] * (1 + 1e-9), p=np.inf)
+      rows, cols = self._pairs(neighbours)
+      point_lats, point_longs = lats[start:end][rows], longs[start:end][rows]
+      heights, widths = lat_per_km[start:end][rows], long_per_km[start:end][rows]
+      inside = ((self.lats[cols] > point_lats - heights) & (self.lats[cols] < point_lats + heights) &
+                (self.longs[cols] > point_longs - widths) & (self.longs[cols] < point_longs + widths))
+      self._count(rows[inside], cols[inside], len(points), counts, start)
+    return counts
+
+  def count_radius(self, lats, longs, radius_km, chunk_size=10_000):
+    """
+    Count each feature within radius_km (scalar or per location) of every location.
+    Returns:
+        ndarray: (len(lats), len(features)) count matrix.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    chords = 2 * np.sin(np.broadcast_to(np.asarray(radius_km, dtype=np.float64), lats.shape) / (2 * EARTH_RADIUS_KM))
+    counts = np.zeros((len(lats), len(self.features)), dtype=np.int64)
+    for start in range(0, len(lats), chunk_size):
+      end = start + chunk_size
+      neighbours = self.sphere_tree.query_ball_point(_unit_vectors(lats[start:end], longs[start:end]), chords[start:end])
+      rows, cols = self._pairs(neighbours)
+      self._count(rows, cols, len(neighbours), counts, start)
+    return counts
+
+def _unit_vectors(lats, longs):
+  lat_rad = np.radians(lats)
+  long_rad = np.radians(longs)
+  return np.column_stack([np.cos(lat_rad) * np.cos(long_rad), np.cos(lat_rad) * np.sin(long_rad), np.sin(lat_rad)])
+
+def get_pois_count_df_from_coords(lats, longs, tags, areas, username=None, password=None, url=None, radius_km=None, tag_filtered_osm_nodes_df=None):
+  """
+  Count the tagged POIs around many locations in one pass over a spatial index.
+  Args:
+      areas: box sizes as in get_boxed_pois_from_df, ignored when radius_km is given.
+      radius_km: count within a great-circle radius instead of a box.
+      tag_filtered_osm_nodes_df: node table to use instead of fetching it with get_all_pois_sql.
+  Returns:
+      DataFrame: one row per location and one column per feature.
+  """
+  if tag_filtered_osm_nodes_df is None:
+    tag_filtered_osm_nodes_df = get_all_pois_sql(username, password, url, tags)
+  with metrics.span("POIIndex.build") as span:
+    index = POIIndex(tag_filtered_osm_nodes_df, tags)
+    span.add(rows=len(tag_filtered_osm_nodes_df))
+  with metrics.span("POIIndex.count", radius_km=radius_km) as span:
+    if radius_km is None:
+      counts = index.count_boxes(lats, longs, areas)
+    else:
+      counts = index.count_radius(lats, longs, radius_km)
+    span.add(rows=len(counts))
+  return pd.DataFrame(counts, columns=index.features)
+
+@functools.lru_cache(maxsize=None)
+def _read_geo_df(path):
+  return gpd.read_file(path)
+
+def get_rail_geo_dfs(rail_2012_path=None, rail_2022_path=None):
+  """
+  Load the 2012 and 2022 rail layers, reading each file only once per process.
+  The paths default to rail_2012_path and rail_2022_path in the config.
+  The returned frames are shared between calls, so do not modify them in place.
+  """
+  rail_2012_geo_df = _read_geo_df(rail_2012_path or config.get("rail_2012_path", "/content/2012rail.geojson"))
+  rail_2022_geo_df = _read_geo_df(rail_2022_path or config.get("rail_2022_path", "/content/2022rail.geojson"))
   return rail_2012_geo_df, rail_2022_geo_df
 
+class GeoLayerIndex:
+  """
+  STRtree over the Point, LineString, Polygon and MultiPolygon features of a
+  layer, split by type once, answering the get_num_local_pois_from_geo_df box
+  count (or a radius count) for many points in one bulk query.
+  """
+  geometry_types = ['Point', 'LineString', 'Polygon', 'MultiPolygon']
+
+  def __init__(self, geo_df):
+    geom_types = geo_df.geometry.geom_type
+    layer = geo_df[geom_types.isin(self.geometry_types)]
+    self.type_codes = pd.Categorical(layer.geometry.geom_type, categories=self.geometry_types).codes
+    self.geometries = layer.geometry.values
+    self.tree = shapely.STRtree(self.geometries)
+    self._projected_tree = None
+    self.crs = geo_df.crs
+
+  def count_boxes(self, lats, longs, length=2, by_type=False):
+    """
+    Count the features intersecting the get_box(lat, long, length) box of every point.
+    Returns:
+        ndarray: counts per point, or (points x geometry_types) counts if by_type.
+    """
+    north, south, west, east = get_box(np.asarray(lats, dtype=np.float64), np.asarray(longs, dtype=np.float64), length)
+    point_index, feature_index = self.tree.query(shapely.box(west, south, east, north), predicate="intersects")
+    return self._bincount(point_index, feature_index, len(north), by_type)
+
+  def count_radius(self, lats, longs, radius_km, by_type=False):
+    """
+    Count the features within radius_km of every point, measured in the
+    British National Grid (EPSG:27700).
+    """
+    if self._projected_tree is None:
+      projected = gpd.GeoSeries(self.geometries, crs=self.crs or "EPSG:4326").to_crs("EPSG:27700")
+      self._projected_tree = shapely.STRtree(projected.values)
+    points = gpd.GeoSeries(gpd.points_from_xy(longs, lats), crs="EPSG:4326").to_crs("EPSG:27700")
+    point_index, feature_index = self._projected_tree.query(points.values, predicate="dwithin", distance=radius_km * 1000)
+    return self._bincount(point_index, feature_index, len(points), by_type)
+
+  def _bincount(self, point_index, feature_index, n_points, by_type):
+    if by_type:
+      counts = np.zeros((n_points, len(self.geometry_types)), dtype=np.int64)
+      np.add.at(counts, (point_index, self.type_codes[feature_index]), 1)
+      return counts
+    return np.bincount(point_index, minlength=n_points)
+
+@functools.lru_cache(maxsize=None)
+def get_rail_indexes(rail_2012_path=None, rail_2022_path=None):
+  """ GeoLayerIndexes over the 2012 and 2022 rail layers, built once per process. """
+  rail_2012_geo_df, rail_2022_geo_df = get_rail_geo_dfs(rail_2012_path, rail_2022_path)
+  return GeoLayerIndex(rail_2012_geo_df), GeoLayerIndex(rail_2022_geo_df)
+
 
 def get_num_local_pois_from_geo_df(lat, long, geo_df):
   north, south, west, east = get_box(lat, long, 2)
-  bbox_geom = box(west, south, east, north)
+  bbox_geom = shapely.box(west, south, east, north)
   nodes = geo_df[
     (geo_df.geometry.type == 'Point')
   ] 
@@ -217,9 +804,113 @@ def get_num_local_pois_from_geo_df(lat, long, geo_df):
 def get_diff_rail_count(lat, long, rail_2022_geo_df, rail_2012_geo_df):
   return get_num_local_pois_from_geo_df(lat, long, rail_2022_geo_df) - get_num_local_pois_from_geo_df(lat, long, rail_2012_geo_df)
 
+def get_diff_rail_counts(lats, longs, rail_2022_index=None, rail_2012_index=None, length=2):
+  """
+  get_diff_rail_count for arrays of points, using GeoLayerIndexes (by default
+  the memoized get_rail_indexes).
+  Returns:
+      ndarray: 2022 count minus 2012 count for every point.
+  """
+  if rail_2022_index is None or rail_2012_index is None:
+    rail_2012_index, rail_2022_index = get_rail_indexes()
+  return rail_2022_index.count_boxes(lats, longs, length) - rail_2012_index.count_boxes(lats, longs, length)
+
 def get_df_from_sql_query(query, username, password, url):
-  engine = create_engine(f"mysql+pymysql://{username}:{password}@{url}:{3306}/ads_2024")
-  return pd.read_sql_query(query, engine)
+  with access.engine_connection(access.get_engine(username, password, url)) as conn:
+    return pd.read_sql_query(query, conn)
+
+CATEGORICAL_COLUMNS = ["property_type", "tenure_type", "new_build_flag", "county", "district", "town_city", "country", "record_status"]
+FLOAT32_COLUMNS = ["latitude", "longitude"]
+DATE_COLUMNS = ["date_of_transfer"]
+
+def downcast_df(df):
+  """
+  Shrink a pp_data / postcode_data style frame: categoricals for the low
+  cardinality text columns, float32 coordinates, datetime dates and the
+  smallest integer type that fits.
+  """
+  for column in df.columns:
+    if column in CATEGORICAL_COLUMNS:
+      df[column] = df[column].astype("category")
+    elif column in FLOAT32_COLUMNS:
+      df[column] = df[column].astype(np.float32)
+    elif column in DATE_COLUMNS:
+      df[column] = pd.to_datetime(df[column])
+    elif pd.api.types.is_integer_dtype(df[column]):
+      df[column] = pd.to_numeric(df[column], downcast="integer")
+  return df
+
+def iter_df_from_sql_query(query, username=None, password=None, url=None, chunksize=100_000, params=None, engine=None):
+  """
+  Stream the result of a query through a server-side cursor as downcast
+  DataFrame chunks of at most chunksize rows. Runs on engine if given (e.g.
+  from access.get_engine_for_url), else on the shared engine for the
+  credentials.
+  """
+  engine = engine or access.get_engine(username, password, url)
+  with access.engine_connection(engine) as conn:
+    conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+    for chunk in pd.read_sql_query(query, conn, chunksize=chunksize, params=params):
+      metrics.count("iter_df_from_sql_query.rows", len(chunk))
+      yield downcast_df(chunk)
+
+def iter_df_from_sql(table_name, username=None, password=None, url=None, columns=None, chunksize=100_000, engine=None):
+  """ Streaming get_df_from_sql, optionally selecting only some columns. """
+  query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table_name}"
+  return iter_df_from_sql_query(query, username, password, url, chunksize, engine=engine)
+
+def aggregate_df_chunks(chunks, value_column, by=None):
+  """
+  Count, mean, standard deviation, min and max of value_column (per group of
+  the by columns) over an iterable of chunks, holding only one chunk and
+  the running totals in memory.
+  Returns:
+      DataFrame: one row per group (a single row if by is None).
+  """
+  totals = None
+  for chunk in chunks:
+    values = chunk[value_column].astype(np.float64)
+    frame = pd.DataFrame({"count": values.notna().astype(np.int64), "sum": values, "sum_sq": values ** 2, "min": values, "max": values})
+    if by is None:
+      partial = frame.agg({"count": "sum", "sum": "sum", "sum_sq": "sum", "min": "min", "max": "max"}).to_frame().T
+    else:
+      keys = [chunk[column].astype(object) for column in ([by] if isinstance(by, str) else by)]
+      partial = frame.groupby(keys, observed=True).agg({"count": "sum", "sum": "sum", "sum_sq": "sum", "min": "min", "max": "max"})
+    if totals is None:
+      totals = partial
+    else:
+      combined = pd.concat([totals, partial])
+      totals = combined.groupby(level=list(range(combined.index.nlevels))).agg({"count": "sum", "sum": "sum", "sum_sq": "sum", "min": "min", "max": "max"})
+  if totals is None:
+    return pd.DataFrame(columns=["count", "mean", "std", "min", "max"])
+  result = pd.DataFrame(index=totals.index)
+  result["count"] = totals["count"].astype(np.int64)
+  result["mean"] = totals["sum"] / totals["count"]
+  variance = (totals["sum_sq"] - totals["count"] * result["mean"] ** 2) / (totals["count"] - 1)
+  result["std"] = np.sqrt(variance.clip(lower=0))
+  result["min"] = totals["min"]
+  result["max"] = totals["max"]
+  return result
+
+def compare_sql_read_memory(table_name, username=None, password=None, url=None, value_column="price", chunksize=100_000, engine=None):
+  """
+  Peak Python memory of get_df_from_sql against streaming the same table
+  through aggregate_df_chunks.
+  Returns:
+      dict: {"get_df_from_sql": MB, "streaming": MB}
+  """
+  import tracemalloc
+  results = {}
+  for name, run in [
+      ("get_df_from_sql", lambda: get_df_from_sql(table_name, username, password, url, engine=engine)),
+      ("streaming", lambda: aggregate_df_chunks(iter_df_from_sql(table_name, username, password, url, [value_column], chunksize, engine=engine), value_column)),
+  ]:
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = peak / 2**20
+  return results
 
 def get_num_local_new_builds(new_build_coords_df, lat, long):
   north, south, west, east = get_box(lat, long, 1)
@@ -229,4 +920,91 @@ def get_num_local_new_builds(new_build_coords_df, lat, long):
                             & (new_build_coords_df['longitude'] >= west) 
                             & (new_build_coords_df['longitude'] <= east)
                           ]
-  return len(new_builds_within_bbox)
\ No newline at end of file
+  return len(new_builds_within_bbox)
+
+
+class BoxCountIndex:
+  """
+  Exact count of the points inside many lat/long boxes at once. Points are
+  ranked by latitude and longitude, and a merge-sort tree over the
+  latitude order (one sorted array of longitude ranks per power-of-two
+  block size) answers each box with four dominance counts, each a
+  vectorized searchsorted per level. Boxes use inclusive bounds like
+  get_num_local_new_builds.
+  """
+  def __init__(self, lats, longs):
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    self.n = len(lats)
+    lat_order = np.argsort(lats, kind="stable")
+    self.sorted_lats = lats[lat_order]
+    long_order = np.argsort(longs, kind="stable")
+    self.sorted_longs = longs[long_order]
+    long_ranks = np.empty(self.n, dtype=np.int64)
+    long_ranks[long_order] = np.arange(self.n)
+    long_ranks = long_ranks[lat_order]
+    positions = np.arange(self.n)
+    self.levels = []
+    k = 0
+    while (1 << k) <= self.n:
+      self.levels.append(np.sort((positions >> k) * (self.n + 1) + long_ranks))
+      k += 1
+
+  def _dominance(self, a, c):
+    # Number of points with latitude rank < a and longitude rank < c
+    counts = np.zeros(len(a), dtype=np.int64)
+    for k, keys in enumerate(self.levels):
+      in_prefix = ((a >> k) & 1).astype(bool)
+      block = (a[in_prefix] >> k) - 1
+      counts[in_prefix] += np.searchsorted(keys, block * (self.n + 1) + c[in_prefix], side="left") - block * (1 << k)
+    return counts
+
+  def count(self, north, south, west, east):
+    """ Number of points with south <= lat <= north and west <= long <= east, per box. """
+    a = np.searchsorted(self.sorted_lats, south, side="left")
+    b = np.searchsorted(self.sorted_lats, north, side="right")
+    c = np.searchsorted(self.sorted_longs, west, side="left")
+    d = np.searchsorted(self.sorted_longs, east, side="right")
+    return self._dominance(b, d) - self._dominance(a, d) - self._dominance(b, c) + self._dominance(a, c)
+
+def new_build_indexes(new_build_coords_df, date_windows=None, date_column="date_of_transfer"):
+  """
+  BoxCountIndex over the new builds, or one per date window.
+  Args:
+      date_windows (list): optional (start, end) pairs; only new builds with
+        start <= date_column <= end go into each window's index.
+  Returns:
+      dict: column suffix ("" or "_<start>_<end>") -> BoxCountIndex.
+  """
+  if date_windows is None:
+    return {"": BoxCountIndex(new_build_coords_df['latitude'], new_build_coords_df['longitude'])}
+  dates = pd.to_datetime(new_build_coords_df[date_column])
+  indexes = {}
+  for start, end in date_windows:
+    in_window = ((dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))).to_numpy()
+    indexes[f"_{start}_{end}"] = BoxCountIndex(new_build_coords_df['latitude'].to_numpy()[in_window], new_build_coords_df['longitude'].to_numpy()[in_window])
+  return indexes
+
+def count_new_builds(indexes, lats, longs, lengths=(1,)):
+  """ New builds around each point in boxes of the given lengths, for indexes from new_build_indexes. """
+  lats = np.asarray(lats, dtype=np.float64)
+  longs = np.asarray(longs, dtype=np.float64)
+  counts = {}
+  for length in lengths:
+    north, south, west, east = get_box(lats, longs, length)
+    for suffix, index in indexes.items():
+      counts[f"new_builds_{length}{suffix}"] = index.count(north, south, west, east)
+  return pd.DataFrame(counts)
+
+def get_num_local_new_builds_batch(new_build_coords_df, lats, longs, lengths=(1,), date_windows=None, date_column="date_of_transfer"):
+  """
+  get_num_local_new_builds for many points, box sizes and date windows in one pass.
+  Args:
+      lengths (iterable): box lengths as passed to get_box.
+      date_windows (list): optional (start, end) pairs; only new builds with
+        start <= date_column <= end are counted in each window.
+  Returns:
+      DataFrame: one row per point and a new_builds_<length> column per box
+        length, or new_builds_<length>_<start>_<end> per length and window.
+  """
+  return count_new_builds(new_build_indexes(new_build_coords_df, date_windows, date_column), lats, longs, lengths)
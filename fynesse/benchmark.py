@@ -0,0 +1,489 @@
+# This file contains benchmarks for the fynesse pipeline
+
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .config import *
+from .lazy import lazy_import
+from . import access, assess, metrics
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+gpd = lazy_import("geopandas")
+shapely = lazy_import("shapely")
+osmium = lazy_import("osmium")
+plt = lazy_import("matplotlib.pyplot")
+
+def import_time(module="fynesse", repeats=3):
+    """
+    Cumulative import time of a module in a fresh interpreter, measured with
+    python -X importtime.
+    Args:
+        module (str): module to import.
+        repeats (int): number of fresh interpreters, the fastest is reported.
+    Returns:
+        dict: {"seconds": cumulative import time, "slowest": [(module, self seconds), ...]}
+    """
+    best = None
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                capture_output=True, text=True, check=True)
+        timings = {}
+        for line in result.stderr.splitlines():
+            match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+            if match:
+                timings[match.group(4)] = (int(match.group(1)) / 1e6, int(match.group(2)) / 1e6)
+        seconds = timings[module][1]
+        if best is None or seconds < best["seconds"]:
+            slowest = sorted(((name, self_seconds) for name, (self_seconds, _) in timings.items()), key=lambda item: -item[1])[:10]
+            best = {"seconds": seconds, "slowest": slowest}
+    return best
+
+def check_import_time(module="fynesse", budget_seconds=0.25):
+    """
+    Raise if importing module takes longer than budget_seconds, listing the
+    slowest imports.
+    """
+    result = import_time(module)
+    if result["seconds"] > budget_seconds:
+        slowest = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in result["slowest"])
+        raise AssertionError(f"Importing {module} took {result['seconds']:.3f}s, over the {budget_seconds}s budget (slowest: {slowest})")
+    return result
+
+# Synthetic stand-ins for the pipeline's inputs. Everything sits in a box over
+# England so the spatial densities are roughly realistic at the larger scales.
+
+ENGLAND_BOX = (50.5, 55.0, -3.5, 1.5)
+
+BENCHMARK_TAGS = {"amenity": ["restaurant", "cafe", "school", "pub"], "shop": ["supermarket", "bakery"]}
+
+PROPERTY_TYPES = ["D", "S", "T", "F", "O"]
+
+def _random_points(n, rng):
+    south, north, west, east = ENGLAND_BOX
+    return rng.uniform(south, north, n), rng.uniform(west, east, n)
+
+def synthetic_postcode_data(n_postcodes, seed=0):
+    """
+    Fake postcode_data rows with unique, correctly formatted postcodes.
+    Returns:
+        DataFrame: postcode, country, latitude, longitude.
+    """
+    rng = np.random.default_rng(seed)
+    n = np.arange(n_postcodes)
+    letters = np.array(list("ABDEFGHJLNPQRSTUWXYZ"))
+    postcodes = (pd.Series(n // 4000, dtype=str).radd("CB") + " " + pd.Series((n // 400) % 10, dtype=str)
+                 + letters[(n // 20) % 20] + letters[n % 20])
+    latitudes, longitudes = _random_points(n_postcodes, rng)
+    return pd.DataFrame({"postcode": postcodes.to_numpy(), "country": "England", "latitude": latitudes, "longitude": longitudes})
+
+def synthetic_pp_data(n_transactions, postcode_df, years=(2020,), seed=0):
+    """
+    Fake pp_data rows on the postcodes of postcode_df, spread evenly over years.
+    Returns:
+        DataFrame: the pp_data columns used by the pipeline.
+    """
+    rng = np.random.default_rng(seed)
+    years = np.asarray(years)
+    dates = (pd.to_datetime(pd.Series(years[rng.integers(0, len(years), n_transactions)], dtype=str) + "-01-01")
+             + pd.to_timedelta(rng.integers(0, 365, n_transactions), unit="D"))
+    return pd.DataFrame({
+        "transaction_unique_identifier": [f"{{{n:08X}-0000-0000-0000-000000000000}}" for n in range(n_transactions)],
+        "price": rng.lognormal(12.5, 0.6, n_transactions).astype(np.int64),
+        "date_of_transfer": dates.dt.strftime("%Y-%m-%d").to_numpy(),
+        "postcode": postcode_df["postcode"].to_numpy()[rng.integers(0, len(postcode_df), n_transactions)],
+        "property_type": np.array(PROPERTY_TYPES)[rng.integers(0, len(PROPERTY_TYPES), n_transactions)],
+        "new_build_flag": np.where(rng.random(n_transactions) < 0.1, "Y", "N"),
+        "tenure_type": np.where(rng.random(n_transactions) < 0.75, "F", "L"),
+        "primary_addressable_object_name": rng.integers(1, 200, n_transactions).astype(str),
+        "secondary_addressable_object_name": "",
+        "street": "HIGH STREET",
+        "locality": "",
+        "town_city": "CAMBRIDGE",
+        "district": "CAMBRIDGE",
+        "county": "CAMBRIDGESHIRE",
+        "ppd_category_type": "A",
+        "record_status": "A",
+    })
+
+def synthetic_osm_nodes(n_nodes, tags=None, seed=0):
+    """
+    Fake tagged OSM nodes in the layout of full_england_osm_to_df, with every
+    node carrying one of the features in tags (default BENCHMARK_TAGS).
+    Returns:
+        DataFrame: id, type, latitude, longitude, tags (json).
+    """
+    rng = np.random.default_rng(seed)
+    pairs = [(key, value) for key, values in (tags or BENCHMARK_TAGS).items() for value in values]
+    encoded = np.array([json.dumps({key: value, "name": "x"}) for key, value in pairs])
+    latitudes, longitudes = _random_points(n_nodes, rng)
+    return pd.DataFrame({"id": np.arange(1, n_nodes + 1, dtype=np.int64), "type": "node",
+                         "latitude": latitudes, "longitude": longitudes,
+                         "tags": encoded[rng.integers(0, len(pairs), n_nodes)]})
+
+def synthetic_rail_geo_df(n_features, seed=0):
+    """
+    Fake rail layer in the mix of geometries get_num_local_pois_from_geo_df
+    counts: stations as points, track as short lines, and platforms as small
+    polygons and multipolygons.
+    Returns:
+        GeoDataFrame in EPSG:4326.
+    """
+    rng = np.random.default_rng(seed)
+    latitudes, longitudes = _random_points(n_features, rng)
+    kinds = rng.integers(0, 4, n_features)
+    geometries = np.empty(n_features, dtype=object)
+    points = kinds == 0
+    geometries[points] = shapely.points(longitudes[points], latitudes[points])
+    lines = kinds == 1
+    steps = rng.normal(0, 0.01, (lines.sum(), 2))
+    geometries[lines] = shapely.linestrings(np.stack([np.column_stack([longitudes[lines], latitudes[lines]]),
+                                                      np.column_stack([longitudes[lines] + steps[:, 0], latitudes[lines] + steps[:, 1]])], axis=1))
+    polygons = kinds >= 2
+    boxes = shapely.box(longitudes[polygons], latitudes[polygons], longitudes[polygons] + 0.002, latitudes[polygons] + 0.001)
+    geometries[polygons] = np.where(kinds[polygons] == 3, shapely.multipolygons(boxes[:, None]), boxes)
+    return gpd.GeoDataFrame({"railway": np.array(["station", "rail", "platform", "platform"])[kinds]},
+                            geometry=geometries, crs="EPSG:4326")
+
+def synthetic_buildings(pp_df, postcode_df, match_rate=0.8, seed=0):
+    """
+    Fake OSM buildings for get_merged_df: one building per distinct address
+    in pp_df, of which match_rate carry its house number and postcode.
+    Returns:
+        GeoDataFrame of building points with addr: columns.
+    """
+    rng = np.random.default_rng(seed)
+    addresses = pp_df[["primary_addressable_object_name", "postcode"]].drop_duplicates()
+    coordinates = postcode_df.set_index("postcode").loc[addresses["postcode"]]
+    n = len(addresses)
+    tagged = rng.random(n) < match_rate
+    jitter = rng.normal(0, 0.0005, (n, 2))
+    return gpd.GeoDataFrame({
+        "building": "yes",
+        "addr:housenumber": np.where(tagged, addresses["primary_addressable_object_name"].to_numpy(), None),
+        "addr:street": "High Street",
+        "addr:postcode": np.where(tagged, addresses["postcode"].to_numpy(), None),
+        "addr:city": "Cambridge",
+    }, geometry=gpd.points_from_xy(coordinates["longitude"].to_numpy() + jitter[:, 0], coordinates["latitude"].to_numpy() + jitter[:, 1]), crs="EPSG:4326")
+
+def write_synthetic_pbf(path, nodes_df, untagged_per_tagged=4, seed=0):
+    """
+    Write nodes_df (from synthetic_osm_nodes) to an OSM PBF file, padded with
+    untagged nodes as in a real extract.
+    """
+    rng = np.random.default_rng(seed)
+    next_id = int(nodes_df["id"].max()) + 1 if len(nodes_df) else 1
+    n_untagged = len(nodes_df) * untagged_per_tagged
+    latitudes, longitudes = _random_points(n_untagged, rng)
+    ids = np.concatenate([nodes_df["id"].to_numpy(), np.arange(next_id, next_id + n_untagged)])
+    order = np.argsort(ids)
+    all_latitudes = np.concatenate([nodes_df["latitude"].to_numpy(), latitudes])
+    all_longitudes = np.concatenate([nodes_df["longitude"].to_numpy(), longitudes])
+    all_tags = list(nodes_df["tags"]) + [None] * n_untagged
+    if os.path.exists(path):
+        os.remove(path)
+    writer = osmium.SimpleWriter(path)
+    try:
+        for i in order:
+            tags = json.loads(all_tags[i]) if all_tags[i] is not None else {}
+            writer.add_node(osmium.osm.mutable.Node(id=int(ids[i]), location=(float(all_longitudes[i]), float(all_latitudes[i])), tags=tags))
+    finally:
+        writer.close()
+    return path
+
+class _SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace("%s", "?"), params)
+        return self.cursor.rowcount
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(query.replace("%s", "?"), rows)
+        return self.cursor.rowcount
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class SQLiteConnection:
+    """
+    sqlite3 connection with the parts of the pymysql interface the access
+    helpers use (begin, %s parameters, cursors as context managers and
+    execute returning the row count), as a stand-in database for benchmarks.
+    MySQL-only statements such as LOAD DATA are not supported.
+    """
+    def __init__(self, path=":memory:"):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+
+    def begin(self):
+        self.connection.execute("BEGIN")
+
+    def commit(self):
+        if self.connection.in_transaction:
+            self.connection.execute("COMMIT")
+
+    def rollback(self):
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+
+    def cursor(self, cursor_class=None):
+        return _SQLiteCursor(self.connection.cursor())
+
+    def close(self):
+        self.connection.close()
+
+HOUSING_TABLES = {
+    "pp_data": "transaction_unique_identifier VARCHAR(38), price INT, date_of_transfer DATE, postcode VARCHAR(8), property_type VARCHAR(1), new_build_flag VARCHAR(1), tenure_type VARCHAR(1), primary_addressable_object_name TEXT, secondary_addressable_object_name TEXT, street TEXT, locality TEXT, town_city TEXT, district TEXT, county TEXT, ppd_category_type VARCHAR(2), record_status VARCHAR(2)",
+    "postcode_data": "postcode VARCHAR(8), country TEXT, latitude DECIMAL(11,8), longitude DECIMAL(10,8)",
+    "prices_coordinates_data": "transaction_unique_identifier VARCHAR(38), price INT, date_of_transfer DATE, postcode VARCHAR(8), property_type VARCHAR(1), new_build_flag VARCHAR(1), tenure_type VARCHAR(1), locality TEXT, town_city TEXT, district TEXT, county TEXT, country TEXT, latitude DECIMAL(11,8), longitude DECIMAL(10,8)",
+}
+
+def load_housing_tables(conn, pp_df, postcode_df):
+    """
+    (Re)create pp_data, postcode_data and an empty prices_coordinates_data on
+    conn and fill them from the synthetic frames. This drops existing tables,
+    so only point it at a scratch database.
+    """
+    with conn.cursor() as cur:
+        for table, columns in HOUSING_TABLES.items():
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+            cur.execute(f"CREATE TABLE {table} ({columns})")
+        for table, df in [("pp_data", pp_df), ("postcode_data", postcode_df)]:
+            placeholders = ", ".join(["%s"] * len(df.columns))
+            cur.executemany(f"INSERT INTO {table} ({', '.join(df.columns)}) VALUES ({placeholders})", df.astype(object).itertuples(index=False, name=None))
+    conn.commit()
+    access.create_spatial_indexes(conn)
+
+# Each benchmark sets up its inputs for a scale, untimed, and returns the
+# callable to time and optionally a reset to run (untimed) before every call.
+
+def _bench_pois_count(scale, seed, n_queries=1000, **kwargs):
+    nodes_df = synthetic_osm_nodes(scale, seed=seed)
+    lats, longs = _random_points(n_queries, np.random.default_rng(seed + 1))
+    areas = np.full(n_queries, 1_000_000)
+    return lambda: assess.get_pois_count_df_from_coords(lats, longs, BENCHMARK_TAGS, areas, tag_filtered_osm_nodes_df=nodes_df), None
+
+def _bench_local_pois(scale, seed, n_queries=20, **kwargs):
+    geo_df = synthetic_rail_geo_df(scale, seed=seed)
+    lats, longs = _random_points(n_queries, np.random.default_rng(seed + 1))
+    return lambda: [assess.get_num_local_pois_from_geo_df(lat, long, geo_df) for lat, long in zip(lats, longs)], None
+
+def _bench_local_pois_index(scale, seed, n_queries=20, **kwargs):
+    geo_df = synthetic_rail_geo_df(scale, seed=seed)
+    lats, longs = _random_points(n_queries, np.random.default_rng(seed + 1))
+    return lambda: assess.GeoLayerIndex(geo_df).count_boxes(lats, longs), None
+
+def _bench_merged_df(scale, seed, **kwargs):
+    postcode_df = synthetic_postcode_data(max(scale // 20, 1), seed=seed)
+    pp_df = synthetic_pp_data(scale, postcode_df, seed=seed).merge(postcode_df, on="postcode")
+    buildings = synthetic_buildings(pp_df, postcode_df, seed=seed)
+    return lambda: assess.get_merged_df(pp_df, buildings), None
+
+def _bench_housing_join(scale, seed, connect=None, **kwargs):
+    conn = connect() if connect is not None else SQLiteConnection()
+    postcode_df = synthetic_postcode_data(max(scale // 20, 1), seed=seed)
+    load_housing_tables(conn, synthetic_pp_data(scale, postcode_df, years=(2019, 2020), seed=seed), postcode_df)
+
+    def reset():
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM prices_coordinates_data")
+        conn.commit()
+    return lambda: access.housing_upload_join_data(conn, 2020, partitioned=False), reset
+
+def _bench_osm_to_df(scale, seed, workdir=None, **kwargs):
+    pbf_path = write_synthetic_pbf(os.path.join(workdir, f"synthetic-{scale}.osm.pbf"), synthetic_osm_nodes(scale, seed=seed), seed=seed)
+    return lambda: access.full_england_osm_to_df(pbf_path), None
+
+BENCHMARKS = {
+    "get_pois_count_df_from_coords": (_bench_pois_count, [10_000, 100_000, 1_000_000]),
+    "get_num_local_pois_from_geo_df": (_bench_local_pois, [1_000, 10_000, 100_000]),
+    "GeoLayerIndex.count_boxes": (_bench_local_pois_index, [1_000, 10_000, 100_000]),
+    "get_merged_df": (_bench_merged_df, [10_000, 100_000, 1_000_000]),
+    "housing_upload_join_data": (_bench_housing_join, [10_000, 100_000, 1_000_000]),
+    "full_england_osm_to_df": (_bench_osm_to_df, [10_000, 100_000, 1_000_000]),
+}
+
+def measure(run, repeats=3, reset=None):
+    """
+    Time run() and its peak Python heap. The time is the fastest of repeats
+    untraced calls; the memory comes from one extra call under tracemalloc,
+    so tracing does not slow the timed calls.
+    Returns:
+        dict: {"seconds", "peak_mb"}
+    """
+    times = []
+    for _ in range(repeats):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 2**20}
+
+def instrumentation_overhead(name, scale, repeats=5, seed=0, connect=None):
+    """
+    Relative cost of fynesse.metrics on one of the BENCHMARKS: the fastest
+    instrumented time over the fastest uninstrumented time, minus one.
+    Spans cost a fixed few tens of microseconds each, so at small scales
+    (a few ms per call) this overstates the overhead, and run-to-run noise
+    is several percent. Instrumentation is left in the state it was found.
+    """
+    was_enabled = metrics.enabled()
+    with tempfile.TemporaryDirectory(prefix="fynesse-bench-") as workdir, contextlib.redirect_stdout(io.StringIO()):
+        run, reset = BENCHMARKS[name][0](scale, seed, connect=connect, workdir=workdir)
+        metrics.disable()
+        disabled = measure(run, repeats, reset)["seconds"]
+        metrics.enable(json_logs=False)
+        enabled = measure(run, repeats, reset)["seconds"]
+    if not was_enabled:
+        metrics.disable()
+    return enabled / disabled - 1
+
+def scaling_exponent(scales, values):
+    """
+    Slope of log(values) against log(scales): about 1 for linear scaling,
+    2 for quadratic, and near 0 when the cost is dominated by fixed overheads.
+    """
+    scales = np.asarray(scales, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    keep = (scales > 0) & (values > 0)
+    if keep.sum() < 2:
+        return None
+    return float(np.polyfit(np.log(scales[keep]), np.log(values[keep]), 1)[0])
+
+def git_commit():
+    """ Short hash of the checked out commit, with a -dirty suffix for local changes, or None outside git. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+def run_benchmarks(names=None, scales=None, repeats=3, seed=0, output_path=None, connect=None):
+    """
+    Run the named BENCHMARKS (default all) over their scales and write the
+    results to JSON, so runs on different commits can be compared with
+    compare_benchmarks.
+    Args:
+        names (list): benchmark names, keys of BENCHMARKS.
+        scales (list): input sizes to use for every benchmark instead of their defaults.
+        repeats (int): timed calls per scale, the fastest is kept.
+        seed (int): seed for the synthetic data.
+        output_path (str): where to write the JSON, by default
+            <benchmark_dir>/<commit>.json with benchmark_dir from the config.
+        connect (callable): returns a pymysql connection to a scratch MariaDB
+            database for housing_upload_join_data; an in-memory SQLite
+            stand-in is used otherwise.
+    Returns:
+        dict: the run metadata and, per benchmark, the scales, seconds,
+        peak_mb and their scaling exponents.
+    """
+    commit = git_commit()
+    results = {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+               "platform": platform.platform(), "seed": seed, "repeats": repeats, "benchmarks": {}}
+    with tempfile.TemporaryDirectory(prefix="fynesse-bench-") as workdir:
+        for name in names or BENCHMARKS:
+            setup, default_scales = BENCHMARKS[name]
+            curve = {"scales": [], "seconds": [], "peak_mb": []}
+            for scale in scales or default_scales:
+                print(f"Benchmarking {name} at scale {scale}")
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run, reset = setup(scale, seed, connect=connect, workdir=workdir)
+                    measured = measure(run, repeats, reset)
+                curve["scales"].append(scale)
+                curve["seconds"].append(measured["seconds"])
+                curve["peak_mb"].append(measured["peak_mb"])
+                print(f"  {measured['seconds']:.4f}s, peak {measured['peak_mb']:.1f} MB")
+            curve["time_exponent"] = scaling_exponent(curve["scales"], curve["seconds"])
+            curve["memory_exponent"] = scaling_exponent(curve["scales"], curve["peak_mb"])
+            results["benchmarks"][name] = curve
+    results["peak_rss_mb"] = access.peak_rss_mb()
+
+    if output_path is None:
+        output_path = os.path.join(config.get("benchmark_dir", "benchmarks"), f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results written to {output_path}")
+    return results
+
+def _load_results(results):
+    if isinstance(results, dict):
+        return results
+    with open(results) as f:
+        return json.load(f)
+
+def compare_benchmarks(baseline, current, tolerance=0.2):
+    """
+    Compare two run_benchmarks results (dicts or JSON paths) at the scales
+    they share.
+    Args:
+        tolerance (float): relative slowdown (or memory growth) above which a
+            row is flagged as a regression.
+    Returns:
+        list: one dict per (benchmark, scale) with the baseline and current
+        seconds and peak_mb, their ratios and a regression flag.
+    """
+    baseline = _load_results(baseline)
+    current = _load_results(current)
+    rows = []
+    for name, curve in current["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        base_curve = baseline["benchmarks"][name]
+        base_by_scale = {scale: i for i, scale in enumerate(base_curve["scales"])}
+        for i, scale in enumerate(curve["scales"]):
+            if scale not in base_by_scale:
+                continue
+            j = base_by_scale[scale]
+            time_ratio = curve["seconds"][i] / base_curve["seconds"][j] if base_curve["seconds"][j] else None
+            memory_ratio = curve["peak_mb"][i] / base_curve["peak_mb"][j] if base_curve["peak_mb"][j] else None
+            rows.append({"benchmark": name, "scale": scale,
+                         "baseline_seconds": base_curve["seconds"][j], "seconds": curve["seconds"][i], "time_ratio": time_ratio,
+                         "baseline_peak_mb": base_curve["peak_mb"][j], "peak_mb": curve["peak_mb"][i], "memory_ratio": memory_ratio,
+                         "regression": any(ratio is not None and ratio > 1 + tolerance for ratio in (time_ratio, memory_ratio))})
+    return rows
+
+def plot_scaling(*results, metric="seconds"):
+    """ Log-log scaling curves of one or more run_benchmarks results, one panel per benchmark. """
+    results = [_load_results(r) for r in results]
+    names = list(dict.fromkeys(name for r in results for name in r["benchmarks"]))
+    fig, axes = plt.subplots(1, len(names), figsize=(4 * len(names), 4), squeeze=False)
+    for ax, name in zip(axes[0], names):
+        for r in results:
+            if name in r["benchmarks"]:
+                curve = r["benchmarks"][name]
+                ax.loglog(curve["scales"], curve[metric], marker="o", label=r.get("commit") or "results")
+        ax.set_title(name, fontsize=9)
+        ax.set_xlabel("scale")
+        ax.set_ylabel(metric)
+        ax.legend()
+    plt.tight_layout()
+    plt.show()
@@ -1,35 +1,64 @@
 import os
-import yaml
+from collections.abc import Mapping
 
 default_file = os.path.join(os.path.dirname(__file__), "defaults.yml")
 local_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "machine.yml"))
 user_file = '_config.yml'
 
-config = {}
-
-if os.path.exists(default_file):
-    with open(default_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(local_file):
-    with open(local_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(user_file):
-    with open(user_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if config=={}:
-    raise ValueError(
-        "No configuration file found at either "
-        + user_file
-        + " or "
-        + local_file
-        + " or "
-        + default_file
-        + "."
-    )
-
-for key, item in config.items():
-    if item is str:
-        config[key] = os.path.expandvars(item)
+def load_config():
+    """Read and merge the default, machine and user configuration files."""
+    import yaml
+
+    loaded = {}
+
+    if os.path.exists(default_file):
+        with open(default_file) as file:
+            loaded.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(local_file):
+        with open(local_file) as file:
+            loaded.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(user_file):
+        with open(user_file) as file:
+            loaded.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if loaded=={}:
+        raise ValueError(
+            "No configuration file found at either "
+            + user_file
+            + " or "
+            + local_file
+            + " or "
+            + default_file
+            + "."
+        )
+
+    for key, item in loaded.items():
+        if item is str:
+            loaded[key] = os.path.expandvars(item)
+    return loaded
+
+class LazyConfig(Mapping):
+    """Configuration mapping that reads the files on first access and keeps the result."""
+    def __init__(self):
+        self._config = None
+
+    def _load(self):
+        if self._config is None:
+            self._config = load_config()
+        return self._config
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+config = LazyConfig()
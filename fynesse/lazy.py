@@ -0,0 +1,32 @@
+import importlib
+import sys
+
+# Heavy dependencies are bound to LazyModule stand-ins so that importing
+# fynesse stays cheap; each module is imported the first time it is used.
+
+class LazyModule:
+    """ Stand-in for a module that is imported on first attribute access. """
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+def lazy_import(name):
+    """ A LazyModule for name, or the module itself if it is already imported. """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
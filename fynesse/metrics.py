@@ -0,0 +1,264 @@
+import json
+import logging
+import math
+import sys
+import threading
+import time
+
+from .config import *
+
+# Opt-in instrumentation for the long-running jobs. Spans time a stage and
+# count the rows and bytes it handled; counters accumulate totals. Both go to
+# the in-process registry, and finished spans are logged as structured records
+# on the "fynesse" logger. Spans are placed per stage or per batch, never per
+# row, and when instrumentation is off span() returns a shared no-op object,
+# so the disabled cost is one flag check.
+
+logger = logging.getLogger("fynesse")
+
+_state = {"enabled": None}
+_local = threading.local()
+
+def enabled():
+    """ Whether instrumentation is on, by default from instrumentation in the config. """
+    if _state["enabled"] is None:
+        _state["enabled"] = bool(config.get("instrumentation", False))
+    return _state["enabled"]
+
+def enable(json_logs=True, stream=None, level=logging.INFO):
+    """
+    Turn instrumentation on.
+    Args:
+        json_logs (bool): also write every finished span as a JSON line.
+        stream: where the JSON lines go, stderr by default.
+        level (int): level of the fynesse logger.
+    """
+    _state["enabled"] = True
+    logger.setLevel(level)
+    if json_logs and not any(isinstance(handler.formatter, JSONFormatter) for handler in logger.handlers):
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(JSONFormatter())
+        logger.addHandler(handler)
+
+def disable():
+    """ Turn instrumentation off and remove the JSON log handlers added by enable. """
+    _state["enabled"] = False
+    for handler in [h for h in logger.handlers if isinstance(h.formatter, JSONFormatter)]:
+        logger.removeHandler(handler)
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB, or 0.0 where it can't be read. """
+    try:
+        # resource is Unix only
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return 0.0
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / 2**20
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a log record as one JSON object, merging in its metrics fields. """
+    def format(self, record):
+        payload = {"time": round(record.created, 6), "level": record.levelname, "logger": record.name, "event": record.getMessage()}
+        payload.update(getattr(record, "metrics", {}))
+        return json.dumps(payload, default=str)
+
+class MetricsRegistry:
+    """
+    Thread-safe totals per span name (calls, seconds, min and max seconds,
+    rows, bytes and errors) and per counter name, plus the peak RSS seen.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.peak_rss_mb = 0.0
+
+    def record_span(self, name, seconds, rows=0, bytes=0, error=False, rss_mb=0.0):
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = {"calls": 0, "seconds": 0.0, "min_seconds": math.inf, "max_seconds": 0.0, "rows": 0, "bytes": 0, "errors": 0}
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["min_seconds"] = min(stats["min_seconds"], seconds)
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rows"] += rows
+            stats["bytes"] += bytes
+            stats["errors"] += error
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: {"spans": {name: stats}, "counters": {...}, "peak_rss_mb": float},
+            with rows_per_second and mb_per_second added to every span.
+        """
+        with self.lock:
+            spans = {}
+            for name, stats in self.spans.items():
+                stats = dict(stats)
+                stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+                stats["mb_per_second"] = stats["bytes"] / 2**20 / stats["seconds"] if stats["seconds"] else 0.0
+                spans[name] = stats
+            return {"spans": spans, "counters": dict(self.counters), "peak_rss_mb": self.peak_rss_mb}
+
+    def dump(self, path):
+        """ Write to_dict() to a JSON file. """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+registry = MetricsRegistry()
+
+class Span:
+    """
+    Times one stage. Use as a context manager; add(rows=..., bytes=..., **fields)
+    while it runs to record what it processed. Nested spans record their parent.
+    """
+    __slots__ = ("name", "fields", "rows", "bytes", "start", "parent")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows=0, bytes=0, **fields):
+        self.rows += rows
+        self.bytes += bytes
+        self.fields.update(fields)
+        return self
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        # getrusage is a syscall, so only top-level spans read the peak RSS
+        rss_mb = peak_rss_mb() if self.parent is None else 0.0
+        registry.record_span(self.name, seconds, self.rows, self.bytes, exc_type is not None, rss_mb)
+        # Skip building the record when nothing would handle it
+        if not logger.hasHandlers() or not logger.isEnabledFor(logging.INFO):
+            return False
+        record = {"span": self.name, "parent": self.parent, "seconds": round(seconds, 6), "rows": self.rows, "bytes": self.bytes}
+        if self.parent is None:
+            record["peak_rss_mb"] = round(rss_mb, 1)
+        if self.rows and seconds:
+            record["rows_per_second"] = round(self.rows / seconds, 1)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        record.update(self.fields)
+        logger.info(self.name, extra={"metrics": record})
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add(self, rows=0, bytes=0, **fields):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name, **fields):
+    """
+    Context manager timing the stage name, e.g.
+        with metrics.span("housing_upload_join_data.insert", year=year) as s:
+            s.add(rows=cur.execute(...))
+    A no-op when instrumentation is disabled.
+    """
+    if not enabled():
+        return _NULL_SPAN
+    return Span(name, fields)
+
+def count(name, value=1):
+    """ Add value to the counter name when instrumentation is enabled. """
+    if enabled():
+        registry.increment(name, value)
+
+def record(name, seconds, rows=0, bytes=0, **fields):
+    """
+    Record a stage timed elsewhere, e.g. in a worker process, as if it had
+    run in a span. A no-op when instrumentation is disabled.
+    """
+    if not enabled():
+        return
+    registry.record_span(name, seconds, rows, bytes)
+    entry = {"span": name, "parent": None, "seconds": round(seconds, 6), "rows": rows, "bytes": bytes}
+    entry.update(fields)
+    logger.info(name, extra={"metrics": entry})
+
+def instrument_engine(engine):
+    """
+    Time every statement run through a SQLAlchemy engine as a "db.query"
+    span, with the statement verb and the rows reported by the cursor. The
+    time is the execute call; rows fetched later by the caller are not
+    included, and SELECTs usually report no row count.
+    """
+    import sqlalchemy
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("fynesse_query_start", []).append(time.perf_counter() if enabled() else None)
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["fynesse_query_start"].pop()
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        rows = max(cursor.rowcount, 0)
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        registry.record_span("db.query", seconds, rows, rss_mb=0.0)
+        registry.record_span(f"db.query.{verb.lower()}", seconds, rows, rss_mb=0.0)
+        logger.info("db.query", extra={"metrics": {"span": "db.query", "verb": verb, "seconds": round(seconds, 6), "rows": rows, "statement": statement[:200]}})
+
+    def handle_error(context):
+        if context.connection is not None:
+            stack = context.connection.info.get("fynesse_query_start")
+            if stack:
+                stack.pop()
+        if enabled():
+            registry.increment("db.query.errors")
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", handle_error)
+    return engine
+
+def snapshot():
+    """ The registry as a dict, see MetricsRegistry.to_dict. """
+    return registry.to_dict()
+
+def dump(path):
+    """ Write the registry to a JSON file. """
+    return registry.dump(path)
+
+def reset():
+    """ Clear the registry. """
+    registry.reset()
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, benchmark
+
+COLUMNS = ["L15 Full-time students", "L13 Routine occupations"]
+
+def raw_census():
+    return pd.read_csv(access.census_csv_path("ts062", "msoa"), dtype={"geography code": str}).set_index("geography code")
+
+def raw_column(raw, name):
+    return raw[next(column for column in raw.columns if column.endswith(name))]
+
+def test_load_census_caches_once(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "census")
+    census = access.load_census("ts062", columns=COLUMNS, cache_dir=cache_dir)
+    assert list(census.columns) == COLUMNS
+    assert census.index.name == "geography_code"
+    assert (census.dtypes == np.int32).all()
+    raw = raw_census()
+    assert census.loc["E02000001", COLUMNS[0]] == raw_column(raw, COLUMNS[0])["E02000001"]
+    assert len(os.listdir(cache_dir)) == 1
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError("census csv parsed again")
+    monkeypatch.setattr(pd, "read_csv", no_parsing)
+    again = access.load_census("ts062", columns=COLUMNS[:1], cache_dir=cache_dir)
+    assert list(again.columns) == COLUMNS[:1]
+    pd.testing.assert_series_equal(again[COLUMNS[0]], census[COLUMNS[0]])
+    assert "Total" in access.load_census("ts062", cache_dir=cache_dir).columns
+    assert len(os.listdir(cache_dir)) == 1
+
+def test_join_census_features(tmp_path):
+    df = pd.DataFrame({"msoa21cd": ["E02000002", "unknown", "E02000001", None]})
+    joined = access.join_census_features(df, "ts062", columns=COLUMNS, proportions=True, cache_dir=str(tmp_path))
+    raw = raw_census()
+    total = raw_column(raw, "All usual residents aged 16 years and over")
+    for column in COLUMNS:
+        expected = raw_column(raw, column) / total
+        values = joined[f"ts062_{column}"]
+        assert values[0] == pytest.approx(expected["E02000002"])
+        assert values[2] == pytest.approx(expected["E02000001"])
+        assert np.isnan(values[1]) and np.isnan(values[3])
+    assert list(joined["msoa21cd"][:3]) == ["E02000002", "unknown", "E02000001"]
+
+def test_attach_postcode_areas(mariadb_conn, tmp_path):
+    conn = mariadb_conn
+    postcode_df = benchmark.synthetic_postcode_data(20, seed=8)
+    benchmark.load_housing_tables(conn, benchmark.synthetic_pp_data(10, postcode_df, seed=8), postcode_df)
+    # Half of postcode_data is in the lookup, which also has a postcode postcode_data lacks
+    lookup = pd.DataFrame({"pcd7": "", "pcd8": "", "pcds": list(postcode_df["postcode"][::2]) + ["ZZ1 1ZZ"]})
+    lookup["oa21cd"] = [f"E{n:08d}" for n in range(len(lookup))]
+    lookup["lsoa21cd"] = [f"E01{n:06d}" for n in range(len(lookup))]
+    lookup["msoa21cd"] = [f"E02{n // 3:06d}" for n in range(len(lookup))]
+    lookup_csv_path = tmp_path / "PCD_OA21_LSOA21_MSOA21_LAD.csv"
+    lookup.to_csv(lookup_csv_path, index=False)
+    for _ in range(2):
+        access.attach_postcode_areas(conn, str(lookup_csv_path))
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT postcode, lsoa21cd, msoa21cd FROM postcode_data")
+        attached = pd.DataFrame(list(cur.fetchall()), columns=["postcode", "lsoa21cd", "msoa21cd"]).set_index("postcode")
+    assert len(attached) == len(postcode_df)
+    expected = lookup.set_index("pcds")[["lsoa21cd", "msoa21cd"]].reindex(attached.index)
+    assert expected["lsoa21cd"].notna().sum() == len(postcode_df[::2])
+    pd.testing.assert_frame_equal(attached, expected, check_names=False)
@@ -0,0 +1,130 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+from fynesse import access
+
+BODY = bytes(range(256)) * 400
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves BODY at any .csv path with an ETag, honouring If-None-Match and
+        (If-)Range. With truncate set, the connection drops after that many bytes. """
+    body = BODY
+    etag = '"v1"'
+    truncate = None
+
+    def do_GET(self):
+        if not self.path.endswith(".csv"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.body
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range", self.etag) == self.etag:
+            offset = int(byte_range.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            body = body[offset:]
+        else:
+            self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.truncate is not None:
+            self.wfile.write(body[:self.truncate])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    StandInHandler.body = BODY
+    StandInHandler.etag = '"v1"'
+    StandInHandler.truncate = None
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_fresh_then_unchanged(server, tmp_path):
+    session = access.get_http_session()
+    path = str(tmp_path / "pp.csv")
+    first = access.download_file(session, server + "/pp.csv", path)
+    assert first["status"] == "downloaded"
+    assert first["bytes"] == len(BODY)
+    assert first["sha256"] == hashlib.sha256(BODY).hexdigest()
+    second = access.download_file(session, server + "/pp.csv", path)
+    assert second["status"] == "unchanged"
+    assert second["bytes"] == 0
+
+def test_resume_partial(server, tmp_path):
+    session = access.get_http_session()
+    path = str(tmp_path / "pp.csv")
+    with open(path + ".part", "wb") as file:
+        file.write(BODY[:1000])
+    with open(path + ".part.meta.json", "w") as file:
+        file.write('{"etag": "\\"v1\\""}')
+    result = access.download_file(session, server + "/pp.csv", path)
+    assert result["status"] == "resumed"
+    assert result["bytes"] == len(BODY) - 1000
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    assert result["sha256"] == hashlib.sha256(BODY).hexdigest()
+
+def test_changed_file_replaces_stale_partial(server, tmp_path):
+    session = access.get_http_session()
+    path = str(tmp_path / "pp.csv")
+    with open(path + ".part", "wb") as file:
+        file.write(b"stale" * 100)
+    with open(path + ".part.meta.json", "w") as file:
+        file.write('{"last_modified": "Mon, 01 Jan 2024 00:00:00 GMT"}')
+    result = access.download_file(session, server + "/pp.csv", path)
+    assert result["status"] == "downloaded"
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+
+def test_interrupted_redownload_is_not_unchanged(server, tmp_path):
+    session = access.get_http_session(retries=0)
+    path = str(tmp_path / "pp.csv")
+    assert access.download_file(session, server + "/pp.csv", path)["status"] == "downloaded"
+    body_v2 = BODY[::-1]
+    StandInHandler.body = body_v2
+    StandInHandler.etag = '"v2"'
+    StandInHandler.truncate = 1000
+    with pytest.raises(Exception):
+        access.download_file(session, server + "/pp.csv", path, chunk_size=100)
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    StandInHandler.truncate = None
+    result = access.download_file(session, server + "/pp.csv", path)
+    assert result["status"] == "resumed"
+    with open(path, "rb") as file:
+        assert file.read() == body_v2
+    assert result["sha256"] == hashlib.sha256(body_v2).hexdigest()
+    assert access.download_file(session, server + "/pp.csv", path)["status"] == "unchanged"
+
+def test_price_paid_manifest_survives_errors(server, tmp_path, monkeypatch):
+    download_file = access.download_file
+
+    def flaky(session, url, path, *args, **kwargs):
+        if "2021-part2" in url:
+            raise ConnectionError("boom")
+        return download_file(session, url, path, *args, **kwargs)
+    monkeypatch.setattr(access, "download_file", flaky)
+    data_dir = str(tmp_path / "new" / "dir")
+    manifest = access.download_price_paid_data(2020, 2022, base_url=server, data_dir=data_dir, max_workers=2)
+    statuses = {(result["year"], result["part"]): result["status"] for result in manifest}
+    assert statuses[(2021, 2)] == "error: boom"
+    assert [status for key, status in statuses.items() if key != (2021, 2)] == ["downloaded"] * 3
+    assert os.path.exists(os.path.join(data_dir, "pp-2020-part1.csv"))
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+import sqlalchemy
+
+from fynesse import access
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    access.dispose_engines()
+    yield
+    access.dispose_engines()
+
+def test_registry_reuses_engines(tmp_path):
+    url = f"sqlite:///{tmp_path / 'a.db'}"
+    engine = access.get_engine_for_url(url)
+    assert access.get_engine_for_url(url) is engine
+    assert access.get_engine_for_url(f"sqlite:///{tmp_path / 'b.db'}") is not engine
+    assert len(access.engine_stats()) == 2
+
+def test_checkout_and_active_counters(tmp_path):
+    url = f"sqlite:///{tmp_path / 'a.db'}"
+    engine = access.get_engine_for_url(url)
+    with access.engine_connection(engine) as conn:
+        assert conn.execute(sqlalchemy.text("SELECT 1")).scalar() == 1
+        stats = access.engine_stats()[url]
+        assert stats["active"] == 1
+        assert stats["checkouts"] == 1
+        assert stats["connections"] == 1
+    with access.engine_connection(engine):
+        pass
+    stats = access.engine_stats()[url]
+    assert stats["active"] == 0
+    assert stats["checkouts"] == 2
+    assert stats["checkout_wait_seconds"] >= 0
+
+def test_counters_under_concurrent_checkouts(tmp_path):
+    url = f"sqlite:///{tmp_path / 'a.db'}"
+    engine = access.get_engine_for_url(url, pool_size=4, max_overflow=4)
+
+    def work():
+        for _ in range(50):
+            with access.engine_connection(engine) as conn:
+                conn.execute(sqlalchemy.text("SELECT 1"))
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = access.engine_stats()[url]
+    assert stats["checkouts"] == 400
+    assert stats["active"] == 0
+
+def test_dispose_engines_empties_registry(tmp_path):
+    url = f"sqlite:///{tmp_path / 'a.db'}"
+    engine = access.get_engine_for_url(url)
+    with access.engine_connection(engine):
+        pass
+    access.dispose_engines()
+    assert access.engine_stats() == {}
+    assert access.get_engine_for_url(url) is not engine
+
+def test_batch_helpers_raise_on_bad_connection():
+    # Nothing listens on port 1
+    with pytest.raises(ConnectionError, match="Error connecting"):
+        access.housing_upload_join_data_years("user", "password", "127.0.0.1", "db", [2020], port=1)
+    assert access.create_connection("user", "password", "127.0.0.1", "db", port=1) is None
@@ -0,0 +1,121 @@
+import pandas as pd
+import pytest
+
+from fynesse import access, benchmark
+
+LEGACY_PRICES_COORDINATES = "price INT, date_of_transfer DATE, postcode VARCHAR(8), property_type VARCHAR(1), new_build_flag VARCHAR(1), tenure_type VARCHAR(1), locality TEXT, town_city TEXT, district TEXT, county TEXT, country TEXT, latitude DECIMAL(11,8), longitude DECIMAL(10,8), db_id INTEGER PRIMARY KEY AUTOINCREMENT"
+
+@pytest.fixture
+def conn():
+    conn = benchmark.SQLiteConnection()
+    postcode_df = benchmark.synthetic_postcode_data(50, seed=0)
+    benchmark.load_housing_tables(conn, benchmark.synthetic_pp_data(1000, postcode_df, years=(2019, 2020), seed=0), postcode_df)
+    yield conn
+    conn.close()
+
+def expected_rows(conn, year):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM pp_data AS pp INNER JOIN postcode_data AS po ON pp.postcode = po.postcode WHERE date_of_transfer BETWEEN %s AND %s", (f"{year}-01-01", f"{year}-12-31"))
+        return cur.fetchone()[0]
+
+def year_rows(conn, year):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM prices_coordinates_data WHERE date_of_transfer BETWEEN %s AND %s", (f"{year}-01-01", f"{year}-12-31"))
+        return cur.fetchone()[0]
+
+def year_df(conn, year):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {access.PRICES_COORDINATES_COLUMNS} FROM prices_coordinates_data WHERE date_of_transfer BETWEEN %s AND %s ORDER BY transaction_unique_identifier", (f"{year}-01-01", f"{year}-12-31"))
+        return pd.DataFrame(list(cur.fetchall()), columns=access.PRICES_COORDINATES_COLUMNS.split(", "))
+
+def test_reload_is_idempotent(conn):
+    assert access.prices_coordinates_layout(conn)[0] == access.PRICES_COORDINATES_COLUMNS
+    for _ in range(2):
+        stats = access.housing_upload_join_data(conn, 2020, partitioned=False)
+    assert stats["rows"] == year_rows(conn, 2020) == expected_rows(conn, 2020) > 0
+    assert year_rows(conn, 2019) == 0
+    assert access.get_watermarks(conn).loc[2020, "row_count"] == stats["rows"]
+
+def test_legacy_table_without_transaction_id(conn):
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE prices_coordinates_data")
+        cur.execute(f"CREATE TABLE prices_coordinates_data ({LEGACY_PRICES_COORDINATES})")
+    assert access.prices_coordinates_layout(conn) == (access.LEGACY_PRICES_COORDINATES_COLUMNS, access.LEGACY_HOUSING_JOIN_QUERY)
+    for _ in range(2):
+        access.housing_upload_join_data(conn, 2019, partitioned=False)
+    assert year_rows(conn, 2019) == expected_rows(conn, 2019) > 0
+    with pytest.raises(ValueError, match="transaction_unique_identifier"):
+        access.apply_price_paid_update(conn, "unused.csv")
+
+@pytest.mark.parametrize("partitioned", [False, True])
+def test_stream_mode_matches_server_mode(mariadb_conn, partitioned):
+    conn = mariadb_conn
+    postcode_df = benchmark.synthetic_postcode_data(200, seed=1)
+    benchmark.load_housing_tables(conn, benchmark.synthetic_pp_data(5000, postcode_df, years=(2019, 2020), seed=1), postcode_df)
+    if partitioned:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE prices_coordinates_data")
+        access.create_prices_coordinates_table(conn, 2019, 2020)
+    for _ in range(2):
+        stats = access.housing_upload_join_data(conn, 2020, mode="stream", chunk_size=1000, partitioned=partitioned)
+    assert stats["rows"] == year_rows(conn, 2020) == expected_rows(conn, 2020) > 0
+    assert (stats["partition"] == "p2020") == partitioned
+    assert year_rows(conn, 2019) == 0
+    assert access.get_watermarks(conn).loc[2020, "source"] == "reload (stream)"
+
+    streamed = year_df(conn, 2020)
+    access.housing_upload_join_data(conn, 2020, mode="server", partitioned=partitioned)
+    pd.testing.assert_frame_equal(streamed, year_df(conn, 2020))
+
+def table_df(conn, table, columns):
+    """ table ordered by transaction id, with dates as strings and coordinates as floats. """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY transaction_unique_identifier")
+        df = pd.DataFrame(list(cur.fetchall()), columns=columns)
+    df["date_of_transfer"] = df["date_of_transfer"].astype(str)
+    for column in ["latitude", "longitude"]:
+        if column in df:
+            df[column] = df[column].astype(float)
+    return df
+
+def test_update_file_applied_twice(mariadb_conn, tmp_path):
+    conn = mariadb_conn
+    postcode_df = benchmark.synthetic_postcode_data(200, seed=2)
+    pp_df = benchmark.synthetic_pp_data(2000, postcode_df, years=(2019, 2020), seed=2)
+    benchmark.load_housing_tables(conn, pp_df, postcode_df)
+    with conn.cursor() as cur:
+        for table in ["prices_coordinates_data", "prices_coordinates_watermarks", "pp_update_log"]:
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+    access.create_prices_coordinates_table(conn, 2019, 2021)
+    for year in [2019, 2020]:
+        access.housing_upload_join_data(conn, year)
+
+    in_2019 = pp_df.index[pp_df["date_of_transfer"].str.startswith("2019")]
+    in_2020 = pp_df.index[pp_df["date_of_transfer"].str.startswith("2020")]
+    added = pp_df.loc[[0]].assign(transaction_unique_identifier="{FFFFFFFF-0000-0000-0000-000000000000}", date_of_transfer="2021-03-01")
+    repriced = pp_df.loc[[in_2020[0]]].assign(price=pp_df.loc[in_2020[0], "price"] + 1000, record_status="C")
+    moved = pp_df.loc[[in_2019[0]]].assign(date_of_transfer="2020-06-15", record_status="C")
+    deleted = pp_df.loc[[in_2020[1]]].assign(record_status="D")
+    update_df = pd.concat([added, repriced, moved, deleted])
+    csv_path = tmp_path / "pp-monthly-update.csv"
+    update_df.assign(date_of_transfer=update_df["date_of_transfer"] + " 00:00").to_csv(csv_path, header=False, index=False)
+
+    expected_pp = pd.concat([pp_df.drop(index=[in_2020[0], in_2019[0], in_2020[1]]), added, repriced, moved])
+    expected_pp = expected_pp.sort_values("transaction_unique_identifier").reset_index(drop=True)
+    expected_pcd = expected_pp.merge(postcode_df, on="postcode")[access.PRICES_COORDINATES_COLUMNS.split(", ")]
+    expected_pcd = expected_pcd.sort_values("transaction_unique_identifier").reset_index(drop=True)
+
+    stats = access.apply_price_paid_update(conn, str(csv_path), batch_size=3, update_id="update-1")
+    assert (stats["added"], stats["changed"], stats["removed"]) == (1, 2, 1)
+    assert (stats["inserted"], stats["deleted"]) == (3, 3)
+    assert stats["years"] == [2019, 2020, 2021]
+    assert access.apply_price_paid_update(conn, str(csv_path), update_id="update-1")["status"] == "already applied"
+    # Replaying the same records under another id must leave the same rows
+    access.apply_price_paid_update(conn, str(csv_path), update_id="update-2")
+
+    pd.testing.assert_frame_equal(table_df(conn, "pp_data", access.PP_DATA_COLUMNS), expected_pp, check_dtype=False)
+    pd.testing.assert_frame_equal(table_df(conn, "prices_coordinates_data", access.PRICES_COORDINATES_COLUMNS.split(", ")), expected_pcd, check_dtype=False)
+    watermarks = access.get_watermarks(conn)
+    for year in [2019, 2020, 2021]:
+        assert watermarks.loc[year, "row_count"] == expected_pcd["date_of_transfer"].str.startswith(str(year)).sum()
+        assert watermarks.loc[year, "last_update_id"] == "update-2"
@@ -0,0 +1,107 @@
+import types
+
+import geopandas as gpd
+import numpy as np
+import pytest
+
+from fynesse import access
+
+def make_world():
+    longs, lats = np.meshgrid(np.linspace(0, 1, 41), np.linspace(52, 53, 41))
+    n = longs.size
+    amenities = np.array(["cafe", "school", "pub"])[np.arange(n) % 3]
+    return gpd.GeoDataFrame({"amenity": amenities}, geometry=gpd.points_from_xy(longs.ravel(), lats.ravel()), crs="EPSG:4326")
+
+WORLD = make_world()
+
+@pytest.fixture
+def fetches(serve_osm):
+    return serve_osm(WORLD)
+
+def test_superset_hit_filters_tags(fetches, tmp_path):
+    cache = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=3600, offline=False)
+    cache.features_from_bbox(52.8, 52.2, 0.8, 0.2, {"amenity": ["cafe", "school"]})
+    pois = cache.features_from_bbox(52.6, 52.4, 0.6, 0.4, {"amenity": "cafe"})
+    assert len(fetches) == 1
+    assert cache.hits == 1
+    assert len(pois) > 0
+    assert set(pois["amenity"]) == {"cafe"}
+    expected = WORLD.cx[0.4:0.6, 52.4:52.6]
+    assert len(pois) == (expected["amenity"] == "cafe").sum()
+
+def test_overlap_fetches_union(fetches, tmp_path):
+    cache = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=3600, offline=False)
+    tags = {"amenity": "pub"}
+    cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    cache.features_from_bbox(52.6, 52.4, 0.6, 0.4, tags)
+    assert fetches[-1] == pytest.approx((52.6, 52.3, 0.6, 0.3))
+    assert len(cache.index) == 1
+    # Both original boxes are now served from the union
+    cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    cache.features_from_bbox(52.6, 52.4, 0.6, 0.4, tags)
+    assert len(fetches) == 2
+
+def test_expired_entries_are_refetched(fetches, tmp_path):
+    cache = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=60, offline=False)
+    tags = {"amenity": "cafe"}
+    cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    for entry in cache.index.values():
+        entry["created"] -= 120
+    cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    assert len(fetches) == 2
+
+def test_least_recently_used_entry_is_evicted(fetches, tmp_path):
+    cache = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=3600, offline=False)
+    tags = {"amenity": "cafe"}
+    boxes = [(52.2, 52.0, 0.2, 0.0), (52.6, 52.4, 0.6, 0.4), (53.0, 52.8, 1.0, 0.8)]
+    cache.features_from_bbox(*boxes[0], tags)
+    cache.features_from_bbox(*boxes[1], tags)
+    sizes = [entry["bytes"] for entry in cache.index.values()]
+    cache.max_bytes = int(sum(sizes) + 0.5 * min(sizes))
+    cache.features_from_bbox(*boxes[0], tags)
+    cache.features_from_bbox(*boxes[2], tags)
+    remaining = [(entry["query"]["north"], entry["query"]["south"], entry["query"]["east"], entry["query"]["west"]) for entry in cache.index.values()]
+    assert sorted(remaining) == sorted([boxes[0], boxes[2]])
+
+def test_oversized_entry_is_kept(fetches, tmp_path):
+    cache = access.OSMCache(str(tmp_path), max_bytes=1, ttl_seconds=3600, offline=False)
+    pois = cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, {"amenity": "cafe"})
+    assert len(cache.index) == 1
+    entry = next(iter(cache.index.values()))
+    assert (tmp_path / entry["file"]).exists()
+    assert len(pois) > 0
+
+def test_offline_miss_raises_and_serves_expired(fetches, tmp_path):
+    tags = {"amenity": "cafe"}
+    online = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=60, offline=False)
+    online.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    for entry in online.index.values():
+        entry["created"] -= 120
+    online._save_index()
+
+    offline = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=60, offline=True)
+    assert len(offline.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)) > 0
+    with pytest.raises(access.OSMCacheMiss):
+        offline.features_from_bbox(52.9, 52.7, 0.9, 0.7, tags)
+    assert len(fetches) == 1
+
+def test_failed_fetch_keeps_replaced_entries(fetches, tmp_path, monkeypatch):
+    tags = {"amenity": "pub"}
+    cache = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=60, offline=False)
+    cache.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)
+    cache.features_from_bbox(52.9, 52.7, 0.9, 0.7, tags)
+    for entry in cache.index.values():
+        if entry["query"]["north"] == 52.9:
+            entry["created"] -= 120
+
+    def unreachable(*args, **kwargs):
+        raise ConnectionError("offline")
+    monkeypatch.setattr(access, "ox", types.SimpleNamespace(geometries_from_bbox=unreachable))
+    with pytest.raises(ConnectionError):
+        # Overlaps the first entry, and the second has expired
+        cache.features_from_bbox(52.6, 52.4, 0.6, 0.4, tags)
+    assert len(cache.index) == 2
+
+    reopened = access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=60, offline=True)
+    assert len(reopened.features_from_bbox(52.5, 52.3, 0.5, 0.3, tags)) > 0
+    assert len(reopened.features_from_bbox(52.9, 52.7, 0.9, 0.7, tags)) > 0
@@ -0,0 +1,47 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from fynesse import access, benchmark
+
+pytest.importorskip("osmium")
+
+@pytest.fixture
+def pbf(tmp_path):
+    nodes_df = benchmark.synthetic_osm_nodes(250, seed=3)
+    return benchmark.write_synthetic_pbf(str(tmp_path / "synthetic.osm.pbf"), nodes_df, untagged_per_tagged=3, seed=3), nodes_df
+
+def test_ingest_skips_untagged_and_flushes_batches(pbf):
+    path, nodes_df = pbf
+    batches = []
+    handler = access.ingest_osm(path, lambda elements_df, tags_df: batches.append((elements_df, tags_df)), batch_size=100)
+    assert [len(elements_df) for elements_df, _ in batches] == [100, 100, 50]
+    assert handler.batches == 3 and handler.elements == 250
+
+    elements_df = pd.concat([elements_df for elements_df, _ in batches], ignore_index=True)
+    assert elements_df["id"].tolist() == nodes_df["id"].tolist()
+    assert (elements_df["type"] == "node").all()
+    # PBF stores coordinates to 1e-7 degrees
+    np.testing.assert_allclose(elements_df["latitude"], nodes_df["latitude"], atol=1e-7)
+    np.testing.assert_allclose(elements_df["longitude"], nodes_df["longitude"], atol=1e-7)
+    assert [json.loads(tags) for tags in elements_df["tags"]] == [json.loads(tags) for tags in nodes_df["tags"]]
+
+    tags_df = pd.concat([tags_df for _, tags_df in batches], ignore_index=True)
+    expected = [(osm_id, key, value) for osm_id, tags in zip(nodes_df["id"], nodes_df["tags"]) for key, value in json.loads(tags).items()]
+    assert list(zip(tags_df["id"], tags_df["tag_key"].astype(str), tags_df["tag_value"].astype(str))) == expected
+
+def test_sql_sink_writes_normalized_tags(pbf, tmp_path):
+    path, nodes_df = pbf
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'osm.db'}")
+    with engine.begin() as conn:
+        access.ingest_osm(path, access.osm_sql_sink(conn, tags_table="osm_england_tags"), batch_size=100)
+    with engine.connect() as conn:
+        nodes = pd.read_sql_query("SELECT id, tags FROM osm_england_nodes ORDER BY id", conn)
+        tags = pd.read_sql_query("SELECT id, tag_key, tag_value FROM osm_england_tags ORDER BY id, tag_key", conn)
+    engine.dispose()
+    assert nodes["id"].tolist() == nodes_df["id"].tolist()
+    expected = sorted((osm_id, key, value) for osm_id, encoded in zip(nodes_df["id"], nodes_df["tags"]) for key, value in json.loads(encoded).items())
+    assert list(tags.itertuples(index=False, name=None)) == expected
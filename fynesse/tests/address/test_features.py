@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from fynesse import access, address, assess
+
+def test_spatial_shards_keep_whole_cells():
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(52.0, 52.5, 2000)
+    longs = rng.uniform(0.0, 0.5, 2000)
+    shards = address.spatial_shards(lats, longs, 8, shard_km=5.0)
+    assert sorted(np.concatenate(shards).tolist()) == list(range(len(lats)))
+    cells = np.floor(lats / 0.045).astype(int) * 1000 + np.floor(longs / 0.07).astype(int)
+    owners = {}
+    for n, shard in enumerate(shards):
+        for cell in np.unique(cells[shard]):
+            assert owners.setdefault(cell, n) == n
+    assert 1 < len(shards) <= 8
+    assert address.spatial_shards([], [], 4) == []
+
+def test_new_build_features_build_index_once(tmp_path):
+    rng = np.random.default_rng(1)
+    new_builds = pd.DataFrame({"latitude": rng.uniform(52.18, 52.22, 500), "longitude": rng.uniform(0.10, 0.14, 500),
+                               "date_of_transfer": pd.to_datetime("2015-01-01") + pd.to_timedelta(rng.integers(0, 3000, 500), unit="D")})
+    windows = [("2015-01-01", "2018-12-31"), ("2019-01-01", "2023-12-31")]
+    generator = address.new_build_features(new_builds, lengths=(1, 2), date_windows=windows)
+    indexes = generator.build_index()
+    assert all(isinstance(index, assess.BoxCountIndex) for index in indexes.values())
+
+    lats = rng.uniform(52.19, 52.21, 200)
+    longs = rng.uniform(0.11, 0.13, 200)
+    expected = assess.get_num_local_new_builds_batch(new_builds, lats, longs, (1, 2), windows)
+    features = address.build_feature_matrix(lats, longs, [generator], cache_dir=tmp_path, n_workers=2, shard_km=0.5)
+    pd.testing.assert_frame_equal(features[expected.columns].reset_index(drop=True), expected, check_dtype=False)
+
+def test_census_features_from_nearest_area(tmp_path):
+    areas_df = pd.DataFrame({"latitude": [51.5, 51.55, 52.0], "longitude": [-0.1, 0.1, 0.5], "msoa21cd": ["E02000001", "E02000002", "unknown"]})
+    generator = address.census_features(areas_df, "ts062", columns=["L15 Full-time students"], proportions=True, cache_dir=str(tmp_path / "census"))
+    features = address.build_feature_matrix([51.501, 51.549, 52.01], [-0.1, 0.101, 0.5], [generator], cache_dir=tmp_path, n_workers=1)
+    census = access.load_census("ts062", columns=["L15 Full-time students", "Total"], cache_dir=str(tmp_path / "census"))
+    expected = census["L15 Full-time students"] / census["Total"]
+    values = features["ts062_L15 Full-time students"]
+    assert values[0] == expected["E02000001"]
+    assert values[1] == expected["E02000002"]
+    assert np.isnan(values[2])
+
+def test_cache_key_covers_package_source(monkeypatch):
+    generator = address.new_build_features(pd.DataFrame({"latitude": [52.2], "longitude": [0.1]}))
+    key = generator.cache_key("coords")
+    assert generator.cache_key("coords") == key
+    monkeypatch.setattr(address, "_package_fingerprint", lambda: "changed")
+    assert generator.cache_key("coords") != key
@@ -0,0 +1,88 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import assess
+
+def buildings(rows):
+    numbers, postcodes, longs, lats = zip(*rows)
+    return gpd.GeoDataFrame({"building": "yes", "addr:housenumber": list(numbers), "addr:street": "High Street",
+                             "addr:postcode": list(postcodes), "addr:city": "Cambridge"},
+                            geometry=gpd.points_from_xy(longs, lats), crs="EPSG:4326", index=[10 + n for n in range(len(rows))])
+
+def transactions(rows):
+    numbers, postcodes, longs, lats = zip(*rows)
+    return pd.DataFrame({"primary_addressable_object_name": list(numbers), "postcode": list(postcodes), "longitude": list(longs), "latitude": list(lats)})
+
+def test_nearest_by_default_and_match_counts():
+    osm = buildings([("1", "CB1 1AA", 0.0, 52.0), (None, "CB1 1AA", 0.0, 52.0), ("9", "CB9 9ZZ", 0.0, 52.0)])
+    pp = transactions([("1", "cb11aa", 0.0, 52.0), ("3", "CB1 1AA", 0.0, 52.0), ("5", "CB1 1AA", 0.0, 52.0)])
+    merged = assess.get_merged_df(pp, osm)
+    assert sorted(merged["match_type"].dropna()) == ["exact", "nearest"]
+    assert merged.attrs["match_counts"] == {"exact": 1, "nearest": 1, "unmatched_pp": 1, "unmatched_osm": 1}
+    assert "index" not in merged.columns
+
+    exact_only = assess.get_merged_df(pp, osm, nearest=False)
+    assert exact_only["match_type"].dropna().tolist() == ["exact"]
+    assert exact_only.attrs["match_counts"] == {"exact": 1, "nearest": 0, "unmatched_pp": 2, "unmatched_osm": 2}
+
+def test_nearest_uses_only_free_unnumbered_buildings_once():
+    osm = buildings([
+        ("1", "CB1 1AA", 0.0, 52.0),        # numbered, matched exactly
+        ("2", "CB1 1AA", 0.0, 52.0),        # numbered, never a nearest candidate
+        (None, "CB1 1AA", 0.0001, 52.0),
+        (None, "CB1 1AA", 0.01, 52.0),
+        (None, "CB2 2BB", 0.0, 52.0),       # other postcode
+    ])
+    pp = transactions([("1", "CB1 1AA", 0.0, 52.0)] + [(number, "CB1 1AA", 0.0, 52.0) for number in ["5", "7", "9"]])
+    positions, match_types = assess.AddressMatcher(assess.add_building_areas(osm)).match(pp, nearest=True)
+    assert match_types[0] == "exact" and positions[0] == 0
+    nearest = positions[match_types == "nearest"]
+    assert sorted(nearest) == [2, 3]
+    assert (match_types == None).sum() == 1
+
+def test_nearest_distance_scales_longitude():
+    # At 60N a degree of longitude is half a degree of latitude
+    osm = buildings([(None, "ZE1 0AA", 0.015, 60.0), (None, "ZE1 0AA", 0.0, 60.01)])
+    pp = transactions([("4", "ZE1 0AA", 0.0, 60.0)])
+    positions, match_types = assess.AddressMatcher(assess.add_building_areas(osm)).match(pp, nearest=True)
+    assert match_types[0] == "nearest"
+    assert positions[0] == 0
+
+def greedy_nearest(matcher, pp, positions):
+    """ The nearest fallback over every (transaction, building) pair in a postcode, without a candidate cap. """
+    positions = positions.copy()
+    postcodes = matcher.postcode_lookup.get_indexer(assess.normalize_postcodes(pp["postcode"]))
+    unmatched = np.flatnonzero((positions < 0) & (postcodes >= 0))
+    claimed = np.zeros(len(matcher.postcode_codes), dtype=bool)
+    claimed[positions[positions >= 0]] = True
+    free = np.flatnonzero((matcher.number_codes < 0) & (matcher.postcode_codes >= 0) & ~claimed)
+    candidates = pd.DataFrame({"pp": unmatched, "postcode": postcodes[unmatched]}).merge(
+        pd.DataFrame({"osm": free, "postcode": matcher.postcode_codes[free]}), on="postcode")
+    lats = pp["latitude"].to_numpy()[candidates["pp"]]
+    distances = np.hypot((matcher.centroid_x[candidates["osm"]] - pp["longitude"].to_numpy()[candidates["pp"]]) * np.cos(np.radians(lats)),
+                         matcher.centroid_y[candidates["osm"]] - lats)
+    candidates = candidates.assign(distance=distances).sort_values("distance", kind="stable")
+    while len(candidates):
+        pairs = candidates.drop_duplicates("pp").drop_duplicates("osm")
+        positions[pairs["pp"].to_numpy()] = pairs["osm"].to_numpy()
+        candidates = candidates[~candidates["pp"].isin(pairs["pp"]) & ~candidates["osm"].isin(pairs["osm"])]
+    return positions
+
+@pytest.mark.parametrize("max_candidates", [1, 2, 8])
+def test_capped_candidates_match_full_greedy(max_candidates):
+    rng = np.random.default_rng(max_candidates)
+    postcodes = ["CB1 1AA", "CB2 2BB", "CB3 3CC"]
+    # Many flats and many unnumbered buildings in one postcode
+    osm = buildings([(None if rng.random() < 0.7 else str(rng.integers(1, 20)), postcodes[rng.integers(0, 3)] if n >= 60 else postcodes[0],
+                      rng.uniform(0, 0.01), rng.uniform(52, 52.01)) for n in range(150)])
+    pp = transactions([(f"FLAT {n}" if n % 3 else str(rng.integers(1, 20)), postcodes[rng.integers(0, 3)] if n >= 80 else postcodes[0],
+                        rng.uniform(0, 0.01), rng.uniform(52, 52.01)) for n in range(200)])
+    matcher = assess.AddressMatcher(assess.add_building_areas(osm))
+    exact, _ = matcher.match(pp, nearest=False)
+    positions, match_types = matcher.match(pp, max_candidates=max_candidates)
+    np.testing.assert_array_equal(positions, greedy_nearest(matcher, pp, exact))
+    nearest = positions[match_types == "nearest"]
+    assert len(nearest) > 0
+    assert len(set(nearest)) == len(nearest) and not set(nearest) & set(exact)
@@ -0,0 +1,60 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from fynesse import access, assess
+
+def make_buildings(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(52.0, 52.1, n)
+    longs = rng.uniform(0.0, 0.1, n)
+    sizes = rng.uniform(0.0001, 0.001, n)
+    columns = {
+        "building": np.where(rng.random(n) < 0.9, "yes", None),
+        "addr:housenumber": np.where(rng.random(n) < 0.7, rng.integers(1, 100, n).astype(str), None),
+        "addr:street": np.where(rng.random(n) < 0.8, "High Street", None),
+        "addr:postcode": np.where(rng.random(n) < 0.8, "CB2 1TN", None),
+        "addr:city": np.where(rng.random(n) < 0.9, "Cambridge", None),
+    }
+    return gpd.GeoDataFrame(columns, geometry=shapely.box(longs, lats, longs + sizes, lats + sizes), crs="EPSG:4326")
+
+def test_area_in_square_metres():
+    box = gpd.GeoDataFrame({"building": ["yes"]}, geometry=[shapely.box(0.0, 52.0, 0.001, 52.001)], crs="EPSG:4326")
+    # 0.001 degrees is about 111.25 m of latitude and 68.5 m of longitude at 52N
+    assert assess.add_building_areas(box)["area"].iloc[0] == pytest.approx(7620, rel=0.01)
+
+def test_address_partitions_are_disjoint_and_cover_buildings():
+    pois = make_buildings()
+    with_address = assess.get_buildings_with_area(pois, True)
+    without_address = assess.get_buildings_with_area(pois, False)
+    assert set(with_address.index).isdisjoint(without_address.index)
+    buildings = pois[pois["building"].notna()]
+    assert sorted(with_address.index.union(without_address.index)) == sorted(buildings.index)
+    assert len(with_address) > 0 and len(without_address) > 0
+    assert with_address[assess.ADDRESS_COLUMNS].notna().all().all()
+    assert (without_address[assess.ADDRESS_COLUMNS].isna().any(axis=1)).all()
+
+    # Reusing precomputed areas gives the same partitions
+    buildings_with_area = assess.add_building_areas(pois)
+    assert list(assess.get_buildings_with_area(buildings_with_area, True).index) == list(with_address.index)
+    np.testing.assert_allclose(assess.get_buildings_with_area(buildings_with_area, False)["area"], without_address["area"])
+
+def test_missing_address_columns():
+    pois = make_buildings().drop(columns=["addr:city", "addr:postcode"])
+    buildings = pois[pois["building"].notna()]
+    assert len(assess.get_buildings_with_area(pois, True)) == 0
+    assert len(assess.get_buildings_with_area(pois, False)) == len(buildings)
+
+    no_buildings = pois.drop(columns="building")
+    assert len(assess.add_building_areas(no_buildings)) == 0
+
+def test_building_features_are_memoized(serve_osm, monkeypatch, tmp_path):
+    fetches = serve_osm(make_buildings())
+    monkeypatch.setattr(access, "_osm_cache", access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=3600, offline=False))
+    assess.get_building_features.cache_clear()
+    buildings = assess.get_building_features(52.1, 52.0, 0.1, 0.0)
+    assert assess.get_building_features(52.1, 52.0, 0.1, 0.0) is buildings
+    assert len(fetches) == 1
+    assert {"area", "has_full_address"} <= set(buildings.columns)
+    assess.get_building_features.cache_clear()
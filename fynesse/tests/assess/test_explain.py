@@ -0,0 +1,13 @@
+from fynesse import access, assess, benchmark
+
+def test_pcd_joined_query_uses_indexes(mariadb_conn):
+    conn = mariadb_conn
+    postcode_df = benchmark.synthetic_postcode_data(20000)
+    benchmark.load_housing_tables(conn, benchmark.synthetic_pp_data(100000, postcode_df), postcode_df)
+    access.create_spatial_indexes(conn)
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE TABLE pp_data, postcode_data")
+        cur.fetchall()
+    lat, long = postcode_df.loc[0, ["latitude", "longitude"]]
+    explain_df = assess.explain_pcd_joined_query(conn, lat, long, postcode_df.loc[0, "postcode"][:3])
+    assert set(explain_df["table"]) == {"po", "pp"}
@@ -0,0 +1,68 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from fynesse import assess, benchmark
+
+QUERY_LATS = np.array([52.2, 52.21, 51.5])
+QUERY_LONGS = np.array([0.12, 0.13, -0.1])
+
+def edge_features():
+    """ Features of every geometry type touching the query boxes on their edges and corners. """
+    geometries = []
+    for lat, long in zip(QUERY_LATS, QUERY_LONGS):
+        north, south, west, east = assess.get_box(lat, long, 2)
+        geometries += [
+            shapely.Point(west, lat), shapely.Point(east, north), shapely.Point(long, south),
+            shapely.Point(east + 1e-9, lat),
+            shapely.LineString([(east, lat), (east + 0.01, lat)]),
+            shapely.LineString([(west - 0.01, north + 1e-9), (west, north + 1e-9)]),
+            shapely.box(long - 0.001, north, long + 0.001, north + 0.01),
+            shapely.box(east + 1e-9, lat, east + 0.01, lat + 0.01),
+            shapely.MultiPolygon([shapely.box(west - 0.01, south - 0.01, west, south), shapely.box(0, 0, 0.001, 0.001)]),
+            shapely.MultiLineString([[(long, lat), (long + 0.001, lat)]]),
+        ]
+    return gpd.GeoDataFrame(geometry=geometries, crs="EPSG:4326")
+
+def layer(seed):
+    synthetic = benchmark.synthetic_rail_geo_df(2000, seed=seed)
+    return gpd.GeoDataFrame(geometry=list(synthetic.geometry) + list(edge_features().geometry), crs="EPSG:4326")
+
+def query_points(geo_df, n=40, seed=0):
+    # Points near features, plus the edge query points
+    rng = np.random.default_rng(seed)
+    centroids = shapely.centroid(geo_df.geometry.values[rng.integers(0, len(geo_df), n)])
+    return np.concatenate([shapely.get_y(centroids), QUERY_LATS]), np.concatenate([shapely.get_x(centroids), QUERY_LONGS])
+
+def test_box_counts_match_per_point():
+    geo_df = layer(0)
+    lats, longs = query_points(geo_df)
+    index = assess.GeoLayerIndex(geo_df)
+    expected = [assess.get_num_local_pois_from_geo_df(lat, long, geo_df) for lat, long in zip(lats, longs)]
+    assert index.count_boxes(lats, longs).tolist() == expected
+    by_type = index.count_boxes(lats, longs, by_type=True)
+    assert by_type.sum(axis=1).tolist() == expected
+    # The edge boxes see one feature of each type on or inside their edges
+    assert (by_type[-3:] >= [3, 1, 1, 1]).all()
+
+def test_diff_rail_counts_match_per_point():
+    rail_2012, rail_2022 = layer(1), layer(2)
+    lats, longs = query_points(rail_2022, seed=1)
+    diffs = assess.get_diff_rail_counts(lats, longs, assess.GeoLayerIndex(rail_2022), assess.GeoLayerIndex(rail_2012))
+    assert list(diffs) == [assess.get_diff_rail_count(lat, long, rail_2022, rail_2012) for lat, long in zip(lats, longs)]
+
+def test_radius_counts_match_projected_distances():
+    geo_df = layer(3)
+    lats, longs = query_points(geo_df, seed=3)
+    index = assess.GeoLayerIndex(geo_df)
+    projected = geo_df[geo_df.geom_type.isin(assess.GeoLayerIndex.geometry_types)].to_crs("EPSG:27700").geometry.to_numpy()
+    points = gpd.GeoSeries(gpd.points_from_xy(longs, lats), crs="EPSG:4326").to_crs("EPSG:27700").to_numpy()
+    for radius_km in [0.5, 2.0]:
+        distances = shapely.distance(points[:, np.newaxis], projected[np.newaxis, :])
+        within = distances <= radius_km * 1000
+        assert within.any()
+        assert index.count_radius(lats, longs, radius_km).tolist() == within.sum(axis=1).tolist()
+        by_type = index.count_radius(lats, longs, radius_km, by_type=True)
+        assert by_type.sum(axis=1).tolist() == within.sum(axis=1).tolist()
+    # MultiLineStrings are not indexed
+    assert len(projected) < len(geo_df)
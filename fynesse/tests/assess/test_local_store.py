@@ -0,0 +1,145 @@
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from fynesse import access, assess, benchmark
+
+@pytest.fixture
+def tables(tmp_path):
+    postcode_df = benchmark.synthetic_postcode_data(20000, seed=3)
+    pp_df = benchmark.synthetic_pp_data(20000, postcode_df, years=(2019, 2020, 2021), seed=3)
+    conn = sqlite3.connect(":memory:")
+    postcode_df.to_sql("postcode_data", conn, index=False)
+    pp_df.to_sql("pp_data", conn, index=False)
+    store = access.LocalStore(str(tmp_path / "store"))
+    store.write_partitions("postcode_data", postcode_df)
+    store.write_partitions("pp_data", pp_df, date_column="date_of_transfer")
+    yield conn, store, postcode_df
+    conn.close()
+
+def test_get_df_from_sql_reads_snapshot(tables):
+    conn, store, postcode_df = tables
+    snapshot = assess.get_df_from_sql("postcode_data", local_store=store)
+    assert list(snapshot.columns) == list(postcode_df.columns)
+    pd.testing.assert_frame_equal(snapshot.sort_values("postcode").reset_index(drop=True), postcode_df.sort_values("postcode").reset_index(drop=True))
+
+@pytest.mark.parametrize("postcode_start", ["CB", "CB1", "CB2 3"])
+def test_pcd_joined_df_matches_database(tables, postcode_start):
+    conn, store, postcode_df = tables
+    lat, long = postcode_df.loc[postcode_df["postcode"].str.startswith(postcode_start), ["latitude", "longitude"]].iloc[0]
+    query, params = assess.build_pcd_joined_query(lat, long, postcode_start, "2020-01-01", "2021-06-30", distance_km=40)
+    expected = pd.read_sql_query(query.replace("%s", "?"), conn, params=params)
+    local = assess.get_pcd_joined_df(lat, long, postcode_start, start_date="2020-01-01", end_date="2021-06-30", distance_km=40, local_store=store)
+    assert len(expected) > 0
+    assert list(local.columns) == list(expected.columns)
+    key = ["postcode", "date_of_transfer", "price", "primary_addressable_object_name"]
+    pd.testing.assert_frame_equal(local.sort_values(key).reset_index(drop=True), expected.sort_values(key).reset_index(drop=True), check_dtype=False)
+
+def partition_names(df):
+    years = pd.to_datetime(df["date_of_transfer"]).dt.year
+    years = years.astype("Int64").astype(str).where(years.notna(), access.LocalStore.null_year)
+    return "year=" + years + "/area=" + df["postcode"].str.extract(r"^([A-Z]+)", expand=False).fillna("")
+
+def python_fingerprints(engine, table):
+    """ The per-partition row counts and checksums that LocalStore.fingerprints computes on MariaDB. """
+    df = pd.read_sql_query(f"SELECT * FROM {table}", engine)
+    names = partition_names(df)
+    hashes = pd.util.hash_pandas_object(df, index=False) % 2**32
+    return {name: [len(group), int(group.sum())] for name, group in hashes.groupby(names)}
+
+def test_refresh_rewrites_only_changed_partitions(tmp_path, monkeypatch):
+    postcode_df = benchmark.synthetic_postcode_data(2000, seed=4)
+    pp_df = benchmark.synthetic_pp_data(5000, postcode_df, years=(2019, 2020), seed=4)
+    pp_df.loc[:29, "date_of_transfer"] = None
+    access.dispose_engines()
+    engine = access.get_engine_for_url(f"sqlite:///{tmp_path / 'pp.db'}")
+    pp_df.to_sql("pp_data", engine, index=False)
+    store = access.LocalStore(str(tmp_path / "store"))
+    monkeypatch.setattr(store, "fingerprints", lambda table, conn, date_column=None, postcode_column="postcode": python_fingerprints(engine, table))
+    written = []
+    write_partitions = store.write_partitions
+
+    def record_write_partitions(*args, **kwargs):
+        names = write_partitions(*args, **kwargs)
+        written.extend(names)
+        return names
+    monkeypatch.setattr(store, "write_partitions", record_write_partitions)
+
+    with access.engine_connection(engine) as conn:
+        initial = store.refresh("pp_data", conn, date_column="date_of_transfer")
+    assert sorted(written) == initial == sorted(python_fingerprints(engine, "pp_data"))
+
+    names = partition_names(pp_df)
+    changed_name, removed_name = names.value_counts().index[:2]
+    null_name = names[0]
+    assert null_name.startswith(f"year={access.LocalStore.null_year}/")
+    changed_year, changed_area = changed_name[len("year="):len("year=") + 4], changed_name.split("area=")[1]
+    removed_year, removed_area = removed_name[len("year="):len("year=") + 4], removed_name.split("area=")[1]
+    with access.engine_connection(engine) as conn:
+        conn.execute(sqlalchemy.text("UPDATE pp_data SET price = price + 1 WHERE rowid = (SELECT MIN(rowid) FROM pp_data WHERE date_of_transfer LIKE :year AND postcode LIKE :area)"),
+                     {"year": changed_year + "%", "area": changed_area + "%"})
+        conn.execute(sqlalchemy.text("DELETE FROM pp_data WHERE date_of_transfer LIKE :year AND postcode LIKE :area"), {"year": removed_year + "%", "area": removed_area + "%"})
+        conn.execute(sqlalchemy.text("UPDATE pp_data SET price = price + 1 WHERE transaction_unique_identifier = :id"), {"id": pp_df.loc[0, "transaction_unique_identifier"]})
+        conn.commit()
+        written.clear()
+        refreshed = store.refresh("pp_data", conn, date_column="date_of_transfer")
+
+    assert refreshed == sorted([changed_name, removed_name, null_name])
+    assert sorted(written) == sorted([changed_name, null_name])
+    assert not (tmp_path / "store" / "pp_data" / removed_name / "part-0.parquet").exists()
+    with open(tmp_path / "store" / "pp_data" / "_manifest.json") as file:
+        assert json.load(file) == python_fingerprints(engine, "pp_data")
+    expected = pd.read_sql_query("SELECT * FROM pp_data", engine)
+    key = ["transaction_unique_identifier"]
+    pd.testing.assert_frame_equal(store.read("pp_data").sort_values(key).reset_index(drop=True), expected.sort_values(key).reset_index(drop=True), check_dtype=False)
+    access.dispose_engines()
+
+def test_rows_without_a_date_are_kept(tmp_path):
+    postcode_df = benchmark.synthetic_postcode_data(200, seed=5)
+    pp_df = benchmark.synthetic_pp_data(500, postcode_df, years=(2020,), seed=5)
+    pp_df.loc[:9, "date_of_transfer"] = None
+    store = access.LocalStore(str(tmp_path / "store"))
+    written = store.write_partitions("pp_data", pp_df, date_column="date_of_transfer")
+    assert any(name.startswith(f"year={access.LocalStore.null_year}/") for name in written)
+    snapshot = store.read("pp_data", columns=["transaction_unique_identifier", "date_of_transfer", "year"])
+    assert len(snapshot) == len(pp_df)
+    undated = snapshot[snapshot["date_of_transfer"].isna()]
+    assert sorted(undated["transaction_unique_identifier"]) == sorted(pp_df.loc[:9, "transaction_unique_identifier"])
+    assert undated["year"].isna().all()
+    assert len(store.read("pp_data", years=(2020, 2020))) == len(pp_df) - 10
+
+def test_refresh_with_server_fingerprints(tmp_path, mariadb_conn, mariadb_engine):
+    postcode_df = benchmark.synthetic_postcode_data(2000, seed=6)
+    pp_df = benchmark.synthetic_pp_data(5000, postcode_df, years=(2019, 2020), seed=6)
+    pp_df.loc[:29, "date_of_transfer"] = None
+    benchmark.load_housing_tables(mariadb_conn, pp_df, postcode_df)
+    store = access.LocalStore(str(tmp_path / "store"))
+    with access.engine_connection(mariadb_engine) as conn:
+        initial = store.refresh("pp_data", conn, date_column="date_of_transfer")
+    assert initial == sorted(partition_names(pp_df).unique())
+
+    names = partition_names(pp_df)
+    changed_name, removed_name = names.value_counts().index[:2]
+    changed_id = pp_df.loc[names == changed_name, "transaction_unique_identifier"].iloc[0]
+    removed_ids = pp_df.loc[names == removed_name, "transaction_unique_identifier"].tolist()
+    with mariadb_conn.cursor() as cur:
+        cur.execute("UPDATE pp_data SET price = price + 1 WHERE transaction_unique_identifier = %s", (changed_id,))
+        cur.executemany("DELETE FROM pp_data WHERE transaction_unique_identifier = %s", [(row_id,) for row_id in removed_ids])
+    mariadb_conn.commit()
+    with access.engine_connection(mariadb_engine) as conn:
+        refreshed = store.refresh("pp_data", conn, date_column="date_of_transfer")
+        current = store.fingerprints("pp_data", conn, date_column="date_of_transfer")
+        expected = pd.read_sql_query("SELECT * FROM pp_data", conn)
+
+    assert refreshed == sorted([changed_name, removed_name])
+    assert removed_name not in current
+    with open(tmp_path / "store" / "pp_data" / "_manifest.json") as file:
+        assert json.load(file) == current
+    snapshot = store.read("pp_data")
+    key = ["transaction_unique_identifier"]
+    for df in (snapshot, expected):
+        df["date_of_transfer"] = pd.to_datetime(df["date_of_transfer"])
+    pd.testing.assert_frame_equal(snapshot.sort_values(key).reset_index(drop=True), expected.sort_values(key).reset_index(drop=True), check_dtype=False)
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import assess
+
+def new_builds_with_ties(n, query_lats, query_longs, seed=0):
+    """ n new builds on a coarse grid (so coordinates repeat), the first ones
+        placed exactly on the edges and corners of the query boxes. """
+    rng = np.random.default_rng(seed)
+    lats = np.round(rng.uniform(52.18, 52.22, n), 3)
+    longs = np.round(rng.uniform(0.10, 0.14, n), 3)
+    edges = []
+    for lat, long in zip(query_lats, query_longs):
+        north, south, west, east = assess.get_box(lat, long, 1)
+        edges += [(north, long), (south, long), (lat, west), (lat, east), (north, east), (south, west), (lat, long)]
+    for i, (lat, long) in enumerate(edges[:n]):
+        lats[i], longs[i] = lat, long
+    return pd.DataFrame({"latitude": lats, "longitude": longs})
+
+@pytest.mark.parametrize("n", [0, 1, 2, 3, 4, 5, 7, 8, 9, 15, 16, 17, 31, 32, 33, 63, 64, 65, 1000])
+def test_batch_matches_per_point(n):
+    rng = np.random.default_rng(n)
+    query_lats = np.round(rng.uniform(52.19, 52.21, 25), 3)
+    query_longs = np.round(rng.uniform(0.11, 0.13, 25), 3)
+    new_build_coords_df = new_builds_with_ties(n, query_lats, query_longs, seed=n)
+    batch = assess.get_num_local_new_builds_batch(new_build_coords_df, query_lats, query_longs)
+    expected = [assess.get_num_local_new_builds(new_build_coords_df, lat, long) for lat, long in zip(query_lats, query_longs)]
+    assert batch["new_builds_1"].tolist() == expected
@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+
+from fynesse import assess, benchmark
+
+def test_batch_matches_one_query_per_location(mariadb_conn):
+    conn = mariadb_conn
+    postcode_df = benchmark.synthetic_postcode_data(500, seed=7)
+    benchmark.load_housing_tables(conn, benchmark.synthetic_pp_data(5000, postcode_df, years=(2020, 2021), seed=7), postcode_df)
+    locations = [(lat, long, postcode[:length]) for (lat, long, postcode), length in zip(postcode_df[["latitude", "longitude", "postcode"]].itertuples(index=False), [2, 3, 5])]
+    # No postcode starts with ZZ, so this location has no rows
+    locations.insert(1, (locations[0][0], locations[0][1], "ZZ"))
+
+    for _ in range(2):
+        batch = assess.get_pcd_joined_dfs(locations, conn, start_date="2020-06-01", end_date="2021-06-30", distance_km=20)
+    assert len(batch) == len(locations)
+    key = ["postcode", "date_of_transfer", "price", "primary_addressable_object_name"]
+    for (lat, long, postcode_start), batch_df in zip(locations, batch):
+        expected = assess.get_pcd_joined_df(lat, long, postcode_start, conn, start_date="2020-06-01", end_date="2021-06-30", distance_km=20)
+        assert list(batch_df.columns) == list(expected.columns)
+        assert (len(expected) == 0) == (postcode_start == "ZZ")
+        pd.testing.assert_frame_equal(batch_df.sort_values(key).reset_index(drop=True), expected.sort_values(key).reset_index(drop=True), check_dtype=False)
+    with pytest.raises(Exception, match="pcd_query_locations"):
+        pd.read_sql_query("SELECT * FROM pcd_query_locations", conn)
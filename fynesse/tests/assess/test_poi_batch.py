@@ -0,0 +1,57 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, assess
+
+def make_world(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    lats = np.concatenate([rng.uniform(52.0, 52.12, n // 2), rng.uniform(52.45, 52.57, n - n // 2)])
+    longs = rng.uniform(0.0, 0.12, n)
+    amenity = np.where(rng.random(n) < 0.5, rng.choice(["cafe", "school"], n), None)
+    shop = np.where(rng.random(n) < 0.4, rng.choice(["bakery", "butcher"], n), None)
+    return gpd.GeoDataFrame({"amenity": amenity, "shop": shop}, geometry=gpd.points_from_xy(longs, lats), crs="EPSG:4326")
+
+WORLD = make_world()
+
+@pytest.fixture
+def fetches(serve_osm, monkeypatch, tmp_path):
+    """ A fresh OSM cache over the osmnx stand-in serving WORLD. """
+    monkeypatch.setattr(access, "_osm_cache", access.OSMCache(str(tmp_path), max_bytes=2**30, ttl_seconds=3600, offline=False))
+    return serve_osm(WORLD)
+
+def test_batch_matches_per_point_with_one_fetch_per_cell(fetches, tmp_path):
+    rng = np.random.default_rng(1)
+    # Two clusters, each inside a single 10 km grid cell
+    lats = np.concatenate([rng.uniform(52.03, 52.08, 15), rng.uniform(52.48, 52.53, 10)])
+    longs = rng.uniform(0.02, 0.1, 25)
+    tags = {"amenity": ["cafe", "school"], "shop": "bakery", "tourism": True}
+
+    batch = assess.count_pois_near_coordinates_batch(lats, longs, tags, distance_km=1.0)
+    assert len(fetches) == 2
+    assert set(batch.attrs["timings"]) == {"boxes", "fetch", "query", "count"}
+
+    access._osm_cache = access.OSMCache(str(tmp_path / "per_point"), max_bytes=2**30, ttl_seconds=3600, offline=False)
+    expected = [assess.count_pois_near_coordinates(lat, long, tags, distance_km=1.0) for lat, long in zip(lats, longs)]
+    for tag in tags:
+        assert batch[tag].tolist() == [counts[tag] for counts in expected]
+    assert batch["amenity"].sum() > 0 and batch["tourism"].sum() == 0
+
+def test_local_pois_are_filtered_to_tag_values():
+    pois = gpd.GeoDataFrame({"amenity": ["cafe", "bench", "school"], "shop": [None, None, "bakery"]},
+                            geometry=gpd.points_from_xy([0.05, 0.05, 0.5], [52.05, 52.05, 52.5]), crs="EPSG:4326")
+    tags = {"amenity": ["cafe"], "shop": "bakery"}
+    batch = assess.count_pois_near_coordinates_batch([52.05, 52.5], [0.05, 0.5], tags, distance_km=1.0, pois=pois)
+    # The bench is not a requested value; the school is counted under amenity as osmnx would, since its shop matches
+    assert batch["amenity"].tolist() == [1, 1]
+    assert batch["shop"].tolist() == [0, 1]
+
+def test_local_pois_match_fetch_path(fetches):
+    rng = np.random.default_rng(2)
+    lats = rng.uniform(52.03, 52.08, 20)
+    longs = rng.uniform(0.02, 0.1, 20)
+    tags = {"amenity": ["cafe"], "shop": "bakery"}
+    fetched = assess.count_pois_near_coordinates_batch(lats, longs, tags, distance_km=1.0)
+    local = assess.count_pois_near_coordinates_batch(lats, longs, tags, distance_km=1.0, pois=WORLD)
+    pd.testing.assert_frame_equal(local, fetched, check_dtype=False)
@@ -0,0 +1,133 @@
+import collections
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from fynesse import access, assess
+
+TAGS = {"amenity": ["cafe", "school"], "shop": ["bakery"]}
+
+def nodes_with_edge_cases(query_lats, query_longs, areas, n_random=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    lats = list(rng.uniform(52.0, 52.2, n_random))
+    longs = list(rng.uniform(0.0, 0.2, n_random))
+    # Nodes exactly on, and one ulp inside, every box edge
+    for lat, long, area in zip(query_lats, query_longs, areas):
+        multiple = int(area / 1_000_000) + 1
+        height, width = 0.009 * 2 * multiple, 0.014 * 2 * multiple
+        for edge_lat, edge_long in [(lat + height, long), (lat - height, long), (lat, long + width), (lat, long - width)]:
+            lats.append(edge_lat)
+            longs.append(edge_long)
+        lats.append(np.nextafter(lat + height, lat))
+        longs.append(long)
+    pairs = [("amenity", "cafe"), ("amenity", "school"), ("shop", "bakery"), ("amenity", "bench")]
+    picks = rng.integers(0, len(pairs), len(lats))
+    tags = [json.dumps({pairs[p][0]: pairs[p][1]}) for p in picks]
+    return pd.DataFrame({"id": np.arange(len(lats)), "latitude": lats, "longitude": longs, "tags": tags})
+
+def test_box_counts_match_per_point_path():
+    rng = np.random.default_rng(1)
+    query_lats = rng.uniform(52.05, 52.15, 40)
+    query_longs = rng.uniform(0.05, 0.15, 40)
+    areas = rng.choice([0, 500_000, 1_000_000, 2_500_000], 40)
+    nodes_df = assess.parse_tag_columns(nodes_with_edge_cases(query_lats, query_longs, areas), TAGS.keys())
+
+    batch = assess.get_pois_count_df_from_coords(query_lats, query_longs, TAGS, areas, tag_filtered_osm_nodes_df=nodes_df)
+    for n, (lat, long, area) in enumerate(zip(query_lats, query_longs, areas)):
+        expected = assess.get_pois_count_from_df(TAGS, assess.get_boxed_pois_from_df(lat, long, nodes_df, area))
+        assert batch.iloc[n].to_dict() == expected
+
+def test_counts_ignore_json_spacing_and_key_order():
+    nodes_df = pd.DataFrame({"latitude": 52.2, "longitude": 0.12, "tags": [
+        '{"amenity": "cafe"}',
+        '{"amenity":"cafe"}',
+        '{ "name" : "Fitzbillies" ,  "amenity" : "cafe" }',
+        '{"shop": "bakery", "amenity": "school"}',
+        '{"amenity": "school","shop":"bakery"}',
+        '{"amenity": "bench"}',
+        '{"name": "cafe"}',
+        '{}',
+        {"amenity": "cafe", "shop": "bakery"},
+    ]})
+    expected = {"cafe": 4, "school": 2, "bakery": 3}
+    assert assess.get_pois_count_from_df(TAGS, nodes_df) == expected
+    # Parsed frames count the same, with the same keys in the same order
+    counts = assess.get_pois_count_from_df(TAGS, assess.parse_tag_columns(nodes_df, TAGS.keys()))
+    assert list(counts.items()) == list(expected.items())
+    assert assess.get_pois_count_from_df(TAGS, nodes_df.iloc[:0]) == {"cafe": 0, "school": 0, "bakery": 0}
+    assert assess.get_pois_count_from_df({"tourism": ["museum"]}, nodes_df) == {"museum": 0}
+
+def haversine_km(lat, long, lats, longs):
+    lat, long, lats, longs = np.radians(lat), np.radians(long), np.radians(lats), np.radians(longs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((longs - long) / 2) ** 2
+    return 2 * assess.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def test_radius_counts_match_brute_force_haversine():
+    rng = np.random.default_rng(2)
+    query_lats = rng.uniform(52.05, 52.15, 30)
+    query_longs = rng.uniform(0.05, 0.15, 30)
+    radii = rng.uniform(0.5, 5.0, 30)
+    nodes_df = assess.parse_tag_columns(nodes_with_edge_cases(query_lats, query_longs, np.zeros(30)), TAGS.keys())
+
+    for radius_km in [2.0, radii]:
+        batch = assess.get_pois_count_df_from_coords(query_lats, query_longs, TAGS, None, radius_km=radius_km, tag_filtered_osm_nodes_df=nodes_df)
+        for n, (lat, long, radius) in enumerate(zip(query_lats, query_longs, np.broadcast_to(radius_km, query_lats.shape))):
+            within = haversine_km(lat, long, nodes_df["latitude"].to_numpy(), nodes_df["longitude"].to_numpy()) <= radius
+            expected = {feature: int((within & (nodes_df[f"tag:{tag}"] == feature).to_numpy()).sum()) for tag, features in TAGS.items() for feature in features}
+            assert batch.iloc[n].to_dict() == expected
+        assert batch.to_numpy().sum() > 0
+
+OSMTag = collections.namedtuple("OSMTag", ["k", "v"])
+
+# Ways 1 and 3 and relation 2 share ids with nodes; node 3 matches only through its way
+OSM_ELEMENTS = [
+    (0, 1, 52.1, 0.1, {"amenity": "cafe"}),
+    (1, 1, 52.2, 0.2, {"amenity": "school"}),
+    (0, 2, 52.3, 0.3, {"shop": "bakery", "name": "Fitzbillies"}),
+    (2, 2, np.nan, np.nan, {"amenity": "cafe"}),
+    (0, 3, 52.4, 0.4, {"amenity": "bench"}),
+    (0, 4, 52.5, 0.5, {"amenity": "school", "shop": "bakery"}),
+    (1, 3, 52.6, 0.6, {"shop": "bakery"}),
+]
+
+def json_contains(document, candidate, path):
+    """ The MariaDB JSON_CONTAINS(doc, candidate, '$.key') calls of get_all_pois_sql, for SQLite. """
+    return json.loads(document).get(path[len("$."):]) == json.loads(candidate)
+
+@pytest.fixture
+def osm_engine(tmp_path):
+    access.dispose_engines()
+    engine = access.get_engine_for_url(f"sqlite:///{tmp_path / 'osm.db'}")
+    sqlalchemy.event.listen(engine, "connect", lambda dbapi_connection, record: dbapi_connection.create_function("JSON_CONTAINS", 3, json_contains))
+    yield engine
+    access.dispose_engines()
+
+def write_osm_elements(engine, elements, tags_table=None):
+    buffer = access.OSMColumnBuffer()
+    for element_type, osm_id, lat, lon, tags in elements:
+        buffer.append(element_type, osm_id, lat, lon, [OSMTag(key, value) for key, value in tags.items()])
+    with engine.begin() as conn:
+        access.osm_sql_sink(conn, tags_table=tags_table)(*buffer.to_frames())
+        if tags_table is not None:
+            access.create_osm_indexes(conn)
+
+def assert_matching_nodes(nodes_df):
+    assert nodes_df["id"].tolist() == [1, 2, 4]
+    assert (nodes_df["type"] == "node").all()
+    assert nodes_df["tag:amenity"].astype(object).fillna("").tolist() == ["cafe", "", "school"]
+    assert nodes_df["tag:shop"].astype(object).fillna("").tolist() == ["", "bakery", "bakery"]
+
+def test_indexed_sql_returns_only_matching_nodes(osm_engine):
+    write_osm_elements(osm_engine, OSM_ELEMENTS, tags_table="osm_england_tags")
+    assert_matching_nodes(assess.get_all_pois_sql(None, None, None, TAGS, engine=osm_engine))
+    assert_matching_nodes(assess.get_all_pois_sql(None, None, None, TAGS, indexed=True, engine=osm_engine))
+
+def test_json_scan_without_tag_table(osm_engine):
+    # A database loaded before create_osm_indexes: nodes only, no osm_england_tags
+    write_osm_elements(osm_engine, [element for element in OSM_ELEMENTS if element[0] == 0])
+    assert_matching_nodes(assess.get_all_pois_sql(None, None, None, TAGS, engine=osm_engine))
+    with pytest.raises(Exception, match="osm_england_tags"):
+        assess.get_all_pois_sql(None, None, None, TAGS, indexed=True, engine=osm_engine)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, assess, benchmark
+
+POSTCODE_DF = benchmark.synthetic_postcode_data(40, seed=0)
+PP_DF = benchmark.synthetic_pp_data(2500, POSTCODE_DF, years=(2019, 2020), seed=0)
+
+def expected_stats(df, value_column, by=None):
+    values = df[value_column].astype(np.float64)
+    if by is None:
+        return values.agg(["count", "mean", "std", "min", "max"]).to_frame().T
+    return values.groupby([df[column] for column in by]).agg(["count", "mean", "std", "min", "max"])
+
+@pytest.fixture
+def engine(tmp_path):
+    access.dispose_engines()
+    engine = access.get_engine_for_url(f"sqlite:///{tmp_path / 'pp.db'}")
+    PP_DF.to_sql("pp_data", engine, index=False)
+    yield engine
+    access.dispose_engines()
+
+@pytest.mark.parametrize("by", [None, ["property_type", "tenure_type"]])
+def test_aggregate_matches_concat(by):
+    chunks = [PP_DF.iloc[start:start + 300] for start in range(0, len(PP_DF), 300)]
+    result = assess.aggregate_df_chunks(chunks, "price", by)
+    expected = expected_stats(PP_DF, "price", by)
+    assert result["count"].tolist() == expected["count"].astype(np.int64).tolist()
+    for column in ["mean", "std", "min", "max"]:
+        np.testing.assert_allclose(result[column].to_numpy(), expected[column].to_numpy(), rtol=1e-9)
+    if by is not None:
+        assert list(result.index) == list(expected.index)
+
+def test_aggregate_of_no_chunks_is_empty():
+    assert list(assess.aggregate_df_chunks([], "price").columns) == ["count", "mean", "std", "min", "max"]
+
+def test_downcast_dtypes():
+    df = PP_DF.merge(POSTCODE_DF[["postcode", "latitude", "longitude"]], on="postcode")
+    df["db_id"] = np.arange(len(df), dtype=np.int64)
+    df = assess.downcast_df(df)
+    for column in ["property_type", "tenure_type", "new_build_flag", "county", "record_status"]:
+        assert isinstance(df[column].dtype, pd.CategoricalDtype)
+    assert df["latitude"].dtype == np.float32 and df["longitude"].dtype == np.float32
+    assert pd.api.types.is_datetime64_any_dtype(df["date_of_transfer"])
+    assert df["price"].dtype == np.int32
+    assert df["db_id"].dtype == np.int16
+    assert df["postcode"].dtype == PP_DF["postcode"].dtype
+
+def test_streamed_chunks_match_full_read(engine):
+    chunks = list(assess.iter_df_from_sql("pp_data", columns=["price", "property_type", "date_of_transfer"], chunksize=1000, engine=engine))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+    assert all(isinstance(chunk["property_type"].dtype, pd.CategoricalDtype) for chunk in chunks)
+    streamed = pd.concat(chunks, ignore_index=True)
+    assert streamed["price"].tolist() == PP_DF["price"].tolist()
+    assert streamed["date_of_transfer"].tolist() == pd.to_datetime(PP_DF["date_of_transfer"]).tolist()
+
+    full = assess.get_df_from_sql("pp_data", engine=engine)
+    pd.testing.assert_frame_equal(
+        assess.aggregate_df_chunks(assess.iter_df_from_sql("pp_data", columns=["price", "tenure_type"], chunksize=700, engine=engine), "price", "tenure_type"),
+        assess.aggregate_df_chunks([full], "price", "tenure_type"))
+
+def test_streamed_query_with_params(engine):
+    chunks = assess.iter_df_from_sql_query("SELECT price FROM pp_data WHERE tenure_type = ?", chunksize=400, params=("F",), engine=engine)
+    assert sum(len(chunk) for chunk in chunks) == (PP_DF["tenure_type"] == "F").sum()
+
+def test_compare_sql_read_memory(engine):
+    peaks = assess.compare_sql_read_memory("pp_data", chunksize=500, engine=engine)
+    assert set(peaks) == {"get_df_from_sql", "streaming"}
+    assert all(peak > 0 for peak in peaks.values())
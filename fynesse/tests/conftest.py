@@ -0,0 +1,47 @@
+import os
+import types
+
+import pytest
+
+from fynesse import access
+
+@pytest.fixture
+def serve_osm(monkeypatch):
+    """ Replaces osmnx in access with a stand-in serving a given GeoDataFrame.
+
+        Calling serve_osm(world) installs the stand-in and returns the list
+        of every (north, south, east, west) bbox fetched from it.
+    """
+    def serve(world):
+        calls = []
+
+        def geometries_from_bbox(north, south, east, west, tags):
+            calls.append((north, south, east, west))
+            return access.filter_tags(world.cx[west:east, south:north], tags).copy()
+        monkeypatch.setattr(access, "ox", types.SimpleNamespace(geometries_from_bbox=geometries_from_bbox))
+        return calls
+    return serve
+
+# A scratch MariaDB database: its pp_data, postcode_data and
+# prices_coordinates_data tables are dropped and recreated.
+DB_ENV = ["FYNESSE_TEST_DB_HOST", "FYNESSE_TEST_DB_USER", "FYNESSE_TEST_DB_PASSWORD", "FYNESSE_TEST_DB_NAME"]
+
+@pytest.fixture
+def mariadb_conn():
+    """ A connection to the scratch MariaDB, skipping the test if none is configured. """
+    if not all(os.environ.get(name) for name in DB_ENV):
+        pytest.skip("no scratch MariaDB configured (" + ", ".join(DB_ENV) + ")")
+    host, user, password, database = (os.environ[name] for name in DB_ENV)
+    conn = access.create_connection(user, password, host, database, int(os.environ.get("FYNESSE_TEST_DB_PORT", 3306)))
+    if conn is None:
+        pytest.skip("scratch MariaDB is not reachable")
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def mariadb_engine(mariadb_conn):
+    """ A SQLAlchemy engine on the same scratch MariaDB as mariadb_conn. """
+    host, user, password, database = (os.environ[name] for name in DB_ENV)
+    engine = access.get_engine(user, password, host, database, int(os.environ.get("FYNESSE_TEST_DB_PORT", 3306)))
+    yield engine
+    access.dispose_engines()
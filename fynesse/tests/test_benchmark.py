@@ -0,0 +1,51 @@
+import copy
+import json
+
+import pytest
+
+from fynesse import benchmark
+
+def test_scaling_exponent():
+    scales = [100, 1000, 10000]
+    assert benchmark.scaling_exponent(scales, [2 * s for s in scales]) == pytest.approx(1)
+    assert benchmark.scaling_exponent(scales, [s * s for s in scales]) == pytest.approx(2)
+    assert benchmark.scaling_exponent(scales, [5, 5, 5]) == pytest.approx(0)
+    # Zero timings are dropped, and one point is not a curve
+    assert benchmark.scaling_exponent(scales, [0, 0, 3]) is None
+
+def test_measure_resets_before_every_call():
+    calls = []
+    measured = benchmark.measure(lambda: calls.append("run"), repeats=3, reset=lambda: calls.append("reset"))
+    assert calls == ["reset", "run"] * 4
+    assert measured["seconds"] >= 0 and measured["peak_mb"] >= 0
+
+@pytest.fixture(scope="module")
+def results(tmp_path_factory):
+    output_path = tmp_path_factory.mktemp("benchmarks") / "run.json"
+    results = benchmark.run_benchmarks(["GeoLayerIndex.count_boxes", "get_pois_count_df_from_coords"], scales=[200, 400], repeats=1, output_path=str(output_path))
+    return results, output_path
+
+def test_run_benchmarks_writes_json(results):
+    results, output_path = results
+    with open(output_path) as f:
+        assert json.load(f) == results
+    assert set(results["benchmarks"]) == {"GeoLayerIndex.count_boxes", "get_pois_count_df_from_coords"}
+    for curve in results["benchmarks"].values():
+        assert curve["scales"] == [200, 400]
+        assert all(seconds > 0 for seconds in curve["seconds"])
+        assert len(curve["peak_mb"]) == 2
+        assert curve["time_exponent"] is not None
+
+def test_compare_benchmarks_flags_slowdown(results):
+    results, output_path = results
+    same = benchmark.compare_benchmarks(str(output_path), results)
+    assert len(same) == 4
+    assert not any(row["regression"] for row in same)
+
+    slower = copy.deepcopy(results)
+    curve = slower["benchmarks"]["GeoLayerIndex.count_boxes"]
+    curve["seconds"] = [2 * seconds for seconds in curve["seconds"]]
+    rows = benchmark.compare_benchmarks(results, slower)
+    flagged = {(row["benchmark"], row["scale"]) for row in rows if row["regression"]}
+    assert flagged == {("GeoLayerIndex.count_boxes", 200), ("GeoLayerIndex.count_boxes", 400)}
+    assert all(row["time_ratio"] == pytest.approx(2) for row in rows if row["benchmark"] == "GeoLayerIndex.count_boxes")
@@ -0,0 +1,14 @@
+import subprocess
+import sys
+
+from fynesse import benchmark
+
+def test_import_within_budget():
+    result = benchmark.check_import_time("fynesse", budget_seconds=0.25)
+    assert result["seconds"] > 0
+
+def test_import_defers_heavy_dependencies():
+    heavy = ["numpy", "pandas", "geopandas", "osmnx", "osmium", "matplotlib", "sqlalchemy", "pymysql", "scipy", "pyarrow"]
+    code = f"import sys, fynesse; print(','.join(m for m in {heavy!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip()
+    assert loaded == ""
@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import sys
+import timeit
+
+import pytest
+import sqlalchemy
+
+from fynesse import access, benchmark, metrics
+
+@pytest.fixture
+def logs():
+    """ Metrics enabled with JSON lines written to a buffer; restored afterwards. """
+    stream = io.StringIO()
+    state = dict(metrics._state)
+    metrics.reset()
+    metrics.enable(stream=stream)
+    yield stream
+    metrics.disable()
+    metrics._state.update(state)
+    metrics.reset()
+    access.dispose_engines()
+
+def records(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+def test_peak_rss_mb():
+    assert metrics.peak_rss_mb() > 0
+
+def test_peak_rss_mb_without_resource(monkeypatch):
+    # As on Windows, without psutil installed
+    monkeypatch.setitem(sys.modules, "resource", None)
+    monkeypatch.setitem(sys.modules, "psutil", None)
+    assert metrics.peak_rss_mb() == 0.0
+
+def test_nested_spans(logs, tmp_path):
+    with metrics.span("outer", year=2020) as outer:
+        with metrics.span("inner") as inner:
+            inner.add(rows=10, bytes=2048)
+        with metrics.span("inner") as inner:
+            inner.add(rows=5)
+        outer.add(rows=15, files=2)
+    metrics.count("things", 3)
+    metrics.count("things")
+
+    snapshot = metrics.snapshot()
+    assert snapshot["spans"]["inner"]["calls"] == 2
+    assert snapshot["spans"]["inner"]["rows"] == 15
+    assert snapshot["spans"]["inner"]["bytes"] == 2048
+    assert snapshot["spans"]["inner"]["min_seconds"] <= snapshot["spans"]["inner"]["max_seconds"]
+    assert snapshot["spans"]["outer"]["rows_per_second"] > 0
+    assert snapshot["counters"] == {"things": 4}
+    assert snapshot["peak_rss_mb"] > 0
+
+    lines = records(logs)
+    assert [line["span"] for line in lines] == ["inner", "inner", "outer"]
+    assert [line["parent"] for line in lines] == ["outer", "outer", None]
+    assert lines[2]["year"] == 2020 and lines[2]["files"] == 2
+    # Only top-level spans read the peak RSS
+    assert "peak_rss_mb" not in lines[0] and lines[2]["peak_rss_mb"] > 0
+    assert lines[0]["event"] == "inner" and lines[0]["level"] == "INFO" and lines[0]["logger"] == "fynesse"
+
+    path = metrics.dump(str(tmp_path / "metrics.json"))
+    with open(path) as file:
+        assert json.load(file)["spans"]["outer"]["calls"] == 1
+
+def test_span_records_errors(logs):
+    with pytest.raises(ValueError):
+        with metrics.span("failing"):
+            raise ValueError("boom")
+    assert metrics.snapshot()["spans"]["failing"]["errors"] == 1
+    assert records(logs)[-1]["error"] == "ValueError"
+
+def test_disabled_is_a_no_op(logs):
+    metrics.disable()
+    span = metrics.span("ignored")
+    assert span is metrics.span("other")
+    with span as s:
+        s.add(rows=1)
+    metrics.count("ignored")
+    metrics.record("ignored", 1.0, rows=1)
+    assert metrics.snapshot() == {"spans": {}, "counters": {}, "peak_rss_mb": 0.0}
+    assert logs.getvalue() == ""
+
+def test_engine_queries_are_timed(logs, tmp_path):
+    engine = access.get_engine_for_url(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text("CREATE TABLE t (x INT)"))
+        conn.execute(sqlalchemy.text("INSERT INTO t VALUES (1), (2), (3)"))
+        assert conn.execute(sqlalchemy.text("SELECT COUNT(*) FROM t")).scalar() == 3
+    spans = metrics.snapshot()["spans"]
+    assert spans["db.query.insert"]["rows"] == 3
+    assert spans["db.query.select"]["calls"] == 1
+    assert spans["db.query"]["calls"] >= 3
+    queries = [line for line in records(logs) if line["event"] == "db.query"]
+    assert [line["verb"] for line in queries if line["verb"] in ("CREATE", "INSERT", "SELECT")] == ["CREATE", "INSERT", "SELECT"]
+    assert next(line for line in queries if line["verb"] == "INSERT")["statement"].startswith("INSERT INTO t")
+
+def test_span_cost_under_one_percent_of_a_realistic_join(logs):
+    # Wall-clock comparisons of whole runs are noisier than 1%, so bound the
+    # cost of the spans a run opens against the uninstrumented run instead
+    with contextlib.redirect_stdout(io.StringIO()):
+        run, reset = benchmark.BENCHMARKS["housing_upload_join_data"][0](50_000, 0)
+        metrics.disable()
+        seconds = benchmark.measure(run, repeats=3, reset=reset)["seconds"]
+        metrics.enable(stream=logs)
+        metrics.reset()
+        reset()
+        run()
+    spans = sum(stats["calls"] for stats in metrics.snapshot()["spans"].values())
+
+    def top_level_span():
+        with metrics.span("overhead", year=2020) as span:
+            span.add(rows=1)
+    span_seconds = min(timeit.repeat(top_level_span, number=1000, repeat=5)) / 1000
+    assert spans > 0
+    assert spans * span_seconds < 0.01 * seconds